@@ -0,0 +1,40 @@
+import requests
+
+from wikiteam3.utils.adaptive_timeout import (
+    DEFAULT_TIMEOUT, READ_TIMEOUT_MAX, LatencyTracker, endpoint_key, request_weight,
+)
+
+
+def _prepare(method="GET", url="https://wiki.example/w/api.php", **kwargs):
+    return requests.Request(method, url, **kwargs).prepare()
+
+
+def test_endpoint_key():
+    assert endpoint_key("https://Wiki.example/w/api.php?action=query") == "wiki.example/api.php"
+    assert endpoint_key("https://wiki.example/index.php/Main_Page") == "wiki.example/"
+    assert endpoint_key("https://wiki.example/images/a/ab/Foo.png") == "wiki.example/"
+
+
+def test_request_weight():
+    assert request_weight(_prepare(params={"action": "query", "list": "allpages"})) == 1
+    assert request_weight(_prepare(params={"action": "query", "rvlimit": 500})) == 10
+    export = _prepare("POST", "https://wiki.example/w/index.php", data={"title": "Special:Export", "limit": 100})
+    assert request_weight(export) == 8
+    assert request_weight(_prepare(params={"export": 1, "arvlimit": 5000})) == 20
+
+
+def test_timeout_follows_latency():
+    tracker = LatencyTracker()
+    assert tracker.timeout("wiki.example/api.php") == DEFAULT_TIMEOUT
+    assert tracker.timeout("wiki.example/api.php", default=30) == 30
+
+    for _ in range(50):
+        tracker.record("wiki.example/api.php", 0.5)
+    tracker.record("wiki.example/api.php", 10, weight=10) # heavy request, 1s per unit
+    connect, read = tracker.timeout("wiki.example/api.php")
+    assert connect == 5 and read == 10 # floors
+    assert tracker.timeout("wiki.example/api.php", weight=10) == (5, 40)
+
+    for _ in range(50):
+        tracker.record("wiki.example/api.php", 300)
+    assert tracker.timeout("wiki.example/api.php", weight=10)[1] == READ_TIMEOUT_MAX
@@ -0,0 +1,38 @@
+import json
+
+import requests
+
+from wikiteam3.dumpgenerator.api.limits import api_limit, has_apihighlimits
+from wikiteam3.dumpgenerator.config import Config
+
+
+class FakeSession:
+    def __init__(self, data):
+        self.data = data
+        self.params = None
+
+    def get(self, url, params=None, timeout=None):
+        self.params = params
+        r = requests.Response()
+        r.status_code = 200
+        r._content = json.dumps(self.data).encode()
+        return r
+
+
+def test_has_apihighlimits():
+    bot = FakeSession({"query": {"userinfo": {"id": 1, "name": "Bot", "rights": ["read", "bot", "apihighlimits"]}}})
+    assert has_apihighlimits(api="https://wiki.example/api.php", session=bot) # type: ignore
+    assert bot.params["uiprop"] == "rights"
+
+    anon = FakeSession({"query": {"userinfo": {"id": 0, "name": "127.0.0.1", "anon": "", "rights": ["read"]}}})
+    assert not has_apihighlimits(api="https://wiki.example/api.php", session=anon) # type: ignore
+    assert not has_apihighlimits(api="https://wiki.example/api.php", session=FakeSession({})) # type: ignore
+
+
+def test_api_limit():
+    assert api_limit(Config()) == 500
+    assert api_limit(Config(), content=True) == 50
+    assert api_limit(Config(api_highlimits=True)) == 5000
+    assert api_limit(Config(api_highlimits=True), content=True) == 500
+    # --api_chunksize wins
+    assert api_limit(Config(api_chunksize=20, api_highlimits=True)) == 20
@@ -0,0 +1,79 @@
+import json
+import threading
+import time
+
+import wikiteam3.dumpgenerator # noqa: F401 # wikiteam3.utils can't be imported first (circular import)
+from wikiteam3.batch.runner import BatchRunner, read_queue
+from wikiteam3.dumpgenerator.exceptions import DumpError, WikiEngineFound
+
+
+def write_queue(tmp_path, lines):
+    path = tmp_path / "queue.txt"
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return read_queue(str(path))
+
+
+def test_read_queue(tmp_path):
+    jobs = write_queue(tmp_path, ["# comment", "", "https://a.fandom.com/ --images", "https://wiki.example/w/"])
+    assert [(job.wiki, job.args, job.farm) for job in jobs] == [
+        ("https://a.fandom.com/", ["--images"], "fandom.com"),
+        ("https://wiki.example/w/", [], "wiki.example"),
+    ]
+
+
+def test_per_farm_scheduling_and_results(tmp_path):
+    jobs = write_queue(tmp_path, [
+        "https://a.fandom.com/", "https://b.fandom.com/", "https://c.fandom.com/",
+        "https://one.example/", "https://two.example/ --fail",
+    ])
+    lock = threading.Lock()
+    running = {}
+    max_running = {}
+    sessions = {}
+
+    def dump(params, session):
+        farm = "fandom" if "fandom" in params[0] else params[0]
+        with lock:
+            running[farm] = running.get(farm, 0) + 1
+            max_running[farm] = max(max_running.get(farm, 0), running[farm])
+            sessions.setdefault(farm, set()).add(id(session))
+        time.sleep(0.05)
+        with lock:
+            running[farm] -= 1
+        if "--fail" in params:
+            raise DumpError("Error in index.php", exit_code=11)
+
+    results = tmp_path / "results.jsonl"
+    runner = BatchRunner(jobs, ["--xml"], workers=4, per_farm=1, results_path=str(results), dump=dump)
+    runner.sessions.factory = object # no need for real sessions
+    runner.run()
+
+    assert max_running["fandom"] == 1
+    assert len(sessions["fandom"]) == 1 # reused
+    lines = [json.loads(line) for line in results.read_text(encoding="utf-8").splitlines()]
+    status = {r["wiki"]: (r["status"], r["exit_code"]) for r in lines}
+    assert status["https://two.example/"] == ("failed", 11)
+    assert [r["error"] for r in lines if r["status"] == "failed"] == ["Error in index.php"]
+    assert status["https://a.fandom.com/"] == ("done", 0)
+    assert len(lines) == 5
+
+    # restart: only the failed one is run again
+    ran = []
+    runner = BatchRunner(jobs, [], results_path=str(results), dump=lambda params, session: ran.append(params[0]))
+    runner.sessions.factory = object
+    runner.run()
+    assert ran == ["https://two.example/"]
+
+
+def test_get_wiki_engine_is_not_a_failure(tmp_path):
+    jobs = write_queue(tmp_path, ["https://wiki.example/"])
+
+    def dump(params, session):
+        raise WikiEngineFound("MediaWiki")
+
+    results = tmp_path / "results.jsonl"
+    runner = BatchRunner(jobs, ["--get-wiki-engine"], workers=1, per_farm=1, results_path=str(results), dump=dump)
+    runner.sessions.factory = object
+    runner.run()
+    [result] = [json.loads(line) for line in results.read_text(encoding="utf-8").splitlines()]
+    assert (result["status"], result["exit_code"], result["error"]) == ("done", 0, None)
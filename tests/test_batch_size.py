@@ -0,0 +1,43 @@
+from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils.checkpoint import Checkpoint
+from wikiteam3.utils.batch_size import BATCH_SIZES_FILENAME, BatchSize, get_batch_size, is_truncated_result
+
+
+def test_grow_and_shrink():
+    batch = BatchSize("api.php|arvlimit", initial=50, minimum=1, maximum=500)
+    assert batch.step == 50
+    assert batch.success(0.1) == 100
+    assert batch.success(3600) == 100 # slow answers do not grow the batch
+    assert batch.failure() and batch.value == 50
+    for _ in range(10):
+        batch.failure()
+    assert batch.value == 1
+    assert not batch.failure()
+    for _ in range(100):
+        batch.success()
+    assert batch.value == 500
+
+
+def test_drop_ramps_up_again():
+    batch = BatchSize("api.php|arvlimit", initial=50, minimum=1)
+    assert batch.drop() and batch.value == 1
+    assert not batch.drop()
+    assert batch.success(0.1) == 6 # step by step, not back to 50
+    assert batch.success(0.1) == 11
+
+
+def test_learned_value_is_persisted(tmp_path):
+    config = Config(path=str(tmp_path))
+    batch = get_batch_size(config, "https://wiki.example/index.php", "limit", initial=1000, minimum=10)
+    assert get_batch_size(config, "https://wiki.example/index.php", "limit", initial=1000, minimum=10) is batch
+    batch.failure()
+    assert (tmp_path / BATCH_SIZES_FILENAME).exists()
+
+    resumed = BatchSize(batch.key, initial=1000, minimum=10, store=Checkpoint(str(tmp_path / BATCH_SIZES_FILENAME)))
+    assert resumed.value == 500
+
+
+def test_is_truncated_result():
+    assert is_truncated_result({"warnings": {"result": {"*": "This result was truncated because it would otherwise be larger than the limit of 8,388,608 bytes."}}})
+    assert not is_truncated_result({"warnings": {"main": {"*": "Unrecognized parameter"}}})
+    assert not is_truncated_result({})
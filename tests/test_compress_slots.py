@@ -0,0 +1,47 @@
+import threading
+import time
+
+import pytest
+
+from wikiteam3.uploader import compress_slots
+from wikiteam3.uploader.compress_slots import SLOT_BYTES, CompressSlots, zstd_memory
+
+pytestmark = pytest.mark.skipif(compress_slots.fcntl is None, reason="flock() not available")
+
+
+def test_zstd_memory():
+    assert zstd_memory(17, 31) == 4.5 * SLOT_BYTES
+    assert zstd_memory(22, 31) == 12 * SLOT_BYTES
+    assert zstd_memory(17, 31, src_size=1000) < SLOT_BYTES # small files don't need the whole window
+
+
+def test_weighted_slots(tmp_path):
+    # two instances, as if in two processes
+    a, b = CompressSlots(4, tmp_path), CompressSlots(4, tmp_path)
+    assert a.weight(2.5 * SLOT_BYTES) == 3
+    assert a.weight(100 * SLOT_BYTES) == 4 # a too large compression runs alone
+
+    held = a.acquire(3)
+    small = b.acquire(1) # still fits
+    acquired = threading.Event()
+
+    def wait_for_two():
+        fds = b.acquire(2)
+        acquired.set()
+        b.release(fds)
+
+    thread = threading.Thread(target=wait_for_two, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    assert not acquired.is_set()
+    a.release(held)
+    thread.join(timeout=5)
+    assert acquired.is_set()
+    b.release(small)
+
+
+def test_hold_unlimited(tmp_path):
+    with CompressSlots(None, tmp_path).hold(100 * SLOT_BYTES):
+        pass
+    assert not list(tmp_path.iterdir())
+
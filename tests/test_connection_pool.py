@@ -0,0 +1,49 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import wikiteam3.dumpgenerator # noqa: F401 # wikiteam3.utils can't be imported first (circular import)
+from wikiteam3.utils.connection_pool import ConnectionStats, IdleTrackingAdapter
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+
+def test_idle_connections_are_retired(server_url):
+    stats = ConnectionStats()
+    adapter = IdleTrackingAdapter(max_idle=0.3)
+    adapter.poolmanager.pool_classes_by_scheme["http"].stats = stats
+    session = requests.Session()
+    session.mount("http://", adapter)
+
+    for _ in range(3):
+        assert session.get(server_url, timeout=5).text == "ok"
+    assert stats.snapshot()["handshakes"] == 1
+    assert stats.snapshot()["reuses"] == 2
+
+    time.sleep(0.5)
+    session.get(server_url, timeout=5)
+    assert stats.snapshot()["idle_retired"] == 1
+    assert stats.snapshot()["handshakes"] == 2
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from wikiteam3.dumpgenerator.api.continuation import ContinuedQuery, Prefetcher, next_continue_params
+
+
+def test_next_continue_params():
+    assert next_continue_params({"continue": {"apcontinue": "B", "continue": "-||"}}) == {"apcontinue": "B", "continue": "-||"}
+    assert next_continue_params({"query-continue": {"allpages": {"apfrom": "B"}}}) == {"apfrom": "B"}
+    assert next_continue_params({"batchcomplete": ""}) is None
+
+
+def _fake_api(batches):
+    """`fetch` of a list=allpages with `batches` of titles, in the legacy form every other batch"""
+    calls = []
+
+    def fetch(params):
+        calls.append((dict(params), threading.current_thread().name))
+        i = int(params.get("apcontinue") or params.get("apfrom") or 0)
+        response = {"query": {"allpages": batches[i]}}
+        if i + 1 < len(batches):
+            if i % 2:
+                response["query-continue"] = {"allpages": {"apfrom": str(i + 1)}}
+            else:
+                response["continue"] = {"apcontinue": str(i + 1), "continue": "-||"}
+        return response
+    return fetch, calls
+
+
+def test_continued_query_prefetches_next_batch():
+    batches = [["A"], ["B"], ["C"], ["D"]]
+    fetch, calls = _fake_api(batches)
+    query = ContinuedQuery(fetch, {"list": "allpages"})
+    seen, tokens = [], []
+    for response in query:
+        seen += response["query"]["allpages"]
+        tokens.append(query.next_continue_params)
+    assert seen == ["A", "B", "C", "D"]
+    assert tokens == [{"apcontinue": "1", "continue": "-||"}, {"apfrom": "2"}, {"apcontinue": "3", "continue": "-||"}, None]
+    assert [params.get("apcontinue") or params.get("apfrom") for params, _ in calls] == [None, "1", "2", "3"]
+    assert all(thread.startswith("prefetch") for _, thread in calls[1:])
+
+
+def test_continued_query_resumes():
+    fetch, calls = _fake_api([["A"], ["B"], ["C"]])
+    query = ContinuedQuery(fetch, {"list": "allpages"}, continue_params={"apcontinue": "1"}, prefetch=False)
+    assert [r["query"]["allpages"] for r in query] == [["B"], ["C"]]
+    assert len(calls) == 2
+
+
+def test_prefetcher_ignores_keys():
+    calls = []
+    prefetcher = Prefetcher(lambda params: calls.append(params) or len(calls), ignore=("arvlimit",))
+    prefetcher.submit({"arvcontinue": "x", "arvlimit": 50})
+    assert prefetcher.get({"arvcontinue": "x", "arvlimit": 100}) == 1
+    assert prefetcher.get({"arvcontinue": "y", "arvlimit": 100}) == 2
+    prefetcher.close()
+
+
+def test_prefetcher_fetched_params_and_discard():
+    calls, discarded = [], []
+    prefetcher = Prefetcher(lambda params: calls.append(params) or len(calls), ignore=("arvlimit",),
+                            discard=discarded.append)
+    prefetcher.submit({"arvcontinue": "x", "arvlimit": 50})
+    prefetcher.submit({"arvcontinue": "x", "arvlimit": 100}) # already fetching
+    assert prefetcher.get({"arvcontinue": "x", "arvlimit": 100}) == 1
+    assert prefetcher.fetched == {"arvcontinue": "x", "arvlimit": 50} # what to send to read the batch again
+    assert len(calls) == 1
+
+    prefetcher.submit({"arvcontinue": "y", "arvlimit": 100})
+    while len(calls) < 2:
+        time.sleep(0.01)
+    prefetcher.close() # never returned
+    for _ in range(100):
+        if discarded:
+            break
+        time.sleep(0.01)
+    assert discarded == [2]
@@ -0,0 +1,30 @@
+from pathlib import Path
+
+from wikiteam3.dumpgenerator.dump.page.xmlrev.xml_revisions_page import legacy_revision, make_xml_from_page
+from wikiteam3.utils.json_stream import JSONItemStream
+
+DATA = Path(__file__).parent / "data" / "formatversion"
+
+
+def _pages(name: str):
+    data = (DATA / name).read_bytes()
+    return data, list(JSONItemStream([data], ("query", "allrevisions")))
+
+
+def test_formatversion2_gives_the_same_xml():
+    fv1_data, fv1_pages = _pages("allrevisions_fv1.json")
+    fv2_data, fv2_pages = _pages("allrevisions_fv2.json")
+    assert len(fv1_pages) == len(fv2_pages) == 3
+    for fv1, fv2 in zip(fv1_pages, fv2_pages):
+        assert make_xml_from_page(fv1, "") == make_xml_from_page(fv2, "")
+    assert 'deleted="deleted"' in make_xml_from_page(fv2_pages[0])
+    # non-ASCII content is not \uXXXX-escaped with utf8=1
+    assert len(fv2_data) < len(fv1_data) * 0.7
+
+
+def test_legacy_revision():
+    rev = {"revid": 1, "minor": False, "anon": True, "slots": {"main": {"contentmodel": "wikitext", "content": "x"}}}
+    assert legacy_revision(rev) == {"revid": 1, "anon": "", "contentmodel": "wikitext", "*": "x"}
+    assert legacy_revision({"revid": 1, "content": "x"}) == {"revid": 1, "*": "x"}
+    fv1 = {"revid": 1, "minor": "", "*": "x"}
+    assert legacy_revision(fv1) is fv1
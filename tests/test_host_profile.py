@@ -0,0 +1,167 @@
+import json
+import time
+
+import pytest
+
+from wikiteam3.dumpgenerator.cli import cli
+from wikiteam3.dumpgenerator import DumpGenerator
+from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.dumpgenerator.exceptions import WikiEngineFound
+from wikiteam3.utils import monkey_patch
+from wikiteam3.utils.batch_size import BATCH_SIZES_FILENAME
+from wikiteam3.utils.host_profile import HostProfile, apply_tuning_profile, discovery_key, save_tuning_profile
+
+API = "https://wiki.example/w/api.php"
+
+
+def test_save_get(tmp_path):
+    key = discovery_key("https://wiki.example/", None, None)
+    profile = HostProfile("https://Wiki.Example/", profile_dir=str(tmp_path / "profiles"))
+    assert profile.get(key) is None
+    profile.save(key, api=API, index="https://wiki.example/w/index.php")
+
+    entry = HostProfile("https://wiki.example/", profile_dir=str(tmp_path / "profiles")).get(key)
+    assert entry is not None and entry["api"] == API
+    assert (tmp_path / "profiles" / "wiki.example.json").exists()
+
+
+def test_ttl(tmp_path):
+    key = discovery_key("https://wiki.example/", None, None)
+    profile = HostProfile(API, profile_dir=str(tmp_path))
+    profile.save(key, api=API, index="")
+    profile.store.update(key, {**profile.store.get(key), "time": time.time() - 10 * 24 * 3600}) # type: ignore
+
+    assert profile.get(key) is None
+    assert HostProfile(API, ttl_days=30, profile_dir=str(tmp_path)).get(key) is not None
+
+    disabled = HostProfile(API, ttl_days=0, profile_dir=str(tmp_path / "disabled"))
+    disabled.save(key, api=API, index="")
+    assert disabled.get(key) is None
+    assert not (tmp_path / "disabled").exists()
+
+
+def test_tuning_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.setattr("wikiteam3.utils.host_profile.PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setattr(HostProfile.__init__, "__defaults__", (7.0, str(tmp_path / "profiles")))
+    monkeypatch.setattr(monkey_patch, "_host_encodings", {"wiki.example": "gbk", "other.example": "big5"})
+
+    first = Config(api=API, path=str(tmp_path / "first"), http_method="GET", export="Spezial:Exportieren")
+    (tmp_path / "first").mkdir()
+    with open(tmp_path / "first" / BATCH_SIZES_FILENAME, "w", encoding="utf-8") as f:
+        json.dump({f"{API}|arvlimit": 20}, f)
+    save_tuning_profile(first)
+
+    monkeypatch.setattr(monkey_patch, "_host_encodings", {})
+    second = Config(api=API, path=str(tmp_path / "second"), http_method="POST")
+    (tmp_path / "second").mkdir()
+    apply_tuning_profile(second)
+    assert second.http_method == "GET"
+    assert second.export == "Spezial:Exportieren"
+    assert monkey_patch._host_encodings == {"wiki.example": "gbk"} # not the other hosts of the process
+    with open(tmp_path / "second" / BATCH_SIZES_FILENAME, encoding="utf-8") as f:
+        assert json.load(f) == {f"{API}|arvlimit": 20}
+
+
+INDEX = "https://wiki.example/w/index.php"
+
+
+@pytest.fixture
+def offline_cli(tmp_path, monkeypatch):
+    """get_parameters() with the network calls of the discovery replaced, returns the calls"""
+    monkeypatch.setattr(HostProfile.__init__, "__defaults__", (7.0, str(tmp_path / "profiles")))
+    monkeypatch.setattr(cli, "has_apihighlimits", lambda api, session: False)
+    calls = {"check_API": [], "check_retry_API": [], "probes": [], "check_index": []}
+    good_indexes = {INDEX}
+
+    def check_API(api, session):
+        calls["check_API"].append(api)
+        return (True, INDEX, api) if api == API else None
+
+    def check_retry_API(api, apiclient, session):
+        calls["check_retry_API"].append(api)
+        return check_API(api, session), api
+
+    def probe_indexes(candidates, logged_in, session, deadline, delay):
+        calls["probes"].append(candidates)
+        for candidate in candidates:
+            yield candidate, (1.0 if candidate in good_indexes else 0.0)
+
+    monkeypatch.setattr(cli, "check_API", check_API)
+    monkeypatch.setattr(cli, "check_retry_API", check_retry_API)
+    def check_index(index, logged_in, session, deadline, delay):
+        calls["check_index"].append(index)
+        return 1.0 if index in good_indexes else 0.0
+
+    monkeypatch.setattr(cli, "probe_indexes", probe_indexes)
+    monkeypatch.setattr(cli, "check_index", check_index)
+    return calls, good_indexes
+
+
+def get_parameters(tmp_path, *params):
+    return cli.get_parameters(["--path", str(tmp_path / "dump"), "--xml", "--xmlrevisions", *params])
+
+
+def test_discovery_saved_and_rechecked(tmp_path, offline_cli):
+    calls, _ = offline_cli
+    config, _ = get_parameters(tmp_path, "--api", API)
+    assert (config.api, config.index) == (API, INDEX)
+    assert calls["check_retry_API"] == [API] and calls["probes"]
+
+    for called in calls.values():
+        called.clear()
+    config, _ = get_parameters(tmp_path, "--api", API)
+    assert (config.api, config.index) == (API, INDEX)
+    assert calls == {"check_API": [API], "check_retry_API": [], "probes": [], "check_index": [INDEX]} # cheap checks
+
+
+def test_failed_index_not_saved(tmp_path, offline_cli):
+    calls, good_indexes = offline_cli
+    good_indexes.clear() # --xmlrevisions goes on without index.php
+    get_parameters(tmp_path, "--api", API)
+    assert HostProfile(API).get(discovery_key(None, API, None)) is None
+
+    calls["check_retry_API"].clear()
+    get_parameters(tmp_path, "--api", API)
+    assert calls["check_retry_API"] == [API] # full discovery again
+
+
+def test_failed_api_not_saved(tmp_path, offline_cli):
+    bad_api = "https://wiki.example/broken/api.php"
+    config, _ = get_parameters(tmp_path, "--api", bad_api, "--index", INDEX)
+    assert config.index == INDEX
+    assert HostProfile(bad_api).get(discovery_key(None, bad_api, INDEX)) is None
+
+
+def test_stale_profile_rediscovered(tmp_path, offline_cli):
+    calls, _ = offline_cli
+    stale_api = "https://wiki.example/old/api.php"
+    key = discovery_key(None, API, None)
+    HostProfile(API).save(key, api=stale_api, index=INDEX)
+
+    config, _ = get_parameters(tmp_path, "--api", API)
+    assert calls["check_API"][0] == stale_api
+    assert calls["check_retry_API"] == [API]
+    assert config.api == API
+    assert HostProfile(API).get(key)["api"] == API # type: ignore
+
+
+def test_profile_index_rechecked(tmp_path, offline_cli):
+    calls, good_indexes = offline_cli
+    moved = "https://wiki.example/index.php"
+    HostProfile(API).save(discovery_key(None, API, None), api=API, index=moved)
+
+    config, _ = get_parameters(tmp_path, "--api", API)
+    assert calls["check_index"] == [moved]
+    assert calls["check_retry_API"] == [API] # full discovery
+    assert config.index == INDEX
+
+
+def test_get_wiki_engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, "get_WikiEngine", lambda url, session: "MediaWiki")
+    with pytest.raises(WikiEngineFound) as e:
+        cli.get_parameters(["https://wiki.example/", "--get-wiki-engine"])
+    assert (e.value.engine, e.value.exit_code) == ("MediaWiki", 0)
+
+    with pytest.raises(SystemExit) as exit:
+        DumpGenerator(["https://wiki.example/", "--get-wiki-engine"])
+    assert exit.value.code == 0
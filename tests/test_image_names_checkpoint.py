@@ -0,0 +1,55 @@
+from types import SimpleNamespace
+
+import pytest
+
+from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.dumpgenerator.dump.image.image import Image
+from wikiteam3.utils.util import sort_unique_lines
+
+NAMES = ["Z.png", "A.png", "M.png", "B.png", "A.png"]
+
+
+def fake_batches(fail_after=None):
+    """ batches of 2 images, raises after `fail_after` batches """
+    starts = []
+
+    def get_image_names_API_batches(config, session, mode="allimages", start="!"):
+        starts.append(start)
+        i = 0 if start == "!" else int(start)
+        c = 0
+        while i < len(NAMES):
+            if fail_after is not None and c >= fail_after:
+                raise ConnectionError("boom")
+            batch = [[name, f"http://x/{name}", "Uploader", 1, "null", "null"] for name in NAMES[i:i + 2]]
+            i += 2
+            c += 1
+            yield batch, mode, str(i) if i < len(NAMES) else ""
+
+    return get_image_names_API_batches, starts
+
+
+def test_sort_unique_lines(tmp_path):
+    path = tmp_path / "lines.txt"
+    path.write_bytes(b"c\nb\na\nb\nd\nc")
+    sort_unique_lines(path, run_lines=2)
+    assert path.read_bytes() == b"a\nb\nc\nd\n"
+
+
+def test_fetch_image_names_resumes(tmp_path, monkeypatch):
+    config = Config(api="http://x/api.php", path=str(tmp_path), date="20260101")
+    other = SimpleNamespace(session=None, assert_max_images=None, assert_max_images_bytes=None)
+
+    batches, _ = fake_batches(fail_after=2)
+    monkeypatch.setattr(Image, "get_image_names_API_batches", batches)
+    with pytest.raises(ConnectionError):
+        Image.fetch_image_names(config=config, other=other)
+
+    batches, starts = fake_batches()
+    monkeypatch.setattr(Image, "get_image_names_API_batches", batches)
+    images = Image.fetch_image_names(config=config, other=other)
+    assert starts == ["4"] # resumed after the second batch
+    assert [image[0] for image in images] == ["A.png", "B.png", "M.png", "Z.png"]
+
+    images_path = tmp_path / Image.get_images_filename(config)
+    assert Image.load_image_names(images_path) == (images, True)
+    assert not (tmp_path / (images_path.name + ".checkpoint.json")).exists()
@@ -0,0 +1,101 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+from wikiteam3.dumpgenerator.api.index_check import check_index, probe_indexes
+
+MEDIAWIKI_PAGE = b'<html class="client-nojs"><body class="mediawiki">ok</body></html>'
+
+
+class WikiHandler(BaseHTTPRequestHandler):
+    """/slow/index.php: Special:Random is a 404, Special:Version answers after 0.3s, everything else hangs for 3s
+    /order/index.php: Special:Random answers a non-MediaWiki page after 0.3s, the others MediaWiki at once
+    /dead/index.php: 404
+    /ok/index.php: MediaWiki
+    """
+
+    requests = []
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        title = parse_qs(self.rfile.read(length).decode()).get("title", [""])[0]
+        WikiHandler.requests.append((time.monotonic(), self.path, title))
+        if self.path.startswith("/dead/") or (self.path.startswith("/slow/") and title == "Special:Random"):
+            status, body = 404, b"not found"
+        elif self.path.startswith("/slow/"):
+            time.sleep(0.3 if title == "Special:Version" else 3)
+            status, body = 200, MEDIAWIKI_PAGE
+        elif self.path.startswith("/order/") and title == "Special:Random":
+            time.sleep(0.3)
+            status, body = 200, b"<html>not a wiki</html>"
+        else:
+            status, body = 200, MEDIAWIKI_PAGE
+        try:
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError: # the client gave up
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    WikiHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WikiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_first_conclusive_answer(server_url):
+    start = time.monotonic()
+    assert check_index(index=f"{server_url}/slow/index.php", logged_in=False, session=requests.Session()) == 0.9
+    assert time.monotonic() - start < 2
+
+
+def test_candidates_in_order(server_url):
+    results = list(probe_indexes(
+        [f"{server_url}/dead/index.php", f"{server_url}/ok/index.php"], logged_in=False, session=requests.Session()
+    ))
+    assert [probability for _, probability in results] == [0.2, 0.9]
+
+
+def test_deadline(server_url):
+    start = time.monotonic()
+    candidates = [f"{server_url}/slow/index.php?deadline"] * 2
+    session = requests.Session()
+    # Special:Version of the candidates answers after 0.3s, still too late: the 404 of
+    # Special:Random decides the first one, the deadline is exceeded before the second one
+    results = list(probe_indexes(candidates, logged_in=False, session=session, deadline=time.monotonic() + 0.1))
+    assert [probability for _, probability in results] == [0.2, 0.0]
+    assert time.monotonic() - start < 1
+
+
+def test_decided_in_page_order(server_url):
+    # Special:Random answers last, but comes first in PROBE_PAGES
+    assert check_index(index=f"{server_url}/order/index.php", logged_in=False, session=requests.Session()) == 0.2
+
+
+def test_candidates_probed_lazily(server_url):
+    candidates = [f"{server_url}/ok/index.php", f"{server_url}/dead/index.php"]
+    for candidate, probability in probe_indexes(candidates, logged_in=False, session=requests.Session()):
+        assert probability == 0.9
+        break
+    time.sleep(0.1)
+    assert not [path for _, path, _ in WikiHandler.requests if path.startswith("/dead/")]
+
+
+def test_rate_limited(server_url):
+    assert check_index(index=f"{server_url}/ok/index.php", logged_in=False, session=requests.Session(), delay=0.3) == 0.9
+    time.sleep(0.5)
+    # Special:Random decided, the other probes were waiting for the limiter and are not sent
+    assert [title for _, _, title in WikiHandler.requests] == ["Special:Random"]
@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from wikiteam3.dumpgenerator.config import Config # noqa: F401 # wikiteam3.utils can't be imported first (circular import)
+from wikiteam3.utils.json_stream import JSONItemStream
+
+
+def _chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+RESPONSE = {
+    "batchcomplete": "",
+    "continue": {"arvcontinue": "20200101000000|42", "continue": "-||"},
+    "warnings": {"main": {"*": "Unrecognized parameter"}},
+    "query": {
+        "allrevisions": [
+            {"pageid": i, "revisions": [{"revid": i * 10 + j, "*": "Ünïcödé " * (i * 100)} for j in range(3)],
+             "ns": 0, "title": f"Page {i}"}
+            for i in range(10)
+        ],
+        "userinfo": {"id": 0, "anon": ""},
+    },
+    "limit": 12345,
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096, 1 << 20])
+def test_items_are_streamed(chunk_size):
+    data = b"\xef\xbb\xbf" + json.dumps(RESPONSE, ensure_ascii=False).encode("utf-8")
+    stream = JSONItemStream(_chunks(data, chunk_size), ("query", "allrevisions"))
+    assert list(stream) == RESPONSE["query"]["allrevisions"]
+    assert stream.count == 10
+    expected = dict(RESPONSE, query={"allrevisions": [], "userinfo": {"id": 0, "anon": ""}})
+    assert stream.document == expected
+
+
+def test_object_values_are_streamed():
+    data = json.dumps({"query": {"pages": {"1": {"title": "A"}, "2": {"title": "B"}}}}).encode()
+    stream = JSONItemStream(_chunks(data, 3), ("query", "pages"))
+    assert list(stream) == [{"title": "A"}, {"title": "B"}]
+    assert stream.document == {"query": {"pages": {}}}
+
+
+def test_document_without_items():
+    stream = JSONItemStream([b'{"error": {"code": "badvalue", "info": "..."}}'], ("query", "pages")).start()
+    assert not stream.started
+    assert stream.document == {"error": {"code": "badvalue", "info": "..."}}
+    assert list(stream) == []
+
+
+def test_invalid_document():
+    with pytest.raises(json.JSONDecodeError):
+        JSONItemStream([b"<!DOCTYPE html><html>"], ("query", "pages")).start()
+    stream = JSONItemStream([b'{"query": {"pages": [1, 2'], ("query", "pages"))
+    with pytest.raises(json.JSONDecodeError):
+        list(stream)
+
+
+def test_close():
+    closed = []
+    stream = JSONItemStream([b'{"query": {"allrevisions": [1, 2, 3]}}'], ("query", "allrevisions"),
+                            on_close=lambda: closed.append(True))
+    items = iter(stream)
+    assert next(items) == 1
+    stream.close()
+    assert closed == [True]
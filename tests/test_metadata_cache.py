@@ -0,0 +1,144 @@
+import json
+import threading
+
+import mwclient
+import requests
+
+from wikiteam3.dumpgenerator.api import metadata_cache
+from wikiteam3.dumpgenerator.api.metadata_cache import METADATA_CACHE_FILENAME, MetadataCache, _init_site, get_site
+from wikiteam3.dumpgenerator.api.namespaces import getNamespacesAPI
+from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.dumpgenerator.dump.misc.site_info import get_siteinfo
+
+API = "https://wiki.example/w/api.php"
+SITEINFO = {"query": {
+    "general": {"generator": "MediaWiki 1.39.5", "sitename": "Example"},
+    "namespaces": {
+        "-1": {"id": -1, "*": "Special"},
+        "0": {"id": 0, "*": ""},
+        "1": {"id": 1, "*": "Talk"},
+    },
+    "userinfo": {"id": 0, "name": "127.0.0.1", "anon": ""},
+}}
+
+
+class NoRequestSession:
+    def get(self, *args, **kwargs):
+        raise AssertionError("unexpected request")
+
+
+def test_fetch_once_and_persist(tmp_path):
+    cache = MetadataCache()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {"query": {"x": 1}}
+
+    # the dump dir doesn't exist yet: memory only
+    dump_dir = tmp_path / "dump"
+    assert cache.get(API, "siteinfo", fetch, path=str(dump_dir)) == {"query": {"x": 1}}
+    assert cache.get(API, "siteinfo", fetch, path=str(dump_dir)) == {"query": {"x": 1}}
+    assert len(calls) == 1
+
+    dump_dir.mkdir()
+    assert cache.get(API, "siteinfo", fetch, path=str(dump_dir)) == {"query": {"x": 1}}
+    with open(dump_dir / METADATA_CACHE_FILENAME, encoding="utf-8") as f:
+        assert json.load(f) == {f"{API}|siteinfo": {"query": {"x": 1}}}
+
+    # resumed dump
+    assert MetadataCache().get(API, "siteinfo", fetch, path=str(dump_dir)) == {"query": {"x": 1}}
+    assert len(calls) == 1
+
+
+def test_invalid_not_cached():
+    cache = MetadataCache()
+    assert cache.get(API, "siteinfo", lambda: {"error": {}}, valid=lambda r: "query" in r) == {"error": {}}
+    assert cache.peek(API, "siteinfo") is None
+
+
+def test_reuse_siteinfo(tmp_path, monkeypatch):
+    import wikiteam3.dumpgenerator.api.namespaces as namespaces_module
+    import wikiteam3.dumpgenerator.dump.misc.site_info as site_info_module
+    cache = MetadataCache()
+    monkeypatch.setattr(namespaces_module, "METADATA_CACHE", cache)
+    monkeypatch.setattr("wikiteam3.dumpgenerator.api.metadata_cache.METADATA_CACHE", cache)
+    monkeypatch.setattr(site_info_module, "_fetch_siteinfo", lambda config, session: SITEINFO)
+
+    config = Config(api=API, path=str(tmp_path), namespaces=["all"])
+    assert get_siteinfo(config, NoRequestSession()) == SITEINFO # type: ignore
+    namespaces, names = getNamespacesAPI(config, NoRequestSession()) # type: ignore
+    assert sorted(namespaces) == [0, 1]
+    assert names == {0: "", 1: "Talk"}
+
+
+def test_init_site():
+    site = mwclient.Site("wiki.example", "/w/", do_init=False)
+    _init_site(site, SITEINFO, SITEINFO["query"]["userinfo"])
+    assert site.initialized
+    assert site.version[:2] == (1, 39)
+    assert site.namespaces == {-1: "Special", 0: "", 1: "Talk"}
+    assert site.username == "127.0.0.1"
+
+
+def test_dump_dir_gets_only_its_api(tmp_path):
+    cache = MetadataCache()
+    other_api = "https://other.example/api.php"
+    cache.get(other_api, "siteinfo", lambda: {"query": "other"}, path=str(tmp_path / "other"))
+    cache.get(API, "siteinfo", lambda: {"query": "this"}, path=str(tmp_path / "dump"))
+    (tmp_path / "dump").mkdir()
+    cache.peek(API, "siteinfo", path=str(tmp_path / "dump"))
+    with open(tmp_path / "dump" / METADATA_CACHE_FILENAME, encoding="utf-8") as f:
+        assert json.load(f) == {f"{API}|siteinfo": {"query": "this"}}
+
+    cache.forget(API.replace("https://", "http://"))
+    assert cache.peek(API, "siteinfo") is None
+    assert cache.peek(other_api, "siteinfo") == {"query": "other"}
+
+
+def test_fetch_without_the_global_lock():
+    cache = MetadataCache()
+    slow_started, done = threading.Event(), threading.Event()
+
+    def slow():
+        slow_started.set()
+        assert done.wait(5)
+        return {"query": "slow"}
+    thread = threading.Thread(target=cache.get, args=(API, "slow", slow))
+    thread.start()
+    assert slow_started.wait(5)
+    assert cache.get(API, "fast", lambda: {"query": "fast"}) == {"query": "fast"} # not blocked by the slow fetch
+    done.set()
+    thread.join()
+
+
+class SiteSession:
+    def __init__(self, username):
+        self.username = username
+        self.requests = []
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        self.requests.append("siteinfo" in params["meta"]) # mwclient may add "|userinfo" itself
+        query = {"userinfo": {"id": 1, "name": self.username, "groups": ["user"], "rights": ["read"]}}
+        if "siteinfo" in params["meta"]:
+            query.update(general=SITEINFO["query"]["general"], namespaces=SITEINFO["query"]["namespaces"])
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({"query": query}).encode()
+        return response
+
+    get = post = lambda self, url, **kwargs: self.request("GET", url, **kwargs)
+
+
+def test_userinfo_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata_cache, "METADATA_CACHE", MetadataCache())
+    anonymous = SiteSession("127.0.0.1")
+    assert get_site(API, anonymous, path=str(tmp_path)).username == "127.0.0.1" # type: ignore
+    assert anonymous.requests == [True] # one request
+
+    logged_in = SiteSession("Bot")
+    site = get_site(API, logged_in, path=str(tmp_path)) # type: ignore
+    assert site.username == "Bot" and site.rights == ["read"]
+    assert logged_in.requests == [False] # userinfo only
+    with open(tmp_path / METADATA_CACHE_FILENAME, encoding="utf-8") as f:
+        assert "userinfo" not in json.load(f)[f"{API}|site_init"]["query"]
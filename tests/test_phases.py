@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+import requests
+
+import wikiteam3.dumpgenerator # noqa: F401 # wikiteam3.utils can't be imported first (circular import)
+from wikiteam3.utils.monkey_patch import SessionMonkeyPatch
+from wikiteam3.utils.phases import current_phase, run_phases
+
+
+def test_concurrent_phases_overlap(capsys):
+    barrier = threading.Barrier(2, timeout=5)
+    seen = {}
+
+    def phase(label):
+        def run():
+            seen[label] = current_phase()
+            barrier.wait() # deadlocks (BrokenBarrierError) if run one after another
+            print("working\nstill working")
+        return run
+
+    run_phases([("xml", phase("xml")), ("images", phase("images"))], concurrent=True)
+    assert seen == {"xml": "xml", "images": "images"}
+    out = capsys.readouterr().out.splitlines()
+    assert "[xml] still working" in out
+    assert "[images] working" in out
+    assert current_phase() is None
+
+
+def test_failed_phase_doesnt_stop_others():
+    done = []
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        run_phases([("xml", fail), ("images", lambda: done.append(1))], concurrent=True)
+    assert done == [1]
+
+
+def test_session_patches_released_in_any_order():
+    session = requests.Session()
+    original = session.send
+    a = SessionMonkeyPatch(session=session, hard_retries=1)
+    b = SessionMonkeyPatch(session=session, hard_retries=2)
+    a.hijack()
+    b.hijack()
+    a.release()
+    assert session.send is not original
+    b.release()
+    assert session.send == original
+    assert not session.__dict__.get("_wikiteam3_patches")
+
+
+def test_session_patch_of_the_current_phase():
+    session = requests.Session()
+    barrier = threading.Barrier(2, timeout=5)
+    sent = []
+
+    def phase(label):
+        def run():
+            patch = SessionMonkeyPatch(session=session)
+            patch.hijack()
+            patch.old_send_method = lambda request, **kwargs: sent.append((current_phase(), label)) # type: ignore
+            barrier.wait() # both patches are active
+            session.send(requests.Request("GET", "http://example.invalid/").prepare())
+            barrier.wait()
+            patch.release()
+        return run
+
+    run_phases([("xml", phase("xml")), ("images", phase("images"))], concurrent=True)
+    assert sorted(sent) == [("images", "images"), ("xml", "xml")]
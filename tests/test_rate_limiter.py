@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+
+import requests
+
+from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils.rate_limiter import (
+    MAX_RETRY_AFTER,
+    MAXLAG,
+    Backpressure,
+    DynamicDelay,
+    RateLimiter,
+    install_rate_limiter,
+    parse_retry_after,
+)
+
+
+def test_reserve_credits_elapsed_time():
+    limiter = RateLimiter()
+    assert limiter.reserve("a", 10) == 0
+    assert 9 < limiter.reserve("a", 10) <= 10 # second request waits for the slot
+    assert limiter.reserve("b", 10) == 0 # buckets are per host
+    assert limiter.reserve("c", 0) == 0
+
+    limiter = RateLimiter()
+    limiter.reserve("a", 0.05)
+    time.sleep(0.06) # the request took longer than the delay
+    assert limiter.reserve("a", 0.05) == 0
+
+
+def test_concurrent_acquire_is_spaced():
+    limiter = RateLimiter()
+    threads = [threading.Thread(target=limiter.acquire, args=("a", 0.02)) for _ in range(5)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert time.monotonic() - start >= 0.02 * 4
+
+
+def test_dynamic_delay_polls_config_json(tmp_path):
+    config = Config(delay=1.5, path=str(tmp_path))
+    delay = DynamicDelay(config, poll_interval=0)
+    assert delay.get() == 1.5
+
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump({"delay": 0.25}, f)
+    assert delay.get() == 0.25
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("5") == 5
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0 # in the past
+    assert parse_retry_after("99999") == MAX_RETRY_AFTER
+
+
+def test_backpressure_backs_off_and_recovers():
+    limiter = RateLimiter()
+    backpressure = Backpressure(limiter=limiter, base_interval=1.0, recovery=0.5)
+    assert backpressure.interval("a", 0.5) == 0.5
+
+    assert backpressure.on_overload("a", retry_after=3) == 3
+    assert limiter.reserve("a", 0) > 2 # held for Retry-After
+    assert backpressure.interval("a", 0.5) == 2.0
+    assert backpressure.on_overload("a") == 4.0
+
+    for _ in range(2):
+        backpressure.on_success("a")
+    assert backpressure.interval("a", 0.5) == 0.5
+    assert backpressure.interval("b", 0.5) == 0.5
+
+
+def _response(url, status=200, headers=None):
+    r = requests.Response()
+    r.url, r.status_code = url, status
+    r._content, r._content_consumed = b"{}", True
+    r.headers.update(headers or {})
+    return r
+
+
+def test_session_adds_maxlag_and_retries_lagged_responses():
+    session = requests.Session()
+    sent = []
+    responses = [
+        _response("http://wiki/api.php", headers={"MediaWiki-API-Error": "maxlag", "X-Database-Lag": "7", "Retry-After": "0"}),
+        _response("http://wiki/api.php"),
+    ]
+
+    def send(request, **kwargs):
+        sent.append(request.url)
+        return responses.pop(0)
+
+    session.send = send
+    install_rate_limiter(session, Config(delay=0), limiter=RateLimiter(), backpressure=Backpressure(limiter=RateLimiter()))
+    r = session.get("http://wiki/api.php", params={"action": "query"})
+    assert r.status_code == 200 and not responses
+    assert sent == ["http://wiki/api.php?action=query&maxlag=%d" % MAXLAG] * 2
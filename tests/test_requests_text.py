@@ -0,0 +1,68 @@
+import pytest
+import requests
+
+import wikiteam3.dumpgenerator # noqa: F401 # wikiteam3.utils can't be imported first (circular import)
+from wikiteam3.utils import monkey_patch
+from wikiteam3.utils.monkey_patch import decode_counting_fffd, detect_encoding, mod_requests_text
+
+mod_requests_text(requests)
+
+
+def _response(content: bytes, url="https://wiki.example/index.php", encoding=None):
+    r = requests.Response()
+    r._content = content
+    r.url = url
+    r.encoding = encoding
+    return r
+
+
+def test_decode_counting_fffd():
+    assert decode_counting_fffd("héllo �".encode("utf-8"), "utf-8") == ("héllo �", 0, None)
+    text, bad, e = decode_counting_fffd(b"ab\xffcd\xfe", "utf-8")
+    assert text == "ab�cd�" and bad == 2
+    assert isinstance(e, UnicodeDecodeError) and e.start == 2
+
+
+def test_encoding_is_detected_once_per_host(monkeypatch):
+    monkeypatch.setattr(monkey_patch, "_host_encodings", {})
+    body = ("Страница " * 2000).encode("utf-8")
+    assert _response(body).text == "Страница " * 2000
+    assert monkey_patch._host_encodings == {"wiki.example": "utf-8"}
+
+    def fail(*args):
+        raise AssertionError("charset detection should be cached")
+    monkeypatch.setattr(requests.compat.chardet, "detect", fail)
+    assert detect_encoding(_response(b"whatever")) == "utf-8"
+
+
+def test_bom_and_tolerance(monkeypatch):
+    monkeypatch.setattr(monkey_patch, "_host_encodings", {})
+    assert _response(b"\xef\xbb\xbf{}", encoding="utf-8").text == "{}"
+    with pytest.warns(UserWarning):
+        assert _response(b"a" * 1000 + b"\xff", encoding="utf-8").text == "a" * 1000 + "�"
+    with pytest.raises(UnicodeDecodeError):
+        _ = _response(b"\xff" * 10 + b"a", encoding="utf-8").text
+
+
+def test_ascii_prefix_is_inconclusive(monkeypatch):
+    monkeypatch.setattr(monkey_patch, "_host_encodings", {})
+    assert _response(b"<html>" + b"x" * 70000).text.startswith("<html>")
+    assert monkey_patch.get_host_encoding("wiki.example") is None # not cached as "ascii"
+
+    page = "Страница ünïcødé " * 100
+    assert _response(page.encode("utf-8")).text == page
+
+    # ASCII for more than ENCODING_DETECT_BYTES, then UTF-8
+    body = "x" * (monkey_patch.ENCODING_DETECT_BYTES + 10) + page
+    monkeypatch.setattr(monkey_patch, "_host_encodings", {})
+    assert _response(body.encode("utf-8")).text == body
+
+    monkey_patch.set_host_encoding("wiki.example", "ascii")
+    assert monkey_patch.get_host_encoding("wiki.example") == "utf-8" # left from the page above
+
+
+def test_cached_encoding_checked_against_the_response(monkeypatch):
+    monkeypatch.setattr(monkey_patch, "_host_encodings", {"wiki.example": "euc-jp"})
+    page = "Страница ünïcødé " * 100
+    assert _response(page.encode("utf-8")).text == page
+    assert monkey_patch.get_host_encoding("wiki.example") == "utf-8"
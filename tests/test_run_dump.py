@@ -0,0 +1,86 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from wikiteam3.dumpgenerator import DumpError, run_dump
+from wikiteam3.dumpgenerator.api.handle_status_code import handle_StatusCode
+from wikiteam3.dumpgenerator.config import Config, OtherConfig
+from wikiteam3.dumpgenerator.exceptions import WikiAvoidedError
+from wikiteam3.utils.phases import run_phases
+
+
+class NotFoundHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), NotFoundHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def new_other(**kwargs) -> OtherConfig:
+    other = dict(
+        resume=False, force=False, session=requests.Session(), bypass_cdn_image_compression=False,
+        add_referer_header=None, image_timestamp_interval=None, ia_wbm_booster=0,
+        assert_max_pages=None, assert_max_edits=None, assert_max_images=None, assert_max_images_bytes=None,
+        hard_retries=0, profile_ttl=0, concurrent_phases=False, upload=False, uploader_args=[],
+    )
+    other.update(kwargs)
+    return OtherConfig(**other)
+
+
+def test_wikimedia_projects_are_avoided(tmp_path):
+    config = Config(api="https://en.wikipedia.org/w/api.php", path=str(tmp_path / "dump"))
+    with pytest.raises(WikiAvoidedError) as e:
+        run_dump(config, new_other())
+    assert e.value.exit_code == 2
+
+
+def test_existing_dump_dir_without_prompt(tmp_path, server_url, monkeypatch):
+    monkeypatch.setattr("builtins.input", lambda *args: pytest.fail("input() called"))
+    config = Config(api=f"{server_url}/api.php", path=str(tmp_path))
+    with pytest.raises(DumpError, match="exists"):
+        run_dump(config, new_other())
+
+    asked = []
+    with pytest.raises(DumpError, match="No config file"):
+        run_dump(config, new_other(), confirm_resume=lambda config: asked.append(config.path) or True)
+    assert asked == [str(tmp_path)]
+
+
+def test_status_code_errors():
+    r = requests.Response()
+    r.status_code, r.url = 404, "https://wiki.example/index.php"
+    with pytest.raises(DumpError) as e:
+        handle_StatusCode(r)
+    assert e.value.exit_code == 1
+    r.status_code = 200
+    handle_StatusCode(r)
+
+
+def test_progress_events():
+    events = []
+
+    def fail():
+        raise DumpError("boom")
+
+    run_phases([("xml", lambda: None)], on_progress=lambda *event: events.append(event))
+    with pytest.raises(DumpError):
+        run_phases([("images", fail), ("redirects", lambda: None)], on_progress=lambda *event: events.append(event))
+    assert events == [("xml", "started"), ("xml", "done"), ("images", "started"), ("images", "failed")]
+
+    # a broken callback doesn't break the dump
+    run_phases([("xml", lambda: events.append("ran"))], on_progress=lambda *event: 1 / 0)
+    assert events[-1] == "ran"
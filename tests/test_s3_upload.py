@@ -0,0 +1,211 @@
+import base64
+import hashlib
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Set, Tuple
+
+import pytest
+
+import wikiteam3.dumpgenerator # noqa: F401 # wikiteam3.utils can't be imported first (circular import)
+from wikiteam3.uploader import s3_upload
+from wikiteam3.uploader.s3_upload import S3ChecksumError, S3Error, S3Uploader
+
+PART = 1024
+
+
+class FakeS3(ThreadingHTTPServer):
+    """Local stand-in of the IA S3 API: single PUTs and multipart uploads"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeS3Handler)
+        self.lock = threading.Lock()
+        self.objects: Dict[str, bytes] = {}
+        self.uploads: Dict[str, Dict[int, bytes]] = {}
+        self.requests: List[Tuple[str, str, Dict[str, List[str]]]] = [] # (method, path, query)
+        self.headers: List[Dict[str, str]] = []
+        self.fail_once: Set[int] = set()
+        """ part numbers answered with a 503 the first time """
+        self.fail_always: Set[int] = set()
+        """ part numbers answered with a 400 """
+        self.corrupt_once: Set[int] = set()
+        """ part numbers with a byte flipped on their way the first time """
+        self.check_md5 = True
+        """ reject the parts not matching their Content-MD5 (BadDigest) """
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def sent_parts(self) -> List[int]:
+        return [int(q["partNumber"][0]) for method, _, q in self.requests if method == "PUT" and "partNumber" in q]
+
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    server: FakeS3
+
+    def log_message(self, format, *args):
+        pass
+
+    def _answer(self, status: int, body: bytes = b"", headers: Dict[str, str] = {}):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read(self) -> Tuple[str, Dict[str, List[str]], bytes]:
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.requests.append((self.command, url.path, query))
+            self.server.headers.append(dict(self.headers))
+        return url.path, query, body
+
+    def do_PUT(self):
+        path, query, body = self._read()
+        if "partNumber" not in query:
+            self.server.objects[path] = body
+            return self._answer(200)
+        number = int(query["partNumber"][0])
+        with self.server.lock:
+            if number in self.server.fail_always:
+                return self._answer(400, b"<Error><Code>BadRequest</Code></Error>")
+            if number in self.server.fail_once:
+                self.server.fail_once.discard(number)
+                return self._answer(503, b"<Error><Code>SlowDown</Code></Error>")
+            if number in self.server.corrupt_once:
+                self.server.corrupt_once.discard(number)
+                body = bytes([body[0] ^ 0xFF]) + body[1:]
+            md5 = hashlib.md5(body)
+            if self.server.check_md5 and self.headers["Content-MD5"] != base64.b64encode(md5.digest()).decode():
+                return self._answer(400, b"<Error><Code>BadDigest</Code></Error>")
+            parts = self.server.uploads.get(query["uploadId"][0])
+            if parts is None:
+                return self._answer(404, b"<Error><Code>NoSuchUpload</Code></Error>")
+            parts[number] = body
+        self._answer(200, headers={"ETag": f'"{md5.hexdigest()}"'})
+
+    def do_POST(self):
+        path, query, body = self._read()
+        if "uploads" in query:
+            with self.server.lock:
+                upload_id = f"upload-{len(self.server.uploads) + 1}"
+                self.server.uploads[upload_id] = {}
+            return self._answer(200, (
+                '<InitiateMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+            ).encode())
+        parts = self.server.uploads.pop(query["uploadId"][0])
+        numbers = [int(n) for n in s3_upload.ElementTree.fromstring(body).itertext() if n.isdigit()]
+        self.server.objects[path] = b"".join(parts[n] for n in numbers)
+        etag = s3_upload._multipart_etag([hashlib.md5(parts[n]).hexdigest() for n in numbers])
+        self._answer(200, f'<CompleteMultipartUploadResult><ETag>"{etag}"</ETag></CompleteMultipartUploadResult>'.encode())
+
+    def do_DELETE(self):
+        _, query, _ = self._read()
+        self.server.uploads.pop(query["uploadId"][0], None)
+        self._answer(204)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setattr(s3_upload.time, "sleep", lambda seconds: None)
+    server = FakeS3()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_uploader(s3: FakeS3, tmp_path, **kwargs) -> S3Uploader:
+    kwargs.setdefault("workers", 3)
+    return S3Uploader("wiki-example_w-20240101", "access", "secret", {"title": "Wiki Dump"},
+                      state_path=tmp_path / "upload_state.json", endpoint=s3.endpoint,
+                      part_size=PART, multipart_threshold=4 * PART, **kwargs)
+
+
+def test_single_put_creates_the_item(s3, tmp_path):
+    local = tmp_path / "siteinfo.json"
+    local.write_bytes(b"{}")
+    make_uploader(s3, tmp_path).upload("siteinfo.json", local, md5=hashlib.md5(b"{}").hexdigest())
+
+    assert s3.objects == {"/wiki-example_w-20240101/siteinfo.json": b"{}"}
+    headers = s3.headers[0]
+    assert headers["Authorization"] == "LOW access:secret"
+    assert headers["x-archive-meta00-title"] == "uri(Wiki%20Dump)"
+    assert headers["x-archive-auto-make-bucket"] == "1"
+    assert headers["Content-MD5"] == "mZFLkyvTelC5g8XnyQrpOw=="
+
+
+def test_multipart_retries_a_failed_part(s3, tmp_path):
+    data = bytes(range(256)) * 23 # 5.75 parts
+    local = tmp_path / "wiki-history.xml.zst"
+    local.write_bytes(data)
+    s3.fail_once = {2, 5}
+    uploader = make_uploader(s3, tmp_path)
+    uploader.upload("wiki-history.xml.zst", local)
+
+    assert s3.objects["/wiki-example_w-20240101/wiki-history.xml.zst"] == data
+    assert sorted(s3.sent_parts()) == [1, 2, 2, 3, 4, 5, 5, 6]
+    assert uploader.state.get("wiki-history.xml.zst") is None # completed
+
+
+def test_multipart_resumes_the_missing_parts(s3, tmp_path):
+    data = b"x" * (6 * PART)
+    local = tmp_path / "wiki-history.xml.zst"
+    local.write_bytes(data)
+    s3.fail_always = {4}
+    with pytest.raises(S3Error):
+        make_uploader(s3, tmp_path, workers=1).upload("wiki-history.xml.zst", local)
+    sent = set(s3.sent_parts()) - {4}
+    assert {1, 2, 3} <= sent and 6 not in sent # the part in flight may still be sent
+    state = make_uploader(s3, tmp_path).state.get("wiki-history.xml.zst")
+    assert sorted(state["parts"]) == sorted(str(n) for n in sent)
+
+    s3.fail_always = set()
+    s3.requests.clear()
+    make_uploader(s3, tmp_path, bucket_exists=True).upload("wiki-history.xml.zst", local)
+    assert sorted(s3.sent_parts()) == sorted({1, 2, 3, 4, 5, 6} - sent)
+    assert s3.objects["/wiki-example_w-20240101/wiki-history.xml.zst"] == data
+
+
+def test_multipart_starts_over_when_the_file_changed(s3, tmp_path):
+    local = tmp_path / "wiki-history.xml.zst"
+    local.write_bytes(b"x" * (6 * PART))
+    s3.fail_always = {2}
+    with pytest.raises(S3Error):
+        make_uploader(s3, tmp_path, workers=1).upload("wiki-history.xml.zst", local)
+
+    s3.fail_always = set()
+    local.write_bytes(b"y" * (5 * PART))
+    make_uploader(s3, tmp_path).upload("wiki-history.xml.zst", local)
+    assert ("DELETE", "/wiki-example_w-20240101/wiki-history.xml.zst", {"uploadId": ["upload-1"]}) in s3.requests
+    assert s3.objects["/wiki-example_w-20240101/wiki-history.xml.zst"] == b"y" * (5 * PART)
+
+
+def test_multipart_resends_a_corrupted_part(s3, tmp_path):
+    data = bytes(range(256)) * 24
+    local = tmp_path / "wiki-history.xml.zst"
+    local.write_bytes(data)
+    s3.corrupt_once = {3}
+    make_uploader(s3, tmp_path).upload("wiki-history.xml.zst", local)
+
+    assert sorted(s3.sent_parts()) == [1, 2, 3, 3, 4, 5, 6] # BadDigest, sent again
+    assert s3.objects["/wiki-example_w-20240101/wiki-history.xml.zst"] == data
+
+
+def test_multipart_etag_mismatch(s3, tmp_path):
+    local = tmp_path / "wiki-history.xml.zst"
+    local.write_bytes(b"x" * (6 * PART))
+    s3.corrupt_once = {3}
+    s3.check_md5 = False # the corrupted part is kept
+    uploader = make_uploader(s3, tmp_path)
+    with pytest.raises(S3ChecksumError):
+        uploader.upload("wiki-history.xml.zst", local)
+    assert uploader.state.get("wiki-history.xml.zst") is None # uploaded again from scratch next time
@@ -0,0 +1,46 @@
+import pytest
+
+from wikiteam3.dumpgenerator.api.page_titles import _spill_namespace_titles
+from wikiteam3.utils.checkpoint import Checkpoint
+
+
+class FakeSite:
+    """ serves `list=allpages` in batches of 2, fails after `fail_after` requests """
+    api_limit = 2
+
+    def __init__(self, titles, fail_after=None):
+        self.titles = titles
+        self.fail_after = fail_after
+        self.requests = 0
+
+    def get(self, action, **kwargs):
+        if self.fail_after is not None and self.requests >= self.fail_after:
+            raise ConnectionError("boom")
+        self.requests += 1
+        start = int(kwargs.get("apcontinue", 0))
+        data = {"query": {"allpages": [{"title": t} for t in self.titles[start:start + 2]]}}
+        if start + 2 < len(self.titles):
+            data["continue"] = {"apcontinue": str(start + 2), "continue": "-||"}
+        return data
+
+
+def test_spill_resumes_from_checkpoint(tmp_path):
+    titles = [f"Page {i}" for i in range(7)]
+    spill_path = str(tmp_path / "titles.txt.ns0.tmp")
+    checkpoint_path = str(tmp_path / "titles.txt.checkpoint.json")
+
+    with pytest.raises(ConnectionError):
+        _spill_namespace_titles(FakeSite(titles, fail_after=2), 0, spill_path, Checkpoint(checkpoint_path))
+    # a partially written batch after the checkpoint must be dropped on resume
+    with open(spill_path, "a", encoding="utf-8") as f:
+        f.write("Page 4\nPa")
+
+    site = FakeSite(titles)
+    assert _spill_namespace_titles(site, 0, spill_path, Checkpoint(checkpoint_path)) == 3
+    assert site.requests == 2
+    with open(spill_path, encoding="utf-8") as f:
+        assert f.read().splitlines() == titles
+
+    checkpoint = Checkpoint(checkpoint_path)
+    assert checkpoint.get("0")["done"]
+    assert _spill_namespace_titles(FakeSite(titles, fail_after=0), 0, spill_path, checkpoint) == 0
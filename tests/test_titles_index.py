@@ -0,0 +1,54 @@
+from wikiteam3.dumpgenerator.api.titles_index import TitlesIndex
+
+
+def _write_titles(path, titles, end=True):
+    with open(path, "w", encoding="utf-8") as f:
+        for title in titles:
+            f.write(title + "\n")
+        if end:
+            f.write("--END--\n")
+
+
+def _read_titles(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f]
+
+
+def test_find_and_iter_from(tmp_path):
+    titles = [f"Page {i}" for i in range(1000)] + ["Ünïcödé", "Widget:AddThis"]
+    path = tmp_path / "titles.txt"
+    _write_titles(path, titles)
+
+    with TitlesIndex.open(path) as index:
+        assert len(index) == len(titles)
+        assert index.find("Page 500") == 500
+        assert index[1000] == "Ünïcödé"
+        assert "Widget:AddThis" in index
+        assert index.find("Not a page") is None
+        assert list(index.iter_from(index.find("Page 998"))) == ["Page 998", "Page 999", "Ünïcödé", "Widget:AddThis"]
+        assert list(index.iter_from(len(titles))) == []
+
+
+def test_build_removes_duplicates_with_small_runs(tmp_path):
+    titles = ["Main Page", "Widget:AddThis", "B", "Main Page", "C", "Widget:AddThis", "B"]
+    path = tmp_path / "titles.txt"
+    _write_titles(path, titles)
+
+    assert TitlesIndex.build(path, run_size=2) == 3
+    assert _read_titles(path) == ["Main Page", "Widget:AddThis", "B", "C", "--END--"]
+
+    with TitlesIndex(path) as index:
+        assert index.is_fresh()
+        assert list(index.iter_from(0)) == ["Main Page", "Widget:AddThis", "B", "C"]
+        assert index.find("C") == 3
+
+
+def test_open_rebuilds_stale_index(tmp_path):
+    path = tmp_path / "titles.txt"
+    _write_titles(path, ["A", "B"])
+    TitlesIndex.open(path).close()
+
+    _write_titles(path, ["A", "B", "Some longer title"])
+    with TitlesIndex.open(path) as index:
+        assert len(index) == 3
+        assert index.find("Some longer title") == 2
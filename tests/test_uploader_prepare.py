@@ -0,0 +1,113 @@
+import hashlib
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+import wikiteam3.dumpgenerator # noqa: F401 # wikiteam3.utils can't be imported first (circular import)
+from wikiteam3.dumpgenerator.config import Config, save_config
+from wikiteam3.uploader.compress_slots import CompressSlots
+from wikiteam3.uploader.compresser import ZstdCompressor
+from wikiteam3.uploader.manifest import FileDigests, Manifest, hash_file
+from wikiteam3.uploader.uploader import config2basename, get_xml_filename, is_uploaded, prepare_files_to_upload
+
+
+class FakeZstd:
+    """Writes `path`.zst, the XML one slowly"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.threads = {}
+        self.tested = []
+
+    def compress_file_digests(self, path: Path, *, level: int, threads: int = 0):
+        compressed = path.parent / (path.name + ".zst")
+        if compressed.exists():
+            return compressed.resolve(), None
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.threads[path.name] = threads
+        time.sleep(0.5 if path.suffix == ".xml" else 0.05)
+        compressed.write_bytes(path.read_bytes())
+        with self.lock:
+            self.running -= 1
+        hasher = hash_file(compressed)
+        return compressed.resolve(), FileDigests(size=hasher.size, md5=hasher.md5, sha1=hasher.sha1, verified=True)
+
+    def test_integrity(self, path) -> bool:
+        self.tested.append(path.name)
+        return True
+
+
+class FakeItem:
+    def __init__(self, files):
+        self.files = files
+
+
+def test_small_files_ready_before_the_xml(tmp_path):
+    config = Config(api="https://wiki.example/api.php", date="20240101", xml=True, redirects=True,
+                    path=str(tmp_path))
+    save_config(config, "config.json")
+    basename = config2basename(config)
+    (tmp_path / get_xml_filename(config)).write_text("<mediawiki>\n</mediawiki>\n", encoding="utf-8")
+    (tmp_path / f"{basename}-titles.txt").write_text("Main Page\n--END--\n", encoding="utf-8")
+    (tmp_path / f"{basename}-redirects.jsonl").write_text("{}\n", encoding="utf-8")
+    (tmp_path / "siteinfo.json").write_text("{}", encoding="utf-8")
+
+    ready = []
+    zstd = FakeZstd()
+    filedict = prepare_files_to_upload(
+        tmp_path, config, FakeItem([{"name": f"{basename}-dumpMeta/siteinfo.json", "size": "2"}]), # type: ignore
+        slots=CompressSlots(None), zstd_compressor=zstd, zstd_level=17, # type: ignore
+        sevenzip_compressor=None, workers=4, on_ready=lambda remote, local: ready.append(remote), # type: ignore
+    )
+
+    xml_remote = f"{get_xml_filename(config)}.zst"
+    assert ready[-1] == xml_remote # the small ones didn't wait for the slow one
+    assert zstd.max_running == 3
+    assert zstd.threads[get_xml_filename(config)] == 0 and zstd.threads[f"{basename}-titles.txt"] == 1
+    assert set(filedict) == set(ready) == {
+        f"{basename}-dumpMeta/config.json",
+        f"{basename}-dumpMeta/{basename}-titles.txt.zst",
+        f"{basename}-dumpMeta/{basename}-redirects.jsonl.zst",
+        xml_remote,
+    } # siteinfo.json is already uploaded
+    assert zstd.tested == [] # verified while compressed
+
+    # resume: nothing compressed nor tested again, the md5 is compared with IA's
+    xml_zst = tmp_path / xml_remote
+    item_files = [{"name": xml_remote, "size": str(xml_zst.stat().st_size), "md5": hash_file(xml_zst).md5}]
+    zstd = FakeZstd()
+    filedict = prepare_files_to_upload(
+        tmp_path, config, FakeItem(item_files), slots=CompressSlots(None), zstd_compressor=zstd, zstd_level=17, # type: ignore
+        sevenzip_compressor=None, # type: ignore
+    )
+    assert xml_remote not in filedict
+    assert zstd.max_running == 0 and zstd.tested == []
+
+
+def test_is_uploaded(tmp_path):
+    local = tmp_path / "a.txt"
+    local.write_bytes(b"abc")
+    manifest = Manifest(tmp_path)
+    md5 = hash_file(local).md5
+    assert is_uploaded(local, {"size": "3", "md5": md5}, manifest)
+    assert not is_uploaded(local, {"size": "3", "md5": "0" * 32}, manifest) # same size, other content
+    assert not is_uploaded(local, {"size": "4", "md5": md5}, manifest)
+
+
+@pytest.mark.skipif(not shutil.which("zstd"), reason="zstd not installed")
+def test_zstd_round_trip_digests(tmp_path):
+    source = tmp_path / "a.xml"
+    source.write_bytes(b"<page>wiki</page>\n" * 100000)
+    compressed, digests = ZstdCompressor().compress_file_digests(source, level=17, threads=1)
+    assert digests is not None and digests.verified
+    assert digests.source_size == source.stat().st_size
+    assert digests.source_sha1 == hashlib.sha1(source.read_bytes()).hexdigest()
+    assert digests.md5 == hashlib.md5(compressed.read_bytes()).hexdigest()
+    assert ZstdCompressor().compress_file_digests(source, level=17) == (compressed, None) # already compressed
@@ -0,0 +1 @@
+from wikiteam3.batch.runner import main
@@ -0,0 +1,4 @@
+from wikiteam3.batch.runner import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import datetime
+import json
+import os
+import shlex
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set
+from urllib.parse import urlparse
+
+import requests
+
+from wikiteam3.dumpgenerator.cli.cli import build_session, getArgumentParser, get_parameters
+from wikiteam3.dumpgenerator.dump import DumpResult, run_dump
+from wikiteam3.dumpgenerator.exceptions import DumpError, WikiEngineFound
+from wikiteam3.utils.phases import labeled, labeled_output
+from wikiteam3.utils.rate_limiter import farm_key
+
+DEFAULT_RESULTS = "batch_results.jsonl"
+
+
+@dataclass
+class BatchJob:
+    wiki: str
+    args: List[str]
+    """ extra wikiteam3dumpgenerator arguments of this wiki """
+
+    @property
+    def host(self) -> str:
+        return (urlparse(self.wiki).hostname or "").lower()
+
+    @property
+    def farm(self) -> str:
+        return farm_key(self.host)
+
+
+def dump_wiki(params: List[str], session: requests.Session) -> DumpResult:
+    """Dump one wiki of the batch, an existing dump dir is resumed"""
+    config, other = get_parameters(params=params, session=session)
+    return run_dump(config, other, confirm_resume=lambda config: True)
+
+
+def read_queue(path: str) -> List[BatchJob]:
+    """One wiki per line: `URL [dumpgenerator args...]`, blank lines and `#` comments are skipped"""
+    jobs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            wiki, *args = shlex.split(line)
+            jobs.append(BatchJob(wiki=wiki, args=args))
+    return jobs
+
+
+def load_done(results_path: str) -> Set[str]:
+    """Wikis already dumped successfully according to the results file"""
+    done = set()
+    if not os.path.exists(results_path):
+        return done
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue # truncated last line
+            if result.get("status") == "done":
+                done.add(result["wiki"])
+    return done
+
+
+class SessionPool:
+    """
+    Idle sessions per farm, reused by the next dump of the same farm (warm connection pools,
+    cookies, learned timeouts). A session is only used by one dump at a time.
+    """
+
+    def __init__(self, factory: Callable[[], requests.Session]):
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._idle: Dict[str, List[requests.Session]] = {}
+
+    def acquire(self, farm: str) -> requests.Session:
+        with self._lock:
+            if self._idle.get(farm):
+                return self._idle[farm].pop()
+        return self.factory()
+
+    def release(self, farm: str, session: requests.Session):
+        with self._lock:
+            self._idle.setdefault(farm, []).append(session)
+
+
+class BatchRunner:
+    """
+    Run the dumps of `jobs` in this process, `workers` at a time, at most `per_farm` at a time
+    on the same wiki farm (see `farm_key()`). The wikis of a farm share the per-host rate limit.
+
+    Every finished dump appends a line to `results_path` (JSON Lines), wikis already "done"
+    there are skipped, so an interrupted batch can simply be restarted.
+    """
+
+    def __init__(self, jobs: List[BatchJob], common_args: List[str], *, workers: int = 4, per_farm: int = 1,
+                 results_path: str = DEFAULT_RESULTS,
+                 dump: Callable[[List[str], requests.Session], Optional[DumpResult]] = dump_wiki):
+        assert workers >= 1 and per_farm >= 1
+        self.common_args = common_args
+        self.workers = workers
+        self.per_farm = per_farm
+        self.results_path = results_path
+        self.dump = dump
+
+        done = load_done(results_path)
+        self.pending = [job for job in jobs if job.wiki not in done]
+        if len(self.pending) < len(jobs):
+            print(f"Skipping {len(jobs) - len(self.pending)} wikis already done in {results_path}")
+        self.running: Dict[str, int] = {}
+        self._cond = threading.Condition()
+        self._results_lock = threading.Lock()
+
+        session_args = getArgumentParser().parse_args(["https://wiki.invalid/"] + common_args)
+        self.sessions = SessionPool(lambda: build_session(session_args))
+
+    def _next_job(self) -> Optional[BatchJob]:
+        """The next job whose farm has a free slot, None when the queue is empty"""
+        with self._cond:
+            while self.pending:
+                for i, job in enumerate(self.pending):
+                    if self.running.get(job.farm, 0) < self.per_farm:
+                        self.running[job.farm] = self.running.get(job.farm, 0) + 1
+                        return self.pending.pop(i)
+                self._cond.wait()
+            return None
+
+    def _job_done(self, job: BatchJob):
+        with self._cond:
+            self.running[job.farm] -= 1
+            self._cond.notify_all()
+
+    def _write_result(self, result: Dict):
+        with self._results_lock:
+            with open(self.results_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+    def run_job(self, job: BatchJob) -> Dict:
+        params = [job.wiki] + self.common_args + job.args
+        started = time.time()
+        status, exit_code, error, path = "done", 0, None, None
+        session = self.sessions.acquire(job.farm)
+        try:
+            with labeled(job.host):
+                dump_result = self.dump(params, session)
+            path = dump_result and dump_result.path
+        except WikiEngineFound as e:
+            print(f"[batch] {job.wiki}: {e.engine}")
+        except DumpError as e:
+            status, exit_code, error = "failed", e.exit_code, str(e) or type(e).__name__
+        except SystemExit as e: # argparse
+            exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            if exit_code:
+                status, error = "failed", f"exit code {exit_code}"
+        except Exception as e:
+            traceback.print_exc()
+            status, exit_code, error = "failed", 1, repr(e)
+        finally:
+            self.sessions.release(job.farm, session)
+
+        result = {
+            "wiki": job.wiki,
+            "farm": job.farm,
+            "status": status,
+            "exit_code": exit_code,
+            "error": error,
+            "path": path,
+            "started": datetime.datetime.fromtimestamp(started, datetime.timezone.utc).isoformat(),
+            "elapsed": round(time.time() - started, 3),
+        }
+        self._write_result(result)
+        print(f"[batch] {job.wiki}: {status}" + (f" ({error})" if error else ""))
+        return result
+
+    def _worker(self):
+        while (job := self._next_job()) is not None:
+            try:
+                self.run_job(job)
+            finally:
+                self._job_done(job)
+
+    def run(self):
+        threads = [
+            threading.Thread(target=self._worker, name=f"batch-{i}", daemon=True)
+            for i in range(min(self.workers, len(self.pending)))
+        ]
+        with labeled_output():
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1) # interruptible by Ctrl-C
+
+
+def main(params=None):
+    parser = argparse.ArgumentParser(
+        description="Dump many wikis in one process. "
+        "Arguments after the options are passed to every wikiteam3dumpgenerator run (e.g. --xml --images).",
+        allow_abbrev=False,
+    )
+    parser.add_argument("queue", help="file with one wiki per line: URL [extra dumpgenerator args]")
+    parser.add_argument("--workers", type=int, default=4, help="dumps running at the same time (default: 4)")
+    parser.add_argument("--per-farm", type=int, default=1, dest="per_farm",
+                        help="dumps running at the same time on the same wiki farm, e.g. fandom.com (default: 1)")
+    parser.add_argument("--results", default=DEFAULT_RESULTS,
+                        help=f"JSON Lines file of the per-wiki results, done wikis are skipped on restart (default: {DEFAULT_RESULTS})")
+    args, common_args = parser.parse_known_args(params)
+
+    runner = BatchRunner(read_queue(args.queue), common_args,
+                         workers=args.workers, per_farm=args.per_farm, results_path=args.results)
+    runner.run()
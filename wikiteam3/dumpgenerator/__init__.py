@@ -1,4 +1,5 @@
-from wikiteam3.dumpgenerator.dump import DumpGenerator
+from wikiteam3.dumpgenerator.dump import DumpGenerator, DumpResult, run_dump
+from wikiteam3.dumpgenerator.exceptions import DumpError
 
 def main():
     DumpGenerator()
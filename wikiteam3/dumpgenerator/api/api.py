@@ -2,10 +2,10 @@ import re
 from typing import Optional
 from urllib.parse import urlparse, urljoin
 
-import mwclient
 import requests
 
 from wikiteam3.dumpgenerator.api.get_json import get_JSON
+from wikiteam3.dumpgenerator.api.metadata_cache import get_site
 from wikiteam3.utils import get_random_UserAgent
 
 
@@ -134,9 +134,7 @@ def check_retry_API(api: str, apiclient=False, *, session: requests.Session):
     if check and apiclient:
         apiurl = urlparse(api)
         try:
-            mwclient.Site(
-                apiurl.netloc, apiurl.path.replace("api.php", ""), scheme=apiurl.scheme, pool=session
-            )
+            get_site(api, session)
         except KeyError:
             # Probably KeyError: 'query'
             if apiurl.scheme == "https":
@@ -152,9 +150,7 @@ def check_retry_API(api: str, apiclient=False, *, session: requests.Session):
             )
 
             try:
-                mwclient.Site(
-                    apiurl.netloc, apiurl.path.replace("api.php", ""), scheme=newscheme, pool=session
-                )
+                get_site(apiurl.geturl(), session, scheme=newscheme)
             except KeyError:
                 check = False
 
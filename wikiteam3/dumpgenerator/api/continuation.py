@@ -0,0 +1,122 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Generator, Iterable, Optional, Tuple
+
+Params = Dict[str, Any]
+
+
+def next_continue_params(response: Dict) -> Optional[Dict[str, str]]:
+    """Continuation parameters of the batch after `response`, None after the last batch
+
+    Both forms are flattened to {param: value}, e.g. {"apcontinue": "Foo", "continue": "-||"}:
+    - `continue` (MediaWiki 1.21+)
+    - `query-continue` (older), {module: {param: value}}
+    """
+    if response.get("continue"):
+        return dict(response["continue"])
+    if response.get("query-continue"):
+        params: Dict[str, str] = {}
+        for module_params in response["query-continue"].values():
+            params.update(module_params)
+        return params
+    return None
+
+
+class Prefetcher:
+    """
+    Fetch one request ahead in a background thread.
+
+    `submit(params)` starts `fetch(params)`, a later `get(params)` with the same params
+    (ignoring the `ignore` keys, e.g. a batch size that changed in the meantime) returns its
+    result instead of fetching again. Exceptions are raised by `get()`, as if fetched there.
+    `fetched` holds the exact params the result of the last `get()` was fetched with.
+    Prefetched results that are never returned are passed to `discard` (e.g. to close a streamed response).
+    """
+
+    def __init__(self, fetch: Callable[[Params], Any], ignore: Iterable[str] = (),
+                 discard: Optional[Callable[[Any], None]] = None):
+        self.fetch = fetch
+        self.ignore = frozenset(ignore)
+        self.discard = discard
+        self.fetched: Optional[Params] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Optional[Tuple[Tuple, Params, Future]] = None
+
+    def _key(self, params: Params) -> Tuple:
+        return tuple(sorted((k, str(v)) for k, v in params.items() if k not in self.ignore))
+
+    def _drop_pending(self):
+        if self._pending is None:
+            return
+        future = self._pending[2]
+        self._pending = None
+        if self.discard is not None and not future.cancel():
+            discard = self.discard
+
+            def discard_result(f: Future):
+                if f.exception() is None:
+                    discard(f.result())
+            future.add_done_callback(discard_result)
+
+    def submit(self, params: Params):
+        """Starts fetching `params`, unless they are already being fetched"""
+        if self._pending is not None and self._pending[0] == self._key(params):
+            return
+        self._drop_pending()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        params = dict(params)
+        self._pending = (self._key(params), params, self._executor.submit(self.fetch, params))
+
+    def get(self, params: Params) -> Any:
+        if self._pending is not None and self._pending[0] == self._key(params):
+            _, self.fetched, future = self._pending
+            self._pending = None
+            return future.result()
+        self.fetched = dict(params)
+        return self.fetch(params)
+
+    def close(self):
+        self._drop_pending()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class ContinuedQuery:
+    """
+    Iterate the batches (responses) of a continued API query, fetching batch N+1 in the
+    background while batch N is consumed.
+
+    `fetch(params)` sends the query and returns the parsed response, it is called with
+    `params` + the continuation parameters of each batch.
+
+    While a batch is consumed:
+    - `continue_params`: continuation parameters of this batch (None for the first batch)
+    - `next_continue_params`: continuation parameters of the next batch, None if it is the last one
+
+    Save one of them to resume the enumeration later (pass it as `continue_params`).
+    """
+
+    def __init__(self, fetch: Callable[[Params], Dict], params: Params,
+                 continue_params: Optional[Dict[str, str]] = None, prefetch: bool = True):
+        self.fetch = fetch
+        self.params = params
+        self.continue_params = continue_params
+        self.next_continue_params: Optional[Dict[str, str]] = None
+        self.prefetch = prefetch
+
+    def __iter__(self) -> Generator[Dict, None, None]:
+        prefetcher = Prefetcher(self.fetch)
+        try:
+            while True:
+                params = {**self.params, **(self.continue_params or {})}
+                response = prefetcher.get(params)
+                self.next_continue_params = next_continue_params(response)
+                if self.next_continue_params is not None and self.prefetch:
+                    prefetcher.submit({**self.params, **self.next_continue_params})
+                yield response
+                if self.next_continue_params is None:
+                    return
+                self.continue_params = self.next_continue_params
+        finally:
+            prefetcher.close()
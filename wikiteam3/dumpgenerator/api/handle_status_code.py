@@ -1,7 +1,7 @@
-import sys
-
 import requests
 
+from wikiteam3.dumpgenerator.exceptions import DumpError
+
 
 def handle_StatusCode(response: requests.Response):
     status_code = response.status_code
@@ -17,7 +17,7 @@ def handle_StatusCode(response: requests.Response):
         print("Bad Request: The wiki may be malfunctioning.")
         print("Please try again later.")
         print(response.url)
-        sys.exit(1)
+        raise DumpError(f"HTTP {status_code} Bad Request: {response.url}")
 
     elif status_code == 401 or status_code == 403:
         print("Authentication required.")
@@ -27,10 +27,10 @@ def handle_StatusCode(response: requests.Response):
     elif status_code == 404:
         print("Not found. Is Special:Export enabled for this wiki?")
         print(response.url)
-        sys.exit(1)
+        raise DumpError(f"HTTP {status_code} Not Found: {response.url}")
 
     elif status_code == 429 or (status_code >= 500 and status_code < 600):
         print("Server error, max retries exceeded.")
         print("Please resume the dump later.")
         print(response.url)
-        sys.exit(1)
+        raise DumpError(f"HTTP {status_code} Server error: {response.url}")
@@ -1,71 +1,76 @@
+import os
 import re
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, Generator, List, Optional, Tuple
 
 import requests
 
-class print_probability:
-    """ Decorator for printing the return value of a function """
+from wikiteam3.utils.rate_limiter import BACKPRESSURE, is_rate_limited, limit_request
+
+PROBE_PAGES = [
+    "Special:Random",
+    "Special:Version",
+    "Special:AllPages",
+    "Special:ListFiles",
+    "Special:Search",
+]
+""" pages requested to check an index.php, the first one (in this order) that answers 2xx decides """
+PROBE_WORKERS = int(os.getenv("WIKITEAM3_PROBE_WORKERS", "5"))
+""" max concurrent probe requests """
+PROBE_TIMEOUT = 30.0
+STARTUP_DEADLINE = float(os.getenv("WIKITEAM3_STARTUP_DEADLINE", "300"))
+""" seconds the index.php probes of the startup may take in total """
+
+
+def _probe(index: str, page: str, session: requests.Session, deadline: Optional[float],
+           delay: float, decided: threading.Event) -> Optional[requests.Response]:
+    if not is_rate_limited(session): # startup, before install_rate_limiter()
+        limit_request(index, delay)
+    if decided.is_set():
+        return None
+    timeout = PROBE_TIMEOUT
+    if deadline is not None:
+        timeout = max(1.0, min(timeout, deadline - time.monotonic()))
+    try:
+        try:
+            r = session.post(url=index, data={"title": page}, timeout=timeout, allow_redirects=True)
+        except requests.exceptions.TooManyRedirects:
+            r = session.post(url=index, params={"title": page}, timeout=timeout, allow_redirects=False)
+    except Exception as e:
+        print(f"check_index(): {page}: Exception:", e)
+        return None
+
+    if not is_rate_limited(session):
+        BACKPRESSURE.on_response(r)
+    for _r in r.history:
+        print(_r.request.method, _r.url, {"title": page}, _r.status_code)
+    print(r.request.method, r.url, {"title": page}, r.status_code)
+    if r.status_code in [301, 302, 303, 307, 308]:
+        print(f"check_index(): {page}: The index.php returned a redirect")
+    elif r.status_code >= 400:
+        print(f"check_index(): {page}: ERROR: The wiki returned status code HTTP {r.status_code}")
+    return r
+
 
-    def __init__(self, func):
-        self.func = func
+def _is_conclusive(r: Optional[requests.Response]) -> bool:
+    return r is not None and r.status_code < 300
 
-    def __call__(self, *args, **kwargs):
-        ret = self.func(*args, **kwargs)
-        print(f"index.php available probability: {ret*100:.0f}% ({ret})")
-        return ret
 
-@print_probability
-def check_index(*, index: str, logged_in: bool, session: requests.Session) -> float:
-    """ Checking index.php availability
-    
+def _probability(r: Optional[requests.Response], logged_in: bool) -> float:
+    """
     returns:
         the probability of index.php being available.
         * [0.0 - 0.5) - not available
         * 0.5 - generally not sure
         * (0.5 - 1] - available
     """
-
-    print("Checking index.php...", index)
-
-    r = None
-
-    for page in [
-                 "Special:Random",
-                 "Special:Version",
-                 "Special:AllPages",
-                 "Special:ListFiles",
-                 "Special:Search",
-                 ]:
-        print(f"check_index(): Trying {page}...")
-
-        try:
-            try:
-                r = session.post(url=index, data={"title": page}, timeout=30, allow_redirects=True)
-            except requests.exceptions.TooManyRedirects:
-                r = session.post(url=index, params={"title": page}, timeout=30, allow_redirects=False)
-        except Exception as e:
-            print("check_index(): Exception:", e)
-            time.sleep(2)
-            continue
-
-        for _r in r.history:
-            print(_r.request.method, _r.url, {"title": page}, _r.status_code)
-        print(r.request.method, r.url, {"title": page}, r.status_code)
-
-        if r.status_code in [301, 302, 303, 307, 308]:
-            print("The index.php returned a redirect")
-            continue
-
-        if r.status_code >= 400:
-            print(f"ERROR: The wiki returned status code HTTP {r.status_code}")
-            continue
-
-        break
-
     if r is None:
         print("ERROR: Failed to get index.php")
         return 0.15
-    
+
     if r.status_code in [301, 302, 303, 307, 308]:
         print("The index.php returned a redirect")
         return 0.3
@@ -96,3 +101,71 @@ def check_index(*, index: str, logged_in: bool, session: requests.Session) -> fl
         return 0.9
 
     return 0.2
+
+
+def _decide(futures: Dict[str, Future], deadline: Optional[float]) -> Tuple[Optional[requests.Response], bool]:
+    """The answer deciding a candidate: the first 2xx one in `PROBE_PAGES` order,
+    else the last answer. returns: (answer, whether the deadline was exceeded)"""
+    decided = None
+    for future in futures.values():
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            return decided, True
+        try:
+            r = future.result(timeout=remaining)
+        except FutureTimeoutError:
+            return decided, True
+        if r is not None:
+            decided = r
+        if _is_conclusive(r):
+            break
+    return decided, False
+
+
+def probe_indexes(indexes: List[str], *, logged_in: bool, session: requests.Session,
+                  deadline: Optional[float] = None, delay: float = 0.0) -> Generator[Tuple[str, float], None, None]:
+    """ Check the candidate index.php URLs, one after another
+
+    The `PROBE_PAGES` of a candidate are requested concurrently (at most `PROBE_WORKERS` in flight,
+    rate limited to `delay` per host if the session isn't yet, see `install_rate_limiter()`).
+    The first of them (in `PROBE_PAGES` order) that answers 2xx decides, the later ones are then
+    cancelled. If none does, the last answer decides.
+
+    yields: (index, probability of index.php being available, see `_probability()`),
+        in the order of `indexes`. The next candidate is only probed when iterating on,
+        stop iterating once one is good enough.
+        Candidates not decided before `deadline` (`time.monotonic()`) get 0.0.
+    """
+    executor = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="probe")
+    futures: Dict[str, Future] = {}
+    try:
+        for index in indexes:
+            print("Checking index.php...", index)
+            decided = threading.Event()
+            futures = {
+                page: executor.submit(_probe, index, page, session, deadline, delay, decided)
+                for page in PROBE_PAGES
+            }
+            r, timed_out = _decide(futures, deadline)
+            decided.set() # the probes waiting for the rate limiter are not sent
+            for future in futures.values():
+                future.cancel()
+            if r is None and timed_out:
+                print("ERROR: index.php check deadline exceeded (WIKITEAM3_STARTUP_DEADLINE)")
+                probability = 0.0
+            else:
+                probability = _probability(r, logged_in)
+            print(f"index.php available probability: {probability*100:.0f}% ({probability})")
+            yield index, probability
+    finally:
+        for future in futures.values():
+            future.cancel() # shutdown(cancel_futures=True) is Python 3.9+
+        executor.shutdown(wait=False)
+
+
+def check_index(*, index: str, logged_in: bool, session: requests.Session, deadline: Optional[float] = None,
+                delay: float = 0.0) -> float:
+    """ Checking index.php availability, see `probe_indexes()` """
+    for _, probability in probe_indexes([index], logged_in=logged_in, session=session, deadline=deadline, delay=delay):
+        return probability
+    raise AssertionError("unreachable")
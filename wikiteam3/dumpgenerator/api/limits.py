@@ -0,0 +1,45 @@
+from typing import List
+
+import requests
+
+from wikiteam3.dumpgenerator.api.get_json import get_JSON
+from wikiteam3.dumpgenerator.config import Config
+
+API_LIMIT_BIG = (500, 5000)
+""" max limit of list modules (allpages, allimages, allredirects, allrevisions without content...),
+    without / with the `apihighlimits` right (ApiBase::LIMIT_BIG1 / LIMIT_BIG2) """
+API_LIMIT_SML = (50, 500)
+""" max limit of content-bearing queries (prop=revisions or list=allrevisions with rvprop=content),
+    without / with the `apihighlimits` right (ApiBase::LIMIT_SML1 / LIMIT_SML2) """
+
+
+def get_user_rights(api: str, session: requests.Session) -> List[str]:
+    """ Rights of the current (logged in or anonymous) user, [] if the API can't tell """
+    try:
+        r = session.get(
+            url=api,
+            params={"action": "query", "meta": "userinfo", "uiprop": "rights", "format": "json"},
+            timeout=30,
+        )
+        rights = get_JSON(r).get("query", {}).get("userinfo", {}).get("rights", [])
+    except (requests.exceptions.RequestException, AttributeError) as e:
+        print("Unable to get the user rights:", e)
+        return []
+    return rights if isinstance(rights, list) else []
+
+
+def has_apihighlimits(api: str, session: requests.Session) -> bool:
+    """ Whether the current user may use the higher API limits (bots, sysops) """
+    return "apihighlimits" in get_user_rights(api=api, session=session)
+
+
+def api_limit(config: Config, content: bool = False) -> int:
+    """ Batch size for an API query
+
+    `--api_chunksize` if set, else the max limit allowed to the current user:
+    `API_LIMIT_SML` for content-bearing queries (`content=True`), `API_LIMIT_BIG` for lists.
+    """
+    if config.api_chunksize:
+        return config.api_chunksize
+    low, high = API_LIMIT_SML if content else API_LIMIT_BIG
+    return high if config.api_highlimits else low
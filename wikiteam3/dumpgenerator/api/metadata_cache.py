@@ -0,0 +1,153 @@
+import os
+import threading
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import mwclient
+import requests
+
+from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils.checkpoint import Checkpoint
+
+METADATA_CACHE_FILENAME = "metadata_cache.json"
+
+
+def _api_id(api: str) -> str:
+    """`api` without its scheme (`get_site()` may override it)"""
+    return api.split("://", 1)[-1]
+
+
+class MetadataCache:
+    """
+    API metadata (siteinfo, namespaces, mwclient site info...) fetched once per API URL
+    and reused for the whole dump (see `forget()`).
+
+    Entries are also saved to `{dump dir}/metadata_cache.json` as soon as the dump dir exists,
+    so a resumed dump doesn't fetch them again. Thread-safe, a value is fetched by one thread at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._memory: Dict[str, Any] = {}
+        self._stores: Dict[str, Checkpoint] = {}
+        self._copied: Set[Tuple[str, str]] = set()
+        """ (api, path): entries of api fetched before the dump dir existed saved to it """
+        self._fetch_locks: Dict[str, threading.Lock] = {}
+
+    def _store(self, api: str, path: str) -> Optional[Checkpoint]:
+        if not path or not os.path.isdir(path):
+            return None
+        if path not in self._stores:
+            self._stores[path] = Checkpoint(os.path.join(path, METADATA_CACHE_FILENAME))
+        store = self._stores[path]
+        if (api, path) not in self._copied:
+            # save what we fetched for this API before the dump dir was created
+            for key, value in self._memory.items():
+                if key.startswith(f"{api}|") and store.get(key) is None:
+                    store.update(key, value)
+            self._copied.add((api, path))
+        return store
+
+    def peek(self, api: str, name: str, path: str = "") -> Any:
+        """The cached `name` of `api`, None if not cached"""
+        key = f"{api}|{name}"
+        with self._lock:
+            store = self._store(api, path)
+            if key in self._memory:
+                return self._memory[key]
+            if store is not None and (value := store.get(key)) is not None:
+                self._memory[key] = value
+                return value
+        return None
+
+    def get(self, api: str, name: str, fetch: Callable[[], Any], path: str = "",
+            valid: Callable[[Any], bool] = lambda value: value is not None) -> Any:
+        """The cached `name` of `api`, or `fetch()` it (only `valid` values are cached)"""
+        key = f"{api}|{name}"
+        value = self.peek(api, name, path)
+        if value is not None:
+            return value
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        with fetch_lock: # other threads wait for this fetch instead of sending the same request
+            value = self.peek(api, name, path)
+            if value is not None:
+                return value
+            value = fetch()
+            if valid(value):
+                with self._lock:
+                    self._memory[key] = value
+                    if (store := self._store(api, path)) is not None:
+                        store.update(key, value)
+            return value
+
+    def forget(self, api: str):
+        """Drop the in-memory entries of `api` (any scheme), e.g. once its dump is done"""
+        prefix = f"{_api_id(api)}|"
+        with self._lock:
+            for key in [key for key in self._memory if _api_id(key).startswith(prefix)]:
+                del self._memory[key]
+            for key in [key for key in self._fetch_locks if _api_id(key).startswith(prefix)]:
+                del self._fetch_locks[key]
+            self._copied = {(a, path) for a, path in self._copied if _api_id(a) != _api_id(api)}
+            # the stores of dump dirs nobody uses anymore
+            used = {path for _, path in self._copied}
+            self._stores = {path: store for path, store in self._stores.items() if path in used}
+
+
+METADATA_CACHE = MetadataCache()
+""" process-wide metadata cache """
+
+
+def cached_metadata(config: Config, name: str, fetch: Callable[[], Any],
+                    valid: Callable[[Any], bool] = lambda value: value is not None) -> Any:
+    """`METADATA_CACHE.get()` for the API and dump dir of `config`"""
+    return METADATA_CACHE.get(config.api, name, fetch, path=config.path, valid=valid)
+
+
+def _init_site(site: mwclient.Site, meta: Dict, userinfo: Dict):
+    """Same as `mwclient.Site.site_init()`, from already fetched responses"""
+    site.site = meta["query"]["general"]
+    site.namespaces = {
+        namespace["id"]: namespace.get("*", "")
+        for namespace in meta["query"]["namespaces"].values()
+    }
+    site.version = site.version_tuple_from_generator(site.site["generator"])
+    site.require(1, 16)
+    site.username = userinfo["name"]
+    site.groups = userinfo.get("groups", [])
+    site.rights = userinfo.get("rights", [])
+    site.initialized = True
+
+
+def get_site(api: str, session: requests.Session, path: str = "", scheme: Optional[str] = None) -> mwclient.Site:
+    """`mwclient.Site` of `api`, initialized with the cached site info instead of a new request
+
+    The user info (rights, groups) is not cached, it changes with the login.
+
+    path: the dump dir, if any
+    scheme: override the scheme of `api`
+    """
+    apiurl = urlparse(api)
+    scheme = scheme or apiurl.scheme
+    site = mwclient.Site(
+        apiurl.netloc, apiurl.path.replace("api.php", ""), scheme=scheme, pool=session, do_init=False
+    )
+    fetched: Dict[str, Dict] = {}
+
+    def fetch() -> Dict:
+        meta = site.get("query", meta="siteinfo|userinfo", siprop="general|namespaces",
+                        uiprop="groups|rights", retry_on_error=False)
+        if "query" in meta:
+            fetched["userinfo"] = meta["query"].pop("userinfo")
+        return meta
+
+    meta = METADATA_CACHE.get(
+        apiurl._replace(scheme=scheme).geturl(), "site_init", fetch,
+        path=path, valid=lambda meta: "query" in meta,
+    )
+    userinfo = fetched.get("userinfo")
+    if userinfo is None:
+        userinfo = site.get("query", meta="userinfo", uiprop="groups|rights", retry_on_error=False)["query"]["userinfo"]
+    _init_site(site, meta, userinfo)
+    return site
@@ -2,8 +2,8 @@ import re
 
 import requests
 
-from wikiteam3.dumpgenerator.cli import Delay
 from wikiteam3.dumpgenerator.api import get_JSON
+from wikiteam3.dumpgenerator.api.metadata_cache import METADATA_CACHE, cached_metadata
 from wikiteam3.dumpgenerator.config import Config
 from wikiteam3.utils.util import ALL_NAMESPACE_FLAG
 
@@ -17,7 +17,6 @@ def getNamespacesScraper(config: Config, session: requests.Session):
             url=config.index, params={"title": "Special:Allpages"}, timeout=30
         )
         raw = r.text
-        Delay(config=config)
 
         # [^>]*? to include selected="selected"
         m = re.compile(
@@ -46,31 +45,39 @@ def getNamespacesScraper(config: Config, session: requests.Session):
     return namespaces, namespacenames
 
 
+def _fetch_namespaces(config: Config, session: requests.Session):
+    """`query.namespaces` of the siteinfo, reusing an already cached siteinfo if any"""
+    for name in ("siteinfo", "site_init"):
+        cached = METADATA_CACHE.peek(config.api, name, config.path)
+        if cached and "namespaces" in cached.get("query", {}):
+            return cached["query"]["namespaces"]
+
+    r = session.get(
+        url=config.api,
+        params={
+            "action": "query",
+            "meta": "siteinfo",
+            "siprop": "namespaces",
+            "format": "json",
+        },
+        timeout=30,
+    )
+    result = get_JSON(r)
+    try:
+        return result["query"]["namespaces"]
+    except KeyError:
+        print("Error: could not get namespaces from the API request.")
+        print("HTTP %d" % r.status_code)
+        print(r.text)
+        raise
+
+
 def getNamespacesAPI(config: Config, session: requests.Session):
     """Uses the API to get the list of namespaces names and ids"""
     namespaces = config.namespaces
     namespace_names = {0: ""}  # main is 0, no prefix
     if namespaces:
-        r = session.get(
-            url=config.api,
-            params={
-                "action": "query",
-                "meta": "siteinfo",
-                "siprop": "namespaces",
-                "format": "json",
-            },
-            timeout=30,
-        )
-        result = get_JSON(r)
-        Delay(config=config)
-        try:
-            nsquery = result["query"]["namespaces"]
-        except KeyError:
-            print("Error: could not get namespaces from the API request.")
-            print("HTTP %d" % r.status_code)
-            print(r.text)
-            raise
-
+        nsquery = cached_metadata(config, "namespaces", lambda: _fetch_namespaces(config, session))
         if ALL_NAMESPACE_FLAG in namespaces:
             namespaces = []
             for i in nsquery.keys():
@@ -1,66 +1,197 @@
+import os
 import re
 import traceback
-from typing import Generator, Optional
-from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, List, Optional, Set, Tuple
 
 import mwclient
-import mwclient.page
 import requests
 from file_read_backwards import FileReadBackwards
 
+from wikiteam3.dumpgenerator.api.continuation import ContinuedQuery
+from wikiteam3.dumpgenerator.api.limits import api_limit
+from wikiteam3.dumpgenerator.api.metadata_cache import get_site
 from wikiteam3.dumpgenerator.api.namespaces import (
     getNamespacesAPI,
     getNamespacesScraper,
 )
-from wikiteam3.dumpgenerator.cli import Delay
+from wikiteam3.dumpgenerator.api.titles_index import TitlesIndex
 from wikiteam3.dumpgenerator.config import Config
 from wikiteam3.utils import clean_HTML, undo_HTML_entities, url2prefix_from_config
+from wikiteam3.utils.checkpoint import Checkpoint
 from wikiteam3.utils.monkey_patch import SessionMonkeyPatch
 
 
+TITLES_WORKERS = int(os.getenv("WIKITEAM3_TITLES_WORKERS", "4"))
+""" max namespaces enumerated at the same time by `getPageTitlesAPI()` """
+
+
+def _allpages_batches(site: mwclient.Site, namespace: int, continue_args: Optional[Dict[str, str]] = None
+                      ) -> Generator[Tuple[List[str], Optional[Dict[str, str]]], None, None]:
+    """Yield (titles, continue_args) for each `list=allpages` batch of `namespace`
+
+    continue_args: the continuation parameters to resume from, `None` for the beginning.
+    The yielded continue_args is the continuation of the next batch, `None` after the last one.
+    The next batch is fetched while the current one is written.
+    """
+    query = ContinuedQuery(
+        lambda params: site.get("query", **params),
+        {"list": "allpages", "apnamespace": namespace, "aplimit": site.api_limit},
+        continue_params=continue_args,
+    )
+    for data in query:
+        titles = [page["title"] for page in data.get("query", {}).get("allpages", [])]
+        yield titles, query.next_continue_params
+
+
+def _spill_namespace_titles(site: mwclient.Site, namespace: int, spill_path: str, checkpoint: Checkpoint) -> int:
+    """Append the titles of `namespace` to `spill_path`, returns the number of titles added
+
+    After every batch, the spill file size and the `apcontinue` of the next batch are saved
+    to `checkpoint`, so an interrupted enumeration continues from the last saved batch.
+    """
+    state = checkpoint.get(str(namespace)) or {}
+    if state and not os.path.exists(spill_path):
+        state = {} # spill file lost, start over
+    if state.get("done"):
+        print("    Titles in the namespace %d already retrieved (checkpoint)" % (namespace))
+        return 0
+    if state:
+        print("    Resuming titles in the namespace %d from %s" % (namespace, state["continue"]))
+
+    c = 0
+    with open(spill_path, "ab") as spill:
+        # drop titles written after the last checkpoint
+        spill.truncate(state.get("offset", 0))
+        for titles, continue_args in _allpages_batches(site, namespace, state.get("continue")):
+            for title in titles:
+                spill.write((title + "\n").encode("utf-8"))
+            spill.flush()
+            c += len(titles)
+            checkpoint.update(str(namespace), {
+                "continue": continue_args,
+                "done": continue_args is None,
+                "offset": spill.tell(),
+            })
+    print("    %d titles retrieved in the namespace %d" % (c, namespace))
+    return c
+
+
 def getPageTitlesAPI(config: Config, session: requests.Session):
-    """Uses the API to get the list of page titles"""
-    titles = []
-    namespaces, namespacenames = getNamespacesAPI(config=config, session=session)
+    """Uses the API to get the list of page titles
 
-    # apply delay to the session for mwclient.Site.allpages()
-    delay_session = SessionMonkeyPatch(
-            session=session, config=config,
-            add_delay=True, delay_msg="Session delay: "+__name__,
-            hard_retries=3 # TODO: --hard-retries
-        )
-    delay_session.hijack()
+    Namespaces are enumerated concurrently ($WIKITEAM3_TITLES_WORKERS) with a shared
+    `mwclient.Site`, each one into its own spill file, then yielded in namespace order.
+    The delay is shared by all workers (see `RateLimiter`), so we are not less polite.
+    Progress is checkpointed (see `_spill_namespace_titles()`), spill files and
+    checkpoint are removed once all titles are yielded.
+
+    NOTE: duplicated titles (e.g. loops) are removed by `TitlesIndex.build()` afterwards
+    """
+    namespaces, namespacenames = getNamespacesAPI(config=config, session=session)
     for namespace in namespaces:
         if namespace in config.exnamespaces:
             print("    Skipping namespace = %d" % (namespace))
-            continue
+    namespaces = sorted(ns for ns in namespaces if ns not in config.exnamespaces)
 
-        c = 0
-        print("    Retrieving titles in the namespace %d" % (namespace))
-        apiurl = urlparse(config.api)
-        site = mwclient.Site(
-            host=apiurl.netloc,
-            path=apiurl.path.replace("api.php", ""),
-            scheme=apiurl.scheme,
-            pool=session
+    # hard retries for mwclient.Site.get()
+    patch_sess = SessionMonkeyPatch(
+            session=session, config=config,
+            hard_retries=3 # TODO: --hard-retries
         )
-        for page in site.allpages(namespace=namespace):
-            assert isinstance(page, mwclient.page.Page)
-            title = page.name
-            titles.append(title)
-            c += 1
-            yield title
+    patch_sess.hijack()
+    titles_path = "{}/{}".format(config.path, get_titles_filename(config))
+    spill_paths = {
+        namespace: "{}.ns{}.tmp".format(titles_path, namespace)
+        for namespace in namespaces
+    }
+    checkpoint = Checkpoint(titles_path + ".checkpoint.json")
+    try:
+        site = get_site(config.api, session, path=config.path)
+        site.api_limit = api_limit(config)
+        with ThreadPoolExecutor(max_workers=max(1, min(TITLES_WORKERS, len(namespaces)))) as executor:
+            futures = []
+            for namespace in namespaces:
+                print("    Retrieving titles in the namespace %d" % (namespace))
+                futures.append(executor.submit(
+                    _spill_namespace_titles, site, namespace, spill_paths[namespace], checkpoint
+                ))
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        patch_sess.release()
+
+    for namespace in namespaces:
+        with open(spill_paths[namespace], encoding="utf-8") as spill:
+            for line in spill:
+                yield line.rstrip("\n")
+
+    for spill_path in spill_paths.values():
+        os.remove(spill_path)
+    checkpoint.remove()
+
+
+R_TITLE = re.compile(r'title="(?P<title>[^>]+)">')
+R_SUBALLPAGES1 = re.compile(r'&amp;from=(?P<from>[^>"]+)&amp;to=(?P<to>[^>"]+)">')
+R_SUBALLPAGES2 = re.compile(r'Special:Allpages/(?P<from>[^>"]+)">')
+R_SUBALLPAGES3 = re.compile(r'&amp;from=(?P<from>[^>"]+)" title="[^>]+">')
+
+
+def _suballpages_links(config: Config, namespace: int, r_suballpages: re.Pattern, raw: str
+                       ) -> Generator[Tuple[str, str], None, None]:
+    """Yield (name, url) of the sub-Allpages linked from `raw`"""
+    for i in r_suballpages.finditer(raw):
+        fr = i.group("from")
+        if r_suballpages is R_SUBALLPAGES1:
+            to = i.group("to")
+            name = f"{fr}-{to}"
+            url = "{}?title=Special:Allpages&namespace={}&from={}&to={}".format(
+                config.index,
+                namespace,
+                fr,
+                to,
+            )  # do not put urllib.parse.quote in fr or to
+        # fix, this regexp doesn't properly save everything? or does r_title fail on this
+        # type of subpage? (wikiindex)
+        elif r_suballpages is R_SUBALLPAGES2:
+            # clean &amp;namespace=\d, sometimes happens
+            fr = fr.split("&amp;namespace=")[0]
+            name = fr
+            url = "{}?title=Special:Allpages/{}&namespace={}".format(
+                config.index,
+                name,
+                namespace,
+            )
+        elif r_suballpages is R_SUBALLPAGES3:
+            fr = fr.split("&amp;namespace=")[0]
+            name = fr
+            url = "{}?title=Special:Allpages&from={}&namespace={}".format(
+                config.index,
+                name,
+                namespace,
+            )
+        else:
+            assert False, "Unreachable"
+        yield name, url
 
-        if len(titles) != len(set(titles)):
-            print("Probably a loop, switching to next namespace")
-            titles = list(set(titles))
 
-    delay_session.release()
+def _fetch_allpages(config: Config, session: requests.Session, url: str) -> str:
+    r = session.get(url=url, timeout=10)
+    return clean_HTML(str(r.text))
 
 
 def getPageTitlesScraper(config: Config, session: requests.Session):
-    """Scrape the list of page titles from Special:Allpages"""
-    titles = []
+    """Scrape the list of page titles from Special:Allpages
+
+    Titles are yielded as soon as a (sub-)Allpages is parsed, fetched HTML is not kept.
+    Each level of sub-Allpages is fetched concurrently ($WIKITEAM3_TITLES_WORKERS),
+    the delay is shared by all workers (see `RateLimiter`).
+    """
     namespaces, namespacenames = getNamespacesScraper(config=config, session=session)
     for namespace in namespaces:
         print("    Retrieving titles in the namespace", namespace)
@@ -71,105 +202,60 @@ def getPageTitlesScraper(config: Config, session: requests.Session):
         raw = r.text
         raw = clean_HTML(raw)
 
-        r_title = r'title="(?P<title>[^>]+)">'
-        r_suballpages = ""
-        r_suballpages1 = r'&amp;from=(?P<from>[^>"]+)&amp;to=(?P<to>[^>"]+)">'
-        r_suballpages2 = r'Special:Allpages/(?P<from>[^>"]+)">'
-        r_suballpages3 = r'&amp;from=(?P<from>[^>"]+)" title="[^>]+">'
-        if re.search(r_suballpages1, raw):
-            r_suballpages = r_suballpages1
-        elif re.search(r_suballpages2, raw):
-            r_suballpages = r_suballpages2
-        elif re.search(r_suballpages3, raw):
-            r_suballpages = r_suballpages3
-        else:
-            pass  # perhaps no subpages
+        r_suballpages: Optional[re.Pattern] = None
+        for r_candidate in (R_SUBALLPAGES1, R_SUBALLPAGES2, R_SUBALLPAGES3):
+            if r_candidate.search(raw):
+                r_suballpages = r_candidate
+                break
+        # else: perhaps no subpages
+
+        titles: Set[str] = set()
+        def new_titles(raw: str) -> Generator[str, None, None]:
+            for i in R_TITLE.finditer(raw):
+                t = undo_HTML_entities(text=i.group("title"))
+                if not t.startswith("Special:") and t not in titles:
+                    titles.add(t)
+                    yield t
+
+        yield from new_titles(raw)
+
+        checked_suballpages: Set[str] = set()
+        def unchecked_links(raw: str) -> List[Tuple[str, str]]:
+            assert r_suballpages is not None
+            links = []
+            for name, url in _suballpages_links(config, namespace, r_suballpages, raw):
+                if name not in checked_suballpages:
+                    # to avoid reload dupe subpages links
+                    checked_suballpages.add(name)
+                    links.append((name, url))
+            return links
 
         # Should be enough subpages on Special:Allpages
         deep = 50
         c = 0
-        oldfr = ""
-        checked_suballpages = []
-        rawacum = raw
-        while r_suballpages and re.search(r_suballpages, raw) and c < deep:
-            # load sub-Allpages
-            m = re.compile(r_suballpages).finditer(raw)
-            currfr = None
-            for i in m:
-                fr = i.group("from")
-                currfr = fr
-
-                if oldfr == currfr:
-                    # We are looping, exit the loop
-                    pass
-
-                if r_suballpages == r_suballpages1:
-                    to = i.group("to")
-                    name = f"{fr}-{to}"
-                    url = "{}?title=Special:Allpages&namespace={}&from={}&to={}".format(
-                        config.index,
-                        namespace,
-                        fr,
-                        to,
-                    )  # do not put urllib.parse.quote in fr or to
-                # fix, this regexp doesn't properly save everything? or does r_title fail on this
-                # type of subpage? (wikiindex)
-                elif r_suballpages == r_suballpages2:
-                    # clean &amp;namespace=\d, sometimes happens
-                    fr = fr.split("&amp;namespace=")[0]
-                    name = fr
-                    url = "{}?title=Special:Allpages/{}&namespace={}".format(
-                        config.index,
-                        name,
-                        namespace,
-                    )
-                elif r_suballpages == r_suballpages3:
-                    fr = fr.split("&amp;namespace=")[0]
-                    name = fr
-                    url = "{}?title=Special:Allpages&from={}&namespace={}".format(
-                        config.index,
-                        name,
-                        namespace,
-                    )
-                else:
-                    assert False, "Unreachable"
-
-                if name not in checked_suballpages:
-                    # to avoid reload dupe subpages links
-                    checked_suballpages.append(name)
-                    Delay(config=config)
-                    # print ('Fetching URL: ', url)
-                    r = session.get(url=url, timeout=10)
-                    raw = str(r.text)
-                    raw = clean_HTML(raw)
-                    rawacum += raw  # merge it after removed junk
+        pending = unchecked_links(raw) if r_suballpages else []
+        del raw
+        with ThreadPoolExecutor(max_workers=max(1, TITLES_WORKERS)) as executor:
+            while pending and c < deep:
+                next_pending: List[Tuple[str, str]] = []
+                fetched = executor.map(lambda link: _fetch_allpages(config, session, link[1]), pending)
+                for (name, _), raw in zip(pending, fetched):
                     print(
                         "    Reading",
                         name,
                         len(raw),
                         "bytes",
-                        len(re.findall(r_suballpages, raw)),
+                        len(r_suballpages.findall(raw)), # type: ignore
                         "subpages",
-                        len(re.findall(r_title, raw)),
+                        len(R_TITLE.findall(raw)),
                         "pages",
                     )
+                    yield from new_titles(raw)
+                    next_pending.extend(unchecked_links(raw))
+                pending = next_pending
+                c += 1
 
-                Delay(config=config)
-            
-            assert currfr is not None, "re.search found the pattern, but re.finditer fails, why?"
-            oldfr = currfr
-            c += 1
-
-        c = 0
-        m = re.compile(r_title).finditer(rawacum)
-        for i in m:
-            t = undo_HTML_entities(text=i.group("title"))
-            if not t.startswith("Special:"):
-                if t not in titles:
-                    titles.append(t)
-                    c += 1
-        print("    %d titles retrieved in the namespace %d" % (c, namespace))
-    return titles
+        print("    %d titles retrieved in the namespace %d" % (len(titles), namespace))
 
 
 def getPageTitles(config: Config, session: requests.Session):
@@ -205,9 +291,7 @@ def getPageTitles(config: Config, session: requests.Session):
     elif config.index:
         titles = getPageTitlesScraper(config=config, session=session)
 
-    titlesfilename = "{}-{}-titles.txt".format(
-        url2prefix_from_config(config=config), config.date
-    )
+    titlesfilename = get_titles_filename(config)
     titlesfile = open(
         "{}/{}".format(config.path, titlesfilename), "wt", encoding="utf-8"
     )
@@ -215,16 +299,22 @@ def getPageTitles(config: Config, session: requests.Session):
     for title in titles:
         titlesfile.write(str(title) + "\n")
         c += 1
-    # TODO: Sort to remove dupes? In CZ, Widget:AddThis appears two times:
-    # main namespace and widget namespace.
-    # We can use sort -u in UNIX, but is it worth it?
     titlesfile.write("--END--\n")
     titlesfile.close()
     print("Titles saved at...", titlesfilename)
 
+    # In CZ, Widget:AddThis appears two times: main namespace and widget namespace.
+    # Building the index removes such duplicates from titles.txt.
+    c -= TitlesIndex.build(f"{config.path}/{titlesfilename}")
+
     print("%d page titles loaded" % (c))
     return titlesfilename
 
+def get_titles_filename(config: Config) -> str:
+    return "{}-{}-titles.txt".format(
+        url2prefix_from_config(config=config), config.date
+    )
+
 def checkTitleOk(config: Config):
     try:
         with FileReadBackwards(
@@ -265,28 +355,13 @@ def read_titles(config: Config, session: requests.Session, start: Optional[str]=
     if not checkTitleOk(config):
         getPageTitles(config=config, session=session)
 
-    titles_filename = "{}-{}-titles.txt".format(
-        url2prefix_from_config(config=config), config.date
-    )
-
-    seeking = start is not None
-    """ If True, we are looking for the `start` title to start reading from """
-    end_reached = False
-    with open(f"{config.path}/{titles_filename}", encoding="utf-8") as f:
-        for line in f:
-            title = line.strip()
-
-            if title == "--END--":
-                end_reached = True
-            else:
-                end_reached = False
-
-            if seeking and title != start:
-                continue
-            else:
-                seeking = False
-
-            yield title
+    with TitlesIndex.open(f"{config.path}/{get_titles_filename(config)}") as index:
+        position = 0
+        if start is not None:
+            position = index.find(start)
+            if position is None:
+                print(f'Title "{start}" not found in the title list, nothing to resume')
+                return
+            print(f'Resuming from title #{position}: "{start}"')
 
-    if not end_reached:
-        raise EOFError("End of file flag `--END--` not found in the last line")
\ No newline at end of file
+        yield from index.iter_from(position)
@@ -0,0 +1,248 @@
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+from typing import BinaryIO, Generator, Iterator, List, Optional, Set, Tuple, Union
+from pathlib import Path
+
+END_MARK = b"--END--"
+""" last line of a complete titles.txt """
+
+_MAGIC = b"WT3TIDX1"
+_HEADER = struct.Struct("<8sQQQ") # magic, count, titles.txt size, titles.txt mtime_ns
+_OFFSET = struct.Struct("<Q") # byte offset of the n-th title in titles.txt
+_ENTRY = struct.Struct("<QQ") # (title digest, n), sorted
+
+RUN_SIZE = 1 << 18
+""" max (digest, n) pairs kept in memory while building the index """
+
+
+def title_digest(title: bytes) -> int:
+    """ 64-bit digest of an (utf-8 encoded) title """
+    return int.from_bytes(hashlib.blake2b(title, digest_size=8).digest(), "little")
+
+
+def _iter_run(path: str) -> Iterator[Tuple[int, int]]:
+    with open(path, "rb") as f:
+        while chunk := f.read(_ENTRY.size * 4096):
+            yield from _ENTRY.iter_unpack(chunk)
+
+
+def _write_run(pairs: List[Tuple[int, int]], tmpdir: str) -> str:
+    pairs.sort()
+    fd, path = tempfile.mkstemp(prefix="run-", dir=tmpdir)
+    with os.fdopen(fd, "wb") as f:
+        for pair in pairs:
+            f.write(_ENTRY.pack(*pair))
+    return path
+
+
+class TitlesIndex:
+    """
+    Compact on-disk index of a titles.txt file, stored next to it as `titles.txt.idx`.
+
+    The index holds the byte offset of every title (so we can seek to the n-th title)
+    and a sorted table of 64-bit title digests (so we can find a title by binary search).
+    Building it is an external sort, memory usage is bounded by `RUN_SIZE`,
+    duplicated titles are removed from titles.txt on the way.
+    """
+
+    def __init__(self, titles_path: Union[str, Path]):
+        """ Open an existing index, use `TitlesIndex.open()` to (re)build it if needed """
+        self.titles_path = str(titles_path)
+        self.index_path = self.titles_path + ".idx"
+
+        with open(self.index_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.titles_size, self.titles_mtime_ns = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            self.close()
+            raise ValueError(f"{self.index_path} is not a titles index")
+        self._offsets_start = _HEADER.size
+        self._entries_start = self._offsets_start + self.count * _OFFSET.size
+
+        self._titles_fp: BinaryIO = open(self.titles_path, "rb")
+
+    def close(self):
+        self._mm.close()
+        if hasattr(self, "_titles_fp"):
+            self._titles_fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def is_fresh(self) -> bool:
+        """ Whether titles.txt was not modified since the index was built """
+        stat = os.stat(self.titles_path)
+        return (stat.st_size, stat.st_mtime_ns) == (self.titles_size, self.titles_mtime_ns)
+
+    def offset(self, n: int) -> int:
+        """ byte offset of the n-th title in titles.txt """
+        if not 0 <= n < self.count:
+            raise IndexError(n)
+        return _OFFSET.unpack_from(self._mm, self._offsets_start + n * _OFFSET.size)[0]
+
+    def __getitem__(self, n: int) -> str:
+        self._titles_fp.seek(self.offset(n))
+        return self._titles_fp.readline().strip().decode("utf-8")
+
+    def _entry(self, i: int) -> Tuple[int, int]:
+        return _ENTRY.unpack_from(self._mm, self._entries_start + i * _ENTRY.size)
+
+    def find(self, title: str) -> Optional[int]:
+        """ Return the position (n) of `title` in titles.txt, or None if not found """
+        digest = title_digest(title.strip().encode("utf-8"))
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        # there may be (very unlikely) digest collisions, check the real title
+        while lo < self.count:
+            entry_digest, n = self._entry(lo)
+            if entry_digest != digest:
+                break
+            if self[n] == title.strip():
+                return n
+            lo += 1
+        return None
+
+    def __contains__(self, title: str) -> bool:
+        return self.find(title) is not None
+
+    def iter_from(self, n: int = 0) -> Generator[str, None, None]:
+        """ Iterate titles from the n-th title (included) to the end """
+        if n >= self.count:
+            return
+        with open(self.titles_path, "rb") as f:
+            f.seek(self.offset(n))
+            for line in f:
+                line = line.strip()
+                if line == END_MARK:
+                    return
+                if line:
+                    yield line.decode("utf-8")
+
+    @classmethod
+    def open(cls, titles_path: Union[str, Path]) -> "TitlesIndex":
+        """ Open the index of `titles_path`, (re)build it if it is missing or stale """
+        try:
+            index = cls(titles_path)
+        except (FileNotFoundError, ValueError, struct.error):
+            pass
+        else:
+            if index.is_fresh():
+                return index
+            index.close()
+        cls.build(titles_path)
+        return cls(titles_path)
+
+    @classmethod
+    def build(cls, titles_path: Union[str, Path], run_size: int = RUN_SIZE) -> int:
+        """ Build the index of `titles_path`, removing duplicated titles from it.
+
+        returns: number of duplicated titles removed
+        """
+        titles_path = str(titles_path)
+        index_path = titles_path + ".idx"
+        tmpdir = tempfile.mkdtemp(prefix=".titles-idx-", dir=os.path.dirname(titles_path) or ".")
+        runs: List[str] = []
+        try:
+            offsets_path = os.path.join(tmpdir, "offsets")
+            count = 0
+            pairs: List[Tuple[int, int]] = []
+            with open(titles_path, "rb") as titles, open(offsets_path, "wb") as offsets:
+                offset = 0
+                for line in titles:
+                    title = line.strip()
+                    if title == END_MARK:
+                        break
+                    if title:
+                        offsets.write(_OFFSET.pack(offset))
+                        pairs.append((title_digest(title), count))
+                        count += 1
+                        if len(pairs) >= run_size:
+                            runs.append(_write_run(pairs, tmpdir))
+                            pairs = []
+                    offset += len(line)
+            if pairs:
+                runs.append(_write_run(pairs, tmpdir))
+            del pairs
+
+            duplicates = cls._merge_runs(titles_path, offsets_path, runs, os.path.join(tmpdir, "entries"))
+            if duplicates:
+                print(f"Removing {len(duplicates)} duplicated titles from {os.path.basename(titles_path)}")
+                cls._remove_titles(titles_path, duplicates)
+                return len(duplicates) + cls.build(titles_path, run_size=run_size)
+
+            stat = os.stat(titles_path)
+            with open(index_path + ".tmp", "wb") as idx:
+                idx.write(_HEADER.pack(_MAGIC, count, stat.st_size, stat.st_mtime_ns))
+                for part in (offsets_path, os.path.join(tmpdir, "entries")):
+                    with open(part, "rb") as f:
+                        while chunk := f.read(1 << 20):
+                            idx.write(chunk)
+            os.replace(index_path + ".tmp", index_path)
+            return 0
+        finally:
+            for path in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, path))
+            os.rmdir(tmpdir)
+
+    @staticmethod
+    def _merge_runs(titles_path: str, offsets_path: str, runs: List[str], entries_path: str) -> Set[int]:
+        """ k-way merge sorted runs into `entries_path`
+
+        returns: positions of titles that already appeared earlier in titles.txt
+        """
+        duplicates: Set[int] = set()
+        with open(titles_path, "rb") as titles, open(offsets_path, "rb") as offsets, \
+             open(entries_path, "wb") as entries:
+
+            def read_title(n: int) -> bytes:
+                offsets.seek(n * _OFFSET.size)
+                titles.seek(_OFFSET.unpack(offsets.read(_OFFSET.size))[0])
+                return titles.readline().strip()
+
+            group_digest = None
+            group: List[Tuple[bytes, int]] = [] # (title, n) with the same digest
+            for digest, n in heapq.merge(*[_iter_run(run) for run in runs]):
+                if digest != group_digest:
+                    group_digest, group = digest, []
+                    entries.write(_ENTRY.pack(digest, n))
+                    group.append((b"", n)) # title is lazily loaded, collisions are rare
+                    continue
+                title = read_title(n)
+                if not group[0][0]:
+                    group[0] = (read_title(group[0][1]), group[0][1])
+                # merged pairs are sorted by n, so the first occurrence is kept
+                if any(title == seen for seen, _ in group):
+                    duplicates.add(n)
+                    continue
+                entries.write(_ENTRY.pack(digest, n))
+                group.append((title, n))
+        return duplicates
+
+    @staticmethod
+    def _remove_titles(titles_path: str, positions: Set[int]):
+        """ Rewrite titles.txt without the titles at `positions` """
+        n = 0
+        with open(titles_path, "rb") as src, open(titles_path + ".tmp", "wb") as dst:
+            for line in src:
+                title = line.strip()
+                if title and title != END_MARK:
+                    n += 1
+                    if n - 1 in positions:
+                        continue
+                dst.write(line)
+        os.replace(titles_path + ".tmp", titles_path)
@@ -6,23 +6,24 @@ import http.cookiejar
 import os
 import queue
 import re
-import sys
+import time
 import traceback
-from typing import Tuple
+from typing import Optional, Tuple
 
 import requests
 from requests.adapters import DEFAULT_RETRIES as REQUESTS_DEFAULT_RETRIES
-from requests.adapters import HTTPAdapter
 import urllib3
 
 from wikiteam3.dumpgenerator.api import (
+    check_API,
     check_retry_API,
     get_WikiEngine,
     mediawiki_get_API_and_Index,
 )
-from wikiteam3.dumpgenerator.api.index_check import check_index
+from wikiteam3.dumpgenerator.api.index_check import STARTUP_DEADLINE, check_index, probe_indexes
 from wikiteam3.dumpgenerator.cli.delay import Delay
 from wikiteam3.dumpgenerator.config import Config, OtherConfig, new_config
+from wikiteam3.dumpgenerator.exceptions import DumpError, WikiEngineFound
 from wikiteam3.dumpgenerator.version import getVersion
 from wikiteam3.utils import (
     get_random_UserAgent,
@@ -30,7 +31,12 @@ from wikiteam3.utils import (
     url2prefix_from_config,
 )
 from wikiteam3.utils.login import uniLogin
+from wikiteam3.dumpgenerator.api.limits import has_apihighlimits
 from wikiteam3.utils.monkey_patch import SessionMonkeyPatch, WakeTLSAdapter
+from wikiteam3.utils.adaptive_timeout import install_adaptive_timeout
+from wikiteam3.utils.connection_pool import IdleTrackingAdapter
+from wikiteam3.utils.host_profile import PROFILE_DIR, PROFILE_TTL_DAYS, HostProfile, describe_age, discovery_key
+from wikiteam3.utils.rate_limiter import BACKPRESSURE, farm_key, install_rate_limiter, parse_retry_after
 from wikiteam3.utils.user_agent import setup_random_UserAgent
 from wikiteam3.utils.util import ALL_NAMESPACE_FLAG
 
@@ -87,7 +93,14 @@ def getArgumentParser():
         "--verbose", action="store_true", help=""
     )
     parser.add_argument(
-        "--api_chunksize", metavar="50", default=50, help="Chunk size for MediaWiki API (arvlimit, ailimit, etc.)"
+        "--profile-ttl", metavar="7", default=PROFILE_TTL_DAYS, type=float, dest="profile_ttl",
+        help="Reuse what a previous run learned about this host (API/index.php URLs, HTTP method, batch sizes...) "
+             "if it is younger than this many days, saved in %s. 0: don't use host profiles" % PROFILE_DIR.replace("%", "%%")
+    )
+    parser.add_argument(
+        "--api_chunksize", metavar="50", default=0,
+        help="Chunk size for MediaWiki API (arvlimit, ailimit, etc.). "
+             "Default: the max allowed (50/500 for content, 500/5000 for lists, the larger ones with the apihighlimits right)"
     )
 
     # URL params
@@ -149,6 +162,11 @@ def getArgumentParser():
     group_download.add_argument(
         "--images", action="store_true", help="Generates an image dump"
     )
+    group_download.add_argument(
+        "--concurrent-phases", action="store_true", dest="concurrent_phases",
+        help="Run the XML, redirects and images dumps at the same time (sharing the --delay rate limit), "
+             "instead of one after another. Their output lines are prefixed with [xml], [redirects], [images]",
+    )
     group_image = parser.add_argument_group(
         "Image dump options", "Options for image dump (--images)"
     )
@@ -280,25 +298,11 @@ def checkParameters(args=argparse.Namespace()) -> bool:
     
     return passed
 
-def get_parameters(params=None) -> Tuple[Config, OtherConfig]:
-    # if not params:
-    #     params = sys.argv
-
-    parser = getArgumentParser()
-    args = parser.parse_args(params)
-    if checkParameters(args) is not True:
-        print("\n\n")
-        parser.print_help()
-        sys.exit(1)
-    # print (args)
-
-    ########################################
 
-    # Create session
+def build_session(args: argparse.Namespace) -> requests.Session:
+    """The `requests.Session` configured by the command line `args` (retries, adapters, cookies, UA, auth)"""
     mod_requests_text(requests) # monkey patch # type: ignore
     session = requests.Session()
-    patch_sess = SessionMonkeyPatch(session=session, hard_retries=1) # hard retry once to avoid spending too much time on initial detection
-    patch_sess.hijack()
     def print_request(r: requests.Response, *args, **kwargs):
         # TODO: use logging
         # print("H:", r.request.headers)
@@ -342,17 +346,29 @@ def get_parameters(params=None) -> Tuple[Config, OtherConfig]:
                         except Exception:
                             pass
                         conn.pool = pool
+                    if kwargs.get('response') is not None and kwargs['response'].status in (429, 503):
+                        # let other requests to this host slow down too
+                        BACKPRESSURE.on_overload(
+                            farm_key(conn.host), parse_retry_after(kwargs['response'].headers.get('Retry-After'))
+                        )
                 return super(CustomRetry, self).increment(method=method, url=url, *args, **kwargs)
 
             def sleep(self, response=None):
-                backoff = self.get_backoff_time()
-                if backoff <= 0:
-                    return
+                retry_after = None
+                if response is not None and self.respect_retry_after_header:
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                if retry_after is not None:
+                    delay = retry_after
+                else:
+                    backoff = self.get_backoff_time()
+                    if backoff <= 0:
+                        return
+                    delay = backoff + 5
                 if response is not None:
                     msg = 'req retry (%s)' % response.status
                 else:
                     msg = None
-                Delay(config=None, msg=msg, delay=backoff+5)
+                Delay(config=None, msg=msg, delay=delay)
 
         __retries__ = CustomRetry(
             total=int(args.retries), backoff_factor=1,
@@ -366,7 +382,7 @@ def get_parameters(params=None) -> Tuple[Config, OtherConfig]:
     for protocol in ['http://', 'https://']:
         session.mount(protocol,
             WakeTLSAdapter(max_retries=__retries__) if args.insecure
-            else HTTPAdapter(max_retries=__retries__)
+            else IdleTrackingAdapter(max_retries=__retries__)
             )
     # Disable SSL verification
     if args.insecure:
@@ -395,13 +411,39 @@ def get_parameters(params=None) -> Tuple[Config, OtherConfig]:
     if args.http_user and args.http_password:
         session.auth = (args.user, args.password)
 
-    # Execute meta info params
-    if args.wiki:
-        if args.get_wiki_engine:
-            print(get_WikiEngine(url=args.wiki, session=session))
-            sys.exit(0)
+    return session
 
-    # Get API and index and verify
+
+def profile_API_ok(api: str, *, session: requests.Session) -> bool:
+    """One siteinfo request, to check that the API of a host profile still answers"""
+    try:
+        return bool(check_API(api, session=session))
+    except requests.exceptions.RequestException as e:
+        print("Connection error: %s" % (str(e)))
+        return False
+
+
+def login(args: argparse.Namespace, *, api: str, index: Optional[str], session: requests.Session) -> requests.Session:
+    """Log in with --user and --password if given, returns the session to use from now on"""
+    # TODO: Re-login after session expires
+    if args.user and args.password:
+        _session = uniLogin(api=api, index=index, session=session, username=args.user, password=args.password)
+        if _session:
+            print("-- Login OK --")
+            return _session
+        print("-- Login failed --")
+    return session
+
+
+def discover_API_and_index(args: argparse.Namespace, *, session: requests.Session, deadline: Optional[float]
+                           ) -> Tuple[str, Optional[str], requests.Session, bool]:
+    """Find and check the api.php and index.php of the wiki (--wiki, --api, --index), logging in
+    (see `login()`) between the API check and the index.php probes
+
+    returns: (api, index, session, checked), `checked`: both passed their checks,
+        i.e. the result can be saved to the host profile
+    raises: `DumpError` if the wiki can't be dumped with them
+    """
     api = args.api if args.api else ""
     index = args.index if args.index else ""
     if api == "" or index == "":
@@ -414,7 +456,7 @@ def get_parameters(params=None) -> Tuple[Config, OtherConfig]:
                     index = index2
             else:
                 print("ERROR: Unsupported wiki. Wiki engines supported are: MediaWiki")
-                sys.exit(1)
+                raise DumpError("Unsupported wiki. Wiki engines supported are: MediaWiki")
         else:
             if api == "":
                 pass
@@ -434,7 +476,8 @@ def get_parameters(params=None) -> Tuple[Config, OtherConfig]:
             session=session,
         )
 
-    if api and check:
+    api_ok = bool(api and check)
+    if api_ok:
         # Replace the index URL we got from the API check
         index2 = check[1]
         api = checkedapi
@@ -445,138 +488,201 @@ def get_parameters(params=None) -> Tuple[Config, OtherConfig]:
             args.api = None
         else:
             print("Error in API. Please, provide a correct path to API")
-            sys.exit(1)
+            raise DumpError("Error in API. Please, provide a correct path to API")
 
-    # login if needed
-    # TODO: Re-login after session expires
-    if args.user and args.password:
-        _session = uniLogin(api=api, index=index, session=session, username=args.user, password=args.password)
-        if _session:
-            session = _session
-            print("-- Login OK --")
-        else:
-            print("-- Login failed --")
+    session = login(args, api=api, index=index, session=session)
 
     # check index
     threshold: float = args.index_check_threshold
 
-    if index and check_index(index=index, logged_in=bool(args.cookies), session=session) > threshold:
-        print("index.php is OK")
-    else:
-        index = index2
-        if index and index.startswith("//"):
-            index = args.wiki.split("//")[0] + index
-        if index and check_index(index=index, logged_in=bool(args.cookies), session=session) > threshold:
+    # candidates, in order of preference: the given/guessed one, the one from the API check,
+    # and its directory. The next one is only probed if the previous one failed.
+    if index2 and index2.startswith("//"):
+        index2 = args.wiki.split("//")[0] + index2
+    candidates = [index, index2, index2 and "/".join(index2.split("/")[:-1])]
+    candidates = list(dict.fromkeys(c for c in candidates if c))
+    index = candidates[-1] if candidates else None
+    index_ok = False
+    for candidate, probability in probe_indexes(
+        candidates, logged_in=bool(args.cookies), session=session, deadline=deadline, delay=args.delay
+    ):
+        if probability > threshold:
+            index = candidate
+            index_ok = True
             print("index.php is OK")
-        else:
-            try:
-                index = "/".join(index.split("/")[:-1])
-            except AttributeError:
-                index = None
-            if index and check_index(index=index, logged_in=bool(args.cookies), session=session) > threshold:
-                print("index.php is OK")
-            else:
-                print("Error in index.php.")
-                if not (args.xmlrevisions or args.xmlapiexport):
-                    print(
-                        "Please, provide a correct path to index.php or use --xmlrevisions or --xmlapiexport. Terminating."
-                    )
-                    sys.exit(11)
-
-
-    namespaces = [ALL_NAMESPACE_FLAG]
-    exnamespaces = []
-    # Process namespace inclusions
-    if args.namespaces:
-        # fix, why - ?  and... --namespaces= all with a space works?
-        if (
-            re.search(r"[^\d, \-]", args.namespaces)
-            and args.namespaces.lower() != ALL_NAMESPACE_FLAG
-        ):
+            break
+    else:
+        print("Error in index.php.")
+        if not (args.xmlrevisions or args.xmlapiexport):
             print(
-                "Invalid namespace values.\nValid format is integer(s) separated by commas"
+                "Please, provide a correct path to index.php or use --xmlrevisions or --xmlapiexport. Terminating."
             )
-            sys.exit(1)
-        else:
-            ns = re.sub(" ", "", args.namespaces)
-            if ns.lower() == ALL_NAMESPACE_FLAG:
-                namespaces = [ALL_NAMESPACE_FLAG]
+            raise DumpError("Error in index.php", exit_code=11)
+
+    return api, index, session, api_ok and index_ok
+
+
+def get_parameters(params=None, session: Optional[requests.Session] = None) -> Tuple[Config, OtherConfig]:
+    """Parse the command line `params` (default: sys.argv), detect the API/index.php and check them
+
+    session: reuse this session (see `build_session()`) instead of building a new one
+    raises: `DumpError` if the wiki can't be dumped with these parameters
+        `WikiEngineFound` with the answer of --get-wiki-engine
+    """
+    # if not params:
+    #     params = sys.argv
+
+    startup_deadline = time.monotonic() + STARTUP_DEADLINE
+    parser = getArgumentParser()
+    args = parser.parse_args(params)
+    if checkParameters(args) is not True:
+        print("\n\n")
+        parser.print_help()
+        raise DumpError("invalid parameters")
+    # print (args)
+
+    ########################################
+
+    if session is None:
+        session = build_session(args)
+    patch_sess = SessionMonkeyPatch(session=session, hard_retries=1) # hard retry once to avoid spending too much time on initial detection
+    patch_sess.hijack()
+    try:
+        # Execute meta info params
+        if args.wiki:
+            if args.get_wiki_engine:
+                raise WikiEngineFound(get_WikiEngine(url=args.wiki, session=session))
+
+        # Get API and index and verify
+        profile = HostProfile(args.wiki or args.api or args.index, ttl_days=args.profile_ttl)
+        profile_key = discovery_key(args.wiki, args.api, args.index)
+        discovered = profile.get(profile_key)
+        if discovered is not None and not profile_API_ok(discovered["api"], session=session):
+            print(f"The API found on {describe_age(discovered)} doesn't answer anymore, discovering it again")
+            discovered = None
+
+        if discovered is not None:
+            api, index = discovered["api"], discovered["index"]
+            print(f"Using the API and index.php found on {describe_age(discovered)} (host profile, --profile-ttl)")
+            print("API: ", api)
+            print("index.php: ", index)
+            session = login(args, api=api, index=index, session=session)
+            if index and check_index(index=index, logged_in=bool(args.cookies), session=session,
+                                     deadline=startup_deadline, delay=args.delay) <= args.index_check_threshold:
+                print(f"The index.php found on {describe_age(discovered)} doesn't answer anymore, discovering it again")
+                discovered = None
+        if discovered is None:
+            api, index, session, checked = discover_API_and_index(args, session=session, deadline=startup_deadline)
+            if checked:
+                profile.save(profile_key, api=api, index=index)
+
+        api_highlimits = False
+        if api:
+            api_highlimits = has_apihighlimits(api=api, session=session)
+            if api_highlimits:
+                print("User has the apihighlimits right, using larger API batches")
+
+
+        namespaces = [ALL_NAMESPACE_FLAG]
+        exnamespaces = []
+        # Process namespace inclusions
+        if args.namespaces:
+            # fix, why - ?  and... --namespaces= all with a space works?
+            if (
+                re.search(r"[^\d, \-]", args.namespaces)
+                and args.namespaces.lower() != ALL_NAMESPACE_FLAG
+            ):
+                print(
+                    "Invalid namespace values.\nValid format is integer(s) separated by commas"
+                )
+                raise DumpError("Invalid namespace values")
             else:
-                namespaces = [int(i) for i in ns.split(",")]
+                ns = re.sub(" ", "", args.namespaces)
+                if ns.lower() == ALL_NAMESPACE_FLAG:
+                    namespaces = [ALL_NAMESPACE_FLAG]
+                else:
+                    namespaces = [int(i) for i in ns.split(",")]
 
-    # Process namespace exclusions
-    if args.exnamespaces:
-        try:
-            exnamespaces = [int(i) for i in ns.split(",")]
-        except ValueError:
-            print(
-                "Invalid namespace values.\nValid format is integer(s) separated by commas"
-            )
-            sys.exit(1)
-
-
-    config = Config(
-        curonly = args.curonly,
-        date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d"),
-        api = api,
-        failfast = args.failfast,
-        http_method = "POST",
-        api_chunksize = int(args.api_chunksize),
-        index = index,
-        images = args.images,
-        redirects = args.redirects,
-        logs = False,
-        xml = args.xml,
-        xmlapiexport = args.xmlapiexport,
-        xmlrevisions = args.xmlrevisions or args.xmlrevisions_page,
-        xmlrevisions_page = args.xmlrevisions_page,
-        namespaces = namespaces,
-        exnamespaces = exnamespaces,
-        path = args.path and os.path.normpath(args.path) or "",
-        delay = args.delay,
-        retries = int(args.retries),
-    )
-
-
-    other = OtherConfig(
-        resume = args.resume,
-        force = args.force,
-        session = session,
-        bypass_cdn_image_compression = args.bypass_cdn_image_compression,
-        add_referer_header = args.add_referer_header,
-        image_timestamp_interval = args.image_timestamp_interval,
-        ia_wbm_booster = args.ia_wbm_booster,
-
-        assert_max_pages = args.assert_max_pages,
-        assert_max_edits = args.assert_max_edits,
-        assert_max_images = args.assert_max_images,
-        assert_max_images_bytes = args.assert_max_images_bytes,
-
-        hard_retries = int(args.hard_retries),
-
-        upload = args.upload,
-        uploader_args = args.uploader_args,
-    )
-
-    # calculating path, if not defined by user with --path=
-    if not config.path:
-        config.path = "./{}-{}-wikidump".format(
-            url2prefix_from_config(config=config),
-            config.date,
-        )
-        print("No --path argument provided. Defaulting to:")
-        print("  [working_directory]/[domain_prefix]-[date]-wikidump")
-        print("Which expands to:")
-        print("  " + config.path)
-
-    if config.delay == 1.5:
-        print(f"--delay is the default value of {config.delay}")
-        print(
-            f"There will be a {config.delay} second delay between HTTP calls in order to keep the server from timing you out."
+        # Process namespace exclusions
+        if args.exnamespaces:
+            try:
+                exnamespaces = [int(i) for i in ns.split(",")]
+            except ValueError:
+                print(
+                    "Invalid namespace values.\nValid format is integer(s) separated by commas"
+                )
+                raise DumpError("Invalid namespace values")
+
+
+        config = Config(
+            curonly = args.curonly,
+            date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d"),
+            api = api,
+            failfast = args.failfast,
+            http_method = "POST",
+            api_chunksize = int(args.api_chunksize),
+            api_highlimits = api_highlimits,
+            index = index,
+            images = args.images,
+            redirects = args.redirects,
+            logs = False,
+            xml = args.xml,
+            xmlapiexport = args.xmlapiexport,
+            xmlrevisions = args.xmlrevisions or args.xmlrevisions_page,
+            xmlrevisions_page = args.xmlrevisions_page,
+            namespaces = namespaces,
+            exnamespaces = exnamespaces,
+            path = args.path and os.path.normpath(args.path) or "",
+            delay = args.delay,
+            retries = int(args.retries),
         )
-        print(
-            "If you know that this is unnecessary, you can manually specify '--delay 0.0'."
+
+
+        other = OtherConfig(
+            resume = args.resume,
+            force = args.force,
+            session = session,
+            bypass_cdn_image_compression = args.bypass_cdn_image_compression,
+            add_referer_header = args.add_referer_header,
+            image_timestamp_interval = args.image_timestamp_interval,
+            ia_wbm_booster = args.ia_wbm_booster,
+
+            assert_max_pages = args.assert_max_pages,
+            assert_max_edits = args.assert_max_edits,
+            assert_max_images = args.assert_max_images,
+            assert_max_images_bytes = args.assert_max_images_bytes,
+
+            hard_retries = int(args.hard_retries),
+            profile_ttl = args.profile_ttl,
+            concurrent_phases = args.concurrent_phases,
+
+            upload = args.upload,
+            uploader_args = args.uploader_args,
         )
 
-    patch_sess.release()
+        # calculating path, if not defined by user with --path=
+        if not config.path:
+            config.path = "./{}-{}-wikidump".format(
+                url2prefix_from_config(config=config),
+                config.date,
+            )
+            print("No --path argument provided. Defaulting to:")
+            print("  [working_directory]/[domain_prefix]-[date]-wikidump")
+            print("Which expands to:")
+            print("  " + config.path)
+
+        if config.delay == 1.5:
+            print(f"--delay is the default value of {config.delay}")
+            print(
+                f"There will be a {config.delay} second delay between HTTP calls in order to keep the server from timing you out."
+            )
+            print(
+                "If you know that this is unnecessary, you can manually specify '--delay 0.0'."
+            )
+    finally:
+        patch_sess.release()
+    # from now on, every request has a timeout derived from the endpoint latency,
+    # and is rate limited to --delay (per host)
+    install_adaptive_timeout(session)
+    install_rate_limiter(session, config)
     return config, other
@@ -57,6 +57,9 @@ class Config:
     """ save images """
 
     api_chunksize: int = 0  # arvlimit, ailimit, etc
+    """ 0: the max limit allowed to the user, see `api_limit()` """
+    api_highlimits: bool = False
+    """ Whether the user has the `apihighlimits` right (detected after login) """
     export: str = ''
     """ `Special:Export` page name """
     http_method: str = ''
@@ -117,6 +120,10 @@ class OtherConfig:
 
     hard_retries: int
     """ Number of hard retries """
+    profile_ttl: float
+    """ --profile-ttl, in days (0: host profiles disabled) """
+    concurrent_phases: bool
+    """ Run the xml, redirects and images phases concurrently """
 
     upload: bool 
     uploader_args: List[str]
\ No newline at end of file
@@ -1 +1 @@
-from .generator import DumpGenerator
+from .generator import DumpGenerator, DumpResult, run_dump
@@ -7,20 +7,23 @@ import time
 import urllib.parse
 import warnings
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Dict, Generator, List, Optional, Tuple, Union
 
 import requests
 
 from wikiteam3.dumpgenerator.api import get_JSON, handle_StatusCode
-from wikiteam3.dumpgenerator.cli import Delay
+from wikiteam3.dumpgenerator.api.continuation import ContinuedQuery
+from wikiteam3.dumpgenerator.api.limits import api_limit
 from wikiteam3.dumpgenerator.config import Config, OtherConfig
 from wikiteam3.dumpgenerator.dump.image.html_regexs import R_NEXT, REGEX_CANDIDATES
-from wikiteam3.dumpgenerator.exceptions import FileSha1Error, FileSizeError
+from wikiteam3.dumpgenerator.exceptions import AssertionsFailedError, DumpError, FileSha1Error, FileSizeError
 from wikiteam3.dumpgenerator.log import log_error
 from wikiteam3.dumpgenerator.version import getVersion
+from wikiteam3.utils.batch_size import get_batch_size
+from wikiteam3.utils.checkpoint import Checkpoint
 from wikiteam3.utils.identifier import url2prefix_from_config
 from wikiteam3.utils.monkey_patch import SessionMonkeyPatch
-from wikiteam3.utils.util import clean_HTML, int_or_zero, sha1bytes, sha1sum, space, underscore, undo_HTML_entities
+from wikiteam3.utils.util import clean_HTML, int_or_zero, sha1bytes, sha1sum, sort_unique_lines, space, underscore, undo_HTML_entities
 
 NULL = "null"
 """ NULL value for image metadata """
@@ -234,7 +237,6 @@ class Image:
 
 
                 if r is None:
-                    Delay(config=config)
                     try:
                         r = session.get(url=url, params=modify_params(), headers=modify_headers(), allow_redirects=True)
                     except requests.exceptions.ContentDecodingError as e:
@@ -264,7 +266,6 @@ class Image:
                             or size != NULL and len(r.content) != int(size)
                         ):
                         ori_url = url + "&format=original"
-                        Delay(config=config)
                         r = session.get(url=ori_url, params=modify_params(), headers=modify_headers(), allow_redirects=True)
                         check_response(r)
 
@@ -360,7 +361,7 @@ class Image:
     def get_image_names(config: Config, session: requests.Session):
         """Get list of image names"""
 
-        print(")Retrieving image filenames")
+        print("Retrieving image filenames")
         images = []
         if config.api:
             print("Using API to retrieve image names...")
@@ -381,13 +382,14 @@ class Image:
         """Retrieve file list: filename, url, uploader"""
 
         images = []
-        limit = 5000
+        # 5000 overload some servers, but it is needed for sites like this with
+        # no next links
+        # http://www.memoryarchive.org/en/index.php?title=Special:Imagelist&sort=byname&limit=50&wpIlMatch=
+        batch = get_batch_size(config, config.index, "Special:Imagelist limit", initial=5000, minimum=5, decrease=10)
         retries = config.retries
         offset = None
         while offset or len(images) == 0:
-            # 5000 overload some servers, but it is needed for sites like this with
-            # no next links
-            # http://www.memoryarchive.org/en/index.php?title=Special:Imagelist&sort=byname&limit=50&wpIlMatch=
+            limit = batch.value
             params = {"title": "Special:Imagelist", "limit": limit, "dir": "prev", "offset": offset}
             r = session.post(
                 url=config.index,
@@ -395,15 +397,13 @@ class Image:
                 timeout=30,
             )
             raw = r.text
-            Delay(config=config)
             # delicate wiki
             if re.search(
                 r"(?i)(allowed memory size of \d+ bytes exhausted|Call to a member function getURL)",
                 raw,
             ):
-                if limit > 10:
+                if batch.failure():
                     print(f"Error: listing {limit} images in a chunk is not possible, trying tiny chunks")
-                    limit = limit // 10
                     continue
                 elif retries > 0:  # waste retries, then exit
                     retries -= 1
@@ -476,30 +476,50 @@ class Image:
     @staticmethod
     def get_image_names_API(config: Config, session: requests.Session):
         """Retrieve file list: filename, url, uploader, size, sha1"""
-        use_oldAPI = False
+        images = []
+        for batch, _, _ in Image.get_image_names_API_batches(config=config, session=session):
+            images += batch
+
+        if len(images) == 1:
+            print("    Found 1 image")
+        else:
+            print("    Found %d images" % (len(images)))
+
+        return images
+
+    @staticmethod
+    def get_image_names_API_batches(config: Config, session: requests.Session,
+                                    mode: str = "allimages", start: str = "!"
+                                    ) -> Generator[Tuple[List[List], str, str], None, None]:
+        """Yield (images, mode, next_start) for every API batch
+
+        mode: "allimages" (API:Allimages) or "allpages" (API:Allpages generator in ns 6, for old APIs)
+        start: aifrom/gapfrom of the first batch, pass a previous `next_start` (and `mode`) to resume
+        next_start: aifrom/gapfrom of the next batch, "" after the last batch
+        """
         # # Commented by @yzqzss:
         # https://www.mediawiki.org/wiki/API:Allpages
         # API:Allpages requires MW >= 1.8
         # API:Allimages requires MW >= 1.13
 
-        aifrom = "!"
-        images = []
-        countImages = 0
-        while aifrom:
-            print(f'Using API:Allimages to get the list of images, {len(images)} images found so far...', end='\r')
-            params = {
-                "action": "query",
-                "list": "allimages",
-                "aiprop": "url|user|size|sha1|timestamp",
-                "aifrom": aifrom,
-                "format": "json",
-                "ailimit": config.api_chunksize,
-            }
+        def fetch(params: Dict) -> Dict:
             # FIXME Handle HTTP Errors HERE
             r = session.get(url=config.api, params=params, timeout=30)
             handle_StatusCode(r)
-            jsonimages = get_JSON(r)
-            Delay(config=config)
+            return get_JSON(r)
+
+        countImages = 0
+        # the next batch is fetched while the current one is processed
+        allimages = ContinuedQuery(fetch, {
+            "action": "query",
+            "list": "allimages",
+            "aiprop": "url|user|size|sha1|timestamp",
+            "aifrom": start,
+            "format": "json",
+            "ailimit": api_limit(config),
+        })
+        for jsonimages in (allimages if mode == "allimages" and start else ()):
+            print(f'Using API:Allimages to get the list of images, {countImages} images found so far...', end='\r')
 
             if "query" in jsonimages:
                 countImages += len(jsonimages["query"]["allimages"])
@@ -509,22 +529,12 @@ class Image:
                 # # uncomment to force use API:Allpages generator 
                 # # may also can as a fallback if API:Allimages response is wrong
 
-                aifrom = ""
-                if (
-                    "query-continue" in jsonimages
-                    and "allimages" in jsonimages["query-continue"]
-                ):
-                    if "aicontinue" in jsonimages["query-continue"]["allimages"]:
-                        aifrom = jsonimages["query-continue"]["allimages"]["aicontinue"]
-                    elif "aifrom" in jsonimages["query-continue"]["allimages"]:
-                        aifrom = jsonimages["query-continue"]["allimages"]["aifrom"]
-                elif "continue" in jsonimages:
-                    if "aicontinue" in jsonimages["continue"]:
-                        aifrom = jsonimages["continue"]["aicontinue"]
-                    elif "aifrom" in jsonimages["continue"]:
-                        aifrom = jsonimages["continue"]["aifrom"]
+                # the resume token, passed as aifrom
+                continue_params = allimages.next_continue_params or {}
+                aifrom = continue_params.get("aicontinue") or continue_params.get("aifrom") or ""
                 print(countImages, aifrom[0:30]+" "*(60-len(aifrom[0:30])),end="\r")
 
+                images = []
                 for image in jsonimages["query"]["allimages"]:
                     image: Dict
 
@@ -558,64 +568,42 @@ class Image:
                     sha1: Union[bool,str] = image.get("sha1", NULL)
                     timestamp = image.get("timestamp", NULL)
                     images.append([underscore(filename), url, space(uploader), size, sha1, timestamp])
-            else:
-                use_oldAPI = True
+                yield images, "allimages", aifrom
+            elif countImages == 0:
+                print("    API:Allimages not available. Using API:Allpages generator instead.")
+                mode, start = "allpages", "!"
                 break
-
-        if use_oldAPI:
-            print("    API:Allimages not available. Using API:Allpages generator instead.")
-            gapfrom = "!"
-            images = []
-            while gapfrom:
-                # Some old APIs doesn't have allimages query
-                # In this case use allpages (in nm=6) as generator for imageinfo
-                # Example:
-                # http://minlingo.wiki-site.com/api.php?action=query&generator=allpages&gapnamespace=6
-                # &gaplimit=500&prop=imageinfo&iiprop=user|url&gapfrom=!
-                params = {
-                    "action": "query",
-                    "generator": "allpages",
-                    "gapnamespace": 6,
-                    "gaplimit": config.api_chunksize, # The value must be between 1 and 500.
-                                    # TODO: Is it OK to set it higher, for speed?
-                    "gapfrom": gapfrom,
-                    "prop": "imageinfo",
-                    "iiprop": "url|user|size|sha1|timestamp",
-                    "format": "json",
-                }
-                # FIXME Handle HTTP Errors HERE
-                r = session.get(url=config.api, params=params, timeout=30)
-                handle_StatusCode(r)
-                jsonimages = get_JSON(r)
-                Delay(config=config)
-
+            else:
+                # allimages stopped answering in the middle of the list, don't start over with another listing
+                raise RuntimeError("API:Allimages returned no query data in the middle of the list")
+
+        if mode == "allpages" and start:
+            # Some old APIs doesn't have allimages query
+            # In this case use allpages (in nm=6) as generator for imageinfo
+            # Example:
+            # http://minlingo.wiki-site.com/api.php?action=query&generator=allpages&gapnamespace=6
+            # &gaplimit=500&prop=imageinfo&iiprop=user|url&gapfrom=!
+            allpages = ContinuedQuery(fetch, {
+                "action": "query",
+                "generator": "allpages",
+                "gapnamespace": 6,
+                "gaplimit": api_limit(config), # 500, 5000 with apihighlimits
+                "gapfrom": start,
+                "prop": "imageinfo",
+                "iiprop": "url|user|size|sha1|timestamp",
+                "format": "json",
+            })
+            for jsonimages in allpages:
                 if "query" in jsonimages:
                     countImages += len(jsonimages["query"]["pages"])
-                    print(countImages, gapfrom[0:30]+" "*(60-len(gapfrom[0:30])),end="\r")
-
-                    gapfrom = ""
-
-                    # all moden(at 20221231) wikis return 'continue' instead of 'query-continue'
-                    if (
-                        "continue" in jsonimages
-                        and "gapcontinue" in jsonimages["continue"]
-                    ):
-                        gapfrom = jsonimages["continue"]["gapcontinue"]
-                    
-                    # prior to mw1.21, that raw continuation (query-continue) was the only option. 
-                    elif (
-                        "query-continue" in jsonimages
-                        and "allpages" in jsonimages["query-continue"]
-                    ):
-                        if "gapfrom" in jsonimages["query-continue"]["allpages"]:
-                            gapfrom = jsonimages["query-continue"]["allpages"][
-                                "gapfrom"
-                            ]
-
 
-                    # print (gapfrom)
-                    # print (jsonimages['query'])
+                    # all moden(at 20221231) wikis return 'continue' (gapcontinue) instead of 'query-continue',
+                    # prior to mw1.21, that raw continuation (query-continue, gapfrom) was the only option.
+                    continue_params = allpages.next_continue_params or {}
+                    gapfrom = continue_params.get("gapcontinue") or continue_params.get("gapfrom") or ""
+                    print(countImages, gapfrom[0:30]+" "*(60-len(gapfrom[0:30])),end="\r")
 
+                    images = []
                     for image, props in jsonimages["query"]["pages"].items():
                         url = props["imageinfo"][0]["url"]
                         url = Image.curate_image_URL(config=config, url=url)
@@ -627,63 +615,140 @@ class Image:
                         sha1 = props.get("imageinfo")[0].get("sha1", NULL)
                         timestamp = props.get("imageinfo")[0].get("timestamp", NULL)
                         images.append([underscore(filename), url, space(uploader), size, sha1, timestamp])
+                    yield images, "allpages", gapfrom
                 else:
                     # if the API doesn't return query data, then we're done
                     break
 
-        if len(images) == 1:
-            print("    Found 1 image")
-        else:
-            print("    Found %d images" % (len(images)))
 
-        return images
+    @staticmethod
+    def get_images_filename(config: Config) -> str:
+        return "{}-{}-images.txt".format(
+            url2prefix_from_config(config=config), config.date
+        )
 
+    @staticmethod
+    def format_image_line(line: List) -> str:
+        """Format an image record as a images.txt line (including the trailing newline)"""
+        while 3 <= len(line) < 6:
+            line.append(NULL) # At this point, make sure all lines have 5 elements
+        filename, url, uploader, size, sha1, timestamp = line
+
+        assert " " not in filename, "Filename contains space, it should be underscored"
+        assert "_" not in uploader, "Uploader contains underscore, it should be spaced"
+
+        return (
+            filename + "\t" + url + "\t" + uploader
+            + "\t" + (str(size) if size else NULL)
+            + "\t" + (str(sha1) if sha1 else NULL) # sha1 or size may be NULL
+            + "\t" + (timestamp if timestamp else NULL)
+            + "\n"
+        )
+
+    @staticmethod
+    def load_image_names(path: Union[str, Path]) -> Tuple[List[List], bool]:
+        """Load images.txt
+
+        returns: (images, complete), complete is True if the list ends with --END--
+        """
+        images = []
+        last_line = ""
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                while line := f.readline().rstrip():
+                    last_line = line
+                    if "\t" in line:
+                        images.append(line.split("\t"))
+        return images, last_line == "--END--"
 
     @staticmethod
     def save_image_names(config: Config, other: OtherConfig, images: List[List]):
         """Save image list in a file, including filename, url, uploader and other metadata"""
 
-        images_filename = "{}-{}-images.txt".format(
-            url2prefix_from_config(config=config), config.date
-        )
+        images_filename = Image.get_images_filename(config)
         images_file = open(
             "{}/{}".format(config.path, images_filename), "w", encoding="utf-8"
         )
 
         c_images_size = 0
         for line in images:
-            while 3 <= len(line) < 6:
-                line.append(NULL) # At this point, make sure all lines have 5 elements
-            filename, url, uploader, size, sha1, timestamp = line
-
-            assert " " not in filename, "Filename contains space, it should be underscored"
-            assert "_" not in uploader, "Uploader contains underscore, it should be spaced"
-
-            # print(line,end='\r')
-            c_images_size += int_or_zero(size)
-
-            images_file.write(
-                filename + "\t" + url + "\t" + uploader
-                + "\t" + (str(size) if size else NULL)
-                + "\t" + (str(sha1) if sha1 else NULL) # sha1 or size may be NULL
-                + "\t" + (timestamp if timestamp else NULL)
-                + "\n"
-            )
+            images_file.write(Image.format_image_line(line))
+            c_images_size += int_or_zero(line[3])
         images_file.write("--END--\n")
         images_file.close()
 
         print("Image metadata (images.txt) saved at:", images_filename)
+        Image.check_image_names_asserts(other=other, c_images=len(images), c_images_size=c_images_size)
+
+    @staticmethod
+    def fetch_image_names(config: Config, other: OtherConfig) -> List[List]:
+        """Get the image list and save it to images.txt, batch by batch
+
+        With the API, every batch is appended to images.txt as it arrives and the
+        aicontinue/gapcontinue of the next batch is saved to `images.txt.checkpoint.json`,
+        so an interrupted listing continues from the last saved batch.
+        Finally images.txt is sorted and deduplicated out of core (unless $WIKITEAM3_IMAGES_SORT=0).
+
+        returns: the (complete) image list
+        """
+        images_path = "{}/{}".format(config.path, Image.get_images_filename(config))
+        if not config.api:
+            images = Image.get_image_names(config=config, session=other.session)
+            Image.save_image_names(config=config, other=other, images=images)
+            return images
+
+        print("Retrieving image filenames")
+        print("Using API to retrieve image names...")
+        checkpoint = Checkpoint(images_path + ".checkpoint.json")
+        state = checkpoint.get("api") or {}
+        if state and not os.path.exists(images_path):
+            state = {} # images.txt lost, start over
+        if state:
+            print(f'Resuming image list from "{state["from"]}" ({state["mode"]})')
+
+        with open(images_path, "ab") as images_file:
+            if not state or state["from"]:
+                # drop records written after the last checkpoint
+                images_file.truncate(state.get("offset", 0))
+            # else: the listing was complete, we were interrupted while sorting
+            for batch, mode, next_start in Image.get_image_names_API_batches(
+                config=config, session=other.session,
+                mode=state.get("mode", "allimages"), start=state.get("from", "!"),
+            ):
+                for line in batch:
+                    images_file.write(Image.format_image_line(line).encode("utf-8"))
+                images_file.flush()
+                checkpoint.update("api", {"mode": mode, "from": next_start, "offset": images_file.tell()})
+
+        if os.environ.get("WIKITEAM3_IMAGES_SORT", "1") != "0":
+            print("Sorting image filenames...")
+            sort_unique_lines(images_path)
+        with open(images_path, "a", encoding="utf-8") as images_file:
+            images_file.write("--END--\n")
+        checkpoint.remove()
+
+        images, _ = Image.load_image_names(images_path)
+        print("    Found %d images" % (len(images)))
+        print("Image metadata (images.txt) saved at:", images_path)
+        Image.check_image_names_asserts(
+            other=other, c_images=len(images),
+            c_images_size=sum(int_or_zero(image[3]) for image in images),
+        )
+        return images
+
+    @staticmethod
+    def check_image_names_asserts(other: OtherConfig, c_images: int, c_images_size: int):
         print(f"Estimated size of all images (images.txt): {c_images_size} bytes ({c_images_size/1024/1024/1024:.2f} GiB)")
 
         try:
-            assert len(images) <= other.assert_max_images if other.assert_max_images is not None else True
+            assert c_images <= other.assert_max_images if other.assert_max_images is not None else True
             print(f"--assert_max_images: {other.assert_max_images}, passed")
             assert c_images_size <= other.assert_max_images_bytes if other.assert_max_images_bytes is not None else True
             print(f"--assert_max_images_bytes: {other.assert_max_images_bytes}, passed")
-        except AssertionError:
+        except AssertionError as e:
             import traceback
             traceback.print_exc()
-            sys.exit(45)
+            raise AssertionsFailedError("--assert_max_images(_bytes) failed") from e
 
 
     @staticmethod
@@ -705,8 +770,7 @@ class Image:
             )
         else:
             print("ERROR: no index nor API")
-            sys.exit(1)
-            return # useless but linting is happy
+            raise DumpError("no index nor API")
 
         if url.startswith("//"):  # Orain wikifarm returns URLs starting with //
             url = "{}:{}".format(domainalone.split("://")[0], url)
@@ -1,6 +1,5 @@
 import os
 
-from wikiteam3.dumpgenerator.cli import Delay
 from wikiteam3.utils import remove_IP
 from wikiteam3.dumpgenerator.config import Config
 
@@ -19,7 +18,6 @@ def save_IndexPHP(config: Config, session):
         except Exception as e:
             print("Error: %s" % (e))
             return
-        Delay(config=config)
         raw = remove_IP(raw=raw)
         with open("%s/index.html" % (config.path), "w", encoding="utf-8") as outfile:
             outfile.write(raw)
@@ -1,13 +1,13 @@
 import json
 import os
-import sys
 from typing import Optional
 
 import requests
 
-from wikiteam3.dumpgenerator.cli import Delay
 from wikiteam3.dumpgenerator.api import get_JSON
+from wikiteam3.dumpgenerator.api.metadata_cache import cached_metadata
 from wikiteam3.dumpgenerator.config import Config, OtherConfig
+from wikiteam3.dumpgenerator.exceptions import AssertionsFailedError
 
 
 def save_siteinfo(config: Config, session: requests.Session):
@@ -22,7 +22,6 @@ def save_siteinfo(config: Config, session: requests.Session):
         "%s/siteinfo.json" % (config.path), "w", encoding="utf-8"
     ) as outfile:
         outfile.write(json.dumps(result, indent=4, sort_keys=True, ensure_ascii=False))
-    Delay(config=config)
 
 
 def assert_siteinfo(result, other: OtherConfig):
@@ -34,13 +33,21 @@ def assert_siteinfo(result, other: OtherConfig):
         assert stats["pages"] <= other.assert_max_pages if other.assert_max_pages is not None else True
         assert stats["images"] <= other.assert_max_images if other.assert_max_images is not None else True
         assert stats["edits"] <= other.assert_max_edits if other.assert_max_edits is not None else True
-    except AssertionError:
+    except AssertionError as e:
         import traceback
         traceback.print_exc()
-        sys.exit(45)
+        raise AssertionsFailedError("--assert_max_pages/edits/images failed") from e
 
 
 def get_siteinfo(config: Config, session: requests.Session):
+    """siteinfo of the wiki, fetched once per dump (see `cached_metadata()`)"""
+    return cached_metadata(
+        config, "siteinfo", lambda: _fetch_siteinfo(config, session),
+        valid=lambda result: "query" in result
+    )
+
+
+def _fetch_siteinfo(config: Config, session: requests.Session):
     assert config.api
 
     # MediaWiki 1.13+
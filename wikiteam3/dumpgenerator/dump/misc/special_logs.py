@@ -1,5 +1,4 @@
 from wikiteam3.dumpgenerator.config import Config
-from wikiteam3.dumpgenerator.cli import Delay
 
 def save_SpecialLog(config: Config, session=None):
     """Save Special:Log"""
@@ -20,4 +19,3 @@ def save_SpecialLog(config: Config, session=None):
     </select>
 """
     raise NotImplementedError() # TODO
-    Delay(config=config)
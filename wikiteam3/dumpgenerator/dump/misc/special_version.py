@@ -2,7 +2,6 @@ import os
 
 import requests
 
-from wikiteam3.dumpgenerator.cli import Delay
 from wikiteam3.utils import remove_IP
 from wikiteam3.dumpgenerator.config import Config
 
@@ -24,7 +23,6 @@ def save_SpecialVersion(config: Config, session: requests.Session):
             print("Error: %s" % (e))
             return
         raw = r.text
-        Delay(config=config)
         raw = remove_IP(raw=raw)
         with open(
             "%s/SpecialVersion.html" % (config.path), "w", encoding="utf-8"
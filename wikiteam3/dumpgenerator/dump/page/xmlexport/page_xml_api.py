@@ -8,9 +8,12 @@ import xml.dom.minidom as MD
 import requests
 
 from wikiteam3.dumpgenerator.api import handle_StatusCode
+from wikiteam3.dumpgenerator.api.limits import api_limit
 from wikiteam3.dumpgenerator.config import Config
 from wikiteam3.dumpgenerator.exceptions import PageMissingError, ExportAbortedError
 from wikiteam3.dumpgenerator.log import log_error
+from wikiteam3.utils.batch_size import BatchSize, get_batch_size
+from wikiteam3.utils.rate_limiter import BACKPRESSURE
 from wikiteam3.utils.util import underscore
 
 
@@ -92,28 +95,26 @@ def reconstructRevisions(root: ET.Element):
             raise e
     return page,edits
 
-def getXMLPageCoreWithApi(config: Config, session: requests.Session, params: Dict, headers: Optional[Dict]=None):
-    """  """
+def getXMLPageCoreWithApi(config: Config, session: requests.Session, params: Dict, headers: Optional[Dict]=None,
+                          batch: Optional[BatchSize]=None):
+    """ batch: the `rvlimit` controller, told about failures and (fast) successes """
     # just send the API request
     # if it fails, it will reduce params['rvlimit']
     xml = ''
     c = 0
-    maxseconds = 100  # max seconds to wait in a single sleeping
     maxretries = config.retries  # x retries and skip
-    increment = 20  # increment every retry
+    if batch is None and 'rvlimit' in params:
+        batch = BatchSize('rvlimit', initial=params['rvlimit'])
 
     while not re.search(r'</api>' if not config.curonly else r'</mediawiki>', xml) or re.search(r'</error>', xml):
         if c > 0 and c < maxretries:
-            wait = increment * c < maxseconds and increment * \
-                   c or maxseconds  # incremental until maxseconds
-            print('    In attempt %d, XML for "%s" is wrong. Waiting %d seconds and reloading...' % (
-            c, params['titles' if config.xmlapiexport else 'pages'], wait))
-            time.sleep(wait)
+            print('    In attempt %d, XML for "%s" is wrong. Backing off and reloading...' % (
+            c, params['titles' if config.xmlapiexport else 'pages']))
+            print('    Backed off for %.1f seconds' % BACKPRESSURE.backoff(config.api))
             # reducing server load requesting smallest chunks (if curonly then
             # rvlimit = 1 from mother function)
-            if params['rvlimit'] > 1:
-                rvlimit = int(params['rvlimit'] / 2)  # half
-                params['rvlimit'] = rvlimit if rvlimit > 1 else 1
+            if 'rvlimit' in params and batch is not None and batch.failure():
+                params['rvlimit'] = batch.value
             print('    We have retried %d times' % (c))
             print('    MediaWiki error for "%s", network error or whatever...' % (
             params['titles' if config.xmlapiexport else 'pages']))
@@ -133,9 +134,15 @@ def getXMLPageCoreWithApi(config: Config, session: requests.Session, params: Dic
 
         # FIXME HANDLE HTTP Errors HERE
         try:
+            t = time.monotonic()
             r = session.get(url=config.api, params=params, headers=headers)
             handle_StatusCode(r)
             xml = r.text
+            if batch is not None and 'rvlimit' in params and re.search(r'</api>', xml) and not re.search(r'</error>', xml):
+                if '<warnings>' in xml and 'truncated' in xml.split('<warnings>')[1].split('</warnings>')[0]:
+                    batch.failure()
+                else:
+                    batch.success(time.monotonic() - t)
             # print xml
         except requests.exceptions.ConnectionError as e:
             print('    Connection error: %s' % (str(e.args[0])))
@@ -157,6 +164,7 @@ def getXMLPageWithApi(config: Config, title="", verbose=True, *, session: reques
     # action=query&rvlimit=50&format=xml&prop=revisions&titles=TITLE_HERE
     # &rvprop=timestamp%7Cuser%7Ccomment%7Ccontent%7Cids%7Cuserid%7Csha1%7Csize
     # print 'current:%s' % (title_)
+    rvlimit = get_batch_size(config, config.api, 'rvlimit', initial=api_limit(config, content=True))
     if not config.curonly:
         params = {'titles': title_, 'action': 'query', 'format': 'xml',
                   'prop': 'revisions',
@@ -169,7 +177,7 @@ def getXMLPageWithApi(config: Config, title="", verbose=True, *, session: reques
                                 'contentmodel' # MW v1.21
                              ]),
                   'rvcontinue': None,
-                  'rvlimit': config.api_chunksize
+                  'rvlimit': rvlimit.value
                   }
     else:
         params = {'titles': title_, 'action': 'query', 'format': 'xml', 'export': 1, 'exportnowrap': 1}
@@ -189,7 +197,8 @@ def getXMLPageWithApi(config: Config, title="", verbose=True, *, session: reques
             if not firstpartok:
                 lastcontinue = params.get(continueKey, None) if continueKey is not None else None
 
-            xml = getXMLPageCoreWithApi(params=params, config=config, session=session)
+            params['rvlimit'] = rvlimit.value
+            xml = getXMLPageCoreWithApi(params=params, config=config, session=session, batch=rvlimit)
             if xml == "":
                 # just return so that we can continue, and getXMLPageCoreWithApi will log the error
                 return
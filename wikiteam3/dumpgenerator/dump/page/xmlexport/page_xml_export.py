@@ -1,28 +1,30 @@
 import os
 import re
-import sys
 import time
-from typing import Any, Dict, Generator
+from typing import Any, Dict, Generator, Optional
 
 import requests
 
-from wikiteam3.dumpgenerator.exceptions import ExportAbortedError, PageMissingError
+from wikiteam3.dumpgenerator.exceptions import DumpError, ExportAbortedError, PageMissingError
 from wikiteam3.dumpgenerator.api import handle_StatusCode
 from wikiteam3.dumpgenerator.log import log_error
 from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils.batch_size import BatchSize, get_batch_size
+from wikiteam3.utils.rate_limiter import BACKPRESSURE
 from wikiteam3.utils.util import underscore
 
 
 HISTORY_MIN_CHUNKSIZE = 2
 """ To loop over all the revisions, we need to retrieve at least 2 revisions at a time. """
-MAX_SECONDS = 100
-""" max seconds to wait in a single sleeping. """
 
-def getXMLPageCore(params: Dict, config: Config, session: requests.Session) -> str:
+def getXMLPageCore(params: Dict, config: Config, session: requests.Session,
+                   batch: Optional[BatchSize] = None) -> str:
     """
     returns a XML containing params['limit'] revisions (or current only), ending in </mediawiki>
     if retrieving params['limit'] revisions fails, returns a current only version
     if all fail, returns the empty string
+
+    batch: the `limit` controller, told about failures and (fast) successes
     """
     assert "pages" in params, "pages not in params"
     assert "limit" in params, "limit not in params"
@@ -30,31 +32,22 @@ def getXMLPageCore(params: Dict, config: Config, session: requests.Session) -> s
     xml = ""
     c = 0
     maxretries = config.retries  # x retries and skip
-    increment_delay = max(config.delay, 1.0)
+    if batch is None and params["limit"] > 1:
+        batch = BatchSize("limit", initial=params["limit"], minimum=HISTORY_MIN_CHUNKSIZE)
 
     while not re.search(r"</mediawiki>", xml):
         if c > 0 and (c < maxretries or params["limit"] > HISTORY_MIN_CHUNKSIZE):
-            delay = min(increment_delay * c, MAX_SECONDS) # incremental until MAX_SECONDS
             print(
-                f'    In attempt {c}, XML for "{params["pages"]}" is wrong. Waiting {delay} seconds and reloading...'
+                f'    In attempt {c}, XML for "{params["pages"]}" is wrong. Backing off and reloading...'
             )
-            time.sleep(delay)
+            print("    Backed off for %.1f seconds" % BACKPRESSURE.backoff(config.index))
             # reducing server load requesting smallest chunks (if curonly then
             # limit = 1 from mother function)
-            if params["limit"] > 1:
+            if params["limit"] > 1 and batch is not None:
+                batch.failure()
                 # NOTE: if limit is float and betwennt 0 to 1, the MW backend will force-int it to 0
-                new_limit: int = params["limit"] // 2  # half
-                if new_limit < HISTORY_MIN_CHUNKSIZE:
-                    new_limit = HISTORY_MIN_CHUNKSIZE
-
-                assert new_limit >= HISTORY_MIN_CHUNKSIZE, f"new_limit: {new_limit} < {HISTORY_MIN_CHUNKSIZE}"
-
-                # set new limit
-                if new_limit != params["limit"]:
-                    print(
-                        f'    Reducing the chunksize of revisions to retrieve from {params["limit"]} to {new_limit}'
-                    )
-                    params["limit"] = new_limit
+                params["limit"] = min(params["limit"], batch.value)
+                assert params["limit"] >= HISTORY_MIN_CHUNKSIZE, f'limit: {params["limit"]} < {HISTORY_MIN_CHUNKSIZE}'
         if c >= maxretries:
             print("    We have retried %d times" % (c))
             print(
@@ -63,7 +56,7 @@ def getXMLPageCore(params: Dict, config: Config, session: requests.Session) -> s
             )
             if config.failfast:
                 print("Exit, it will be for another time")
-                sys.exit(1)
+                raise DumpError(f'Export of "{params["pages"]}" failed (--failfast)')
             # If it's not already what we tried: our last chance, preserve only the last revision...
             # config.curonly means that the whole dump is configured to save only the last,
             # params['curonly'] should mean that we've already tried this
@@ -91,11 +84,14 @@ def getXMLPageCore(params: Dict, config: Config, session: requests.Session) -> s
                 return ""  # empty xml
         # FIXME HANDLE HTTP Errors HERE
         try:
+            t = time.monotonic()
             r = session.post(
                 url=config.index, params=params, timeout=120
             )
             handle_StatusCode(r)
             xml = r.text
+            if batch is not None and "curonly" not in params and re.search(r"</mediawiki>", xml):
+                batch.success(time.monotonic() - t)
         except requests.exceptions.ConnectionError as e:
             print("    Connection error: %s" % (str(e.args[0])))
             xml = ""
@@ -118,6 +114,7 @@ def getXMLPageWithExport(config: Config, title: str,
     # http://www.mediawiki.org/wiki/Manual_talk:Parameters_to_Special:Export#Parameters_no_longer_in_use.3F
 
     PARAM_LIMIT = int(os.getenv("PARAM_XML_LIMIT", 1000))
+    batch = get_batch_size(config, config.index, "limit", initial=PARAM_LIMIT, minimum=HISTORY_MIN_CHUNKSIZE)
     truncated = False
     title_ = underscore(title)
     # do not convert & into %26, title_ = re.sub('&', '%26', title_)
@@ -132,12 +129,12 @@ def getXMLPageWithExport(config: Config, title: str,
         params["limit"] = 1
     else:
         params["offset"] = "1"  # 1 always < 2000s
-        params["limit"] = PARAM_LIMIT
+        params["limit"] = batch.value
     # in other case, do not set params['templates']
     if config.templates:
         params["templates"] = 1
 
-    xml = getXMLPageCore(params=params, config=config, session=session)
+    xml = getXMLPageCore(params=params, config=config, session=session, batch=batch)
     if xml == "":
         raise ExportAbortedError(config.index)
     if "</page>" not in xml:
@@ -159,11 +156,12 @@ def getXMLPageWithExport(config: Config, title: str,
         while not truncated and params["offset"]:  # next chunk
             # get the last timestamp from the acum XML
             params["offset"] = re.findall(r_timestamp, xml)[-1]
+            params["limit"] = batch.value
             try:
-                xml2 = getXMLPageCore(params=params, config=config, session=session)
+                xml2 = getXMLPageCore(params=params, config=config, session=session, batch=batch)
             except MemoryError:
-                print("The page's history exceeds our memory, halving limit.")
-                params["limit"] = params["limit"] / 2
+                print("The page's history exceeds our memory, reducing limit.")
+                batch.failure()
                 continue
 
             # are there more edits in this next XML chunk or no <page></page>?
@@ -197,8 +195,8 @@ def getXMLPageWithExport(config: Config, title: str,
                             "<revision>".join(xml2.split("<revision>")[1:])
                         )
                     except MemoryError:
-                        "The page's history exceeds our memory, halving limit."
-                        params["limit"] = params["limit"] / 2
+                        print("The page's history exceeds our memory, reducing limit.")
+                        batch.failure()
                         continue
                     xml = xml2
                     edit_count += len(re.findall(r_timestamp, xml))
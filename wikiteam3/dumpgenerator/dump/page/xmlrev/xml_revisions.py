@@ -1,23 +1,27 @@
 from datetime import datetime
+import json
 import os
-import sys
 import time
-from typing import Dict, List, Optional
-from urllib.parse import urlparse
+from typing import Dict, List, Optional, Tuple
 import lxml.etree
 
 import mwclient
 import mwclient.errors
 import requests
 
-from wikiteam3.dumpgenerator.cli.delay import Delay
-from wikiteam3.dumpgenerator.exceptions import MWUnknownContentModelException, PageMissingError
+from wikiteam3.dumpgenerator.exceptions import DumpError, MWUnknownContentModelException, PageMissingError
 from wikiteam3.dumpgenerator.log import log_error
+from wikiteam3.dumpgenerator.api.continuation import Prefetcher
+from wikiteam3.dumpgenerator.api.limits import api_limit
+from wikiteam3.dumpgenerator.api.metadata_cache import get_site
 from wikiteam3.dumpgenerator.api.namespaces import getNamespacesAPI
 from wikiteam3.dumpgenerator.api.page_titles import read_titles
 from wikiteam3.dumpgenerator.dump.page.xmlrev.xml_revisions_page import \
     make_xml_from_page, make_xml_page_from_raw
 from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils.batch_size import get_batch_size, is_truncated_result
+from wikiteam3.utils.json_stream import READ_SIZE, JSONItemStream
+from wikiteam3.utils.rate_limiter import BACKPRESSURE
 from wikiteam3.utils.util import ALL_NAMESPACE_FLAG, XMLRIVISIONS_INCREMENTAL_DUMP_MARK, mark_as_done
 
 __ALL_NAMESPACE = -20241122
@@ -57,11 +61,13 @@ def getXMLRevisionsByAllRevisions(config: Config, session: requests.Session, sit
                 _nscontinue_input = None
 
         print("Trying to export all revisions from namespace %s" % namespace)
+        # curonly only lists the revision IDs, otherwise we ask for the content
+        arvlimit = get_batch_size(config, config.api, "arvlimit", initial=api_limit(config, content=not config.curonly))
         # arvgeneratexml exists but was deprecated in 1.26 (while arv is from 1.27?!)
         arv_params = {
             "action": "query",
             "list": "allrevisions",
-            "arvlimit": config.api_chunksize,
+            "arvlimit": arvlimit.value,
             "arvdir": "newer",
         }
         if namespace != __ALL_NAMESPACE:
@@ -77,27 +83,39 @@ def getXMLRevisionsByAllRevisions(config: Config, session: requests.Session, sit
             arv_params[
                 "arvprop"
             ] = ARV_PROP
+            if use_formatversion2(site):
+                # unescaped utf-8 and no pages keyed by id: smaller and faster to parse
+                arv_params.update(formatversion=2, utf8=1, arvslots="main")
             print(
                 "Trying to get wikitext from the allrevisions API and to build the XML"
             )
+            yielded = 0 # pages of the current batch already yielded, skipped if the batch is read again
+            batch_params: Dict = {} # exact params of the current batch
+            # the next batch is requested while the current one is read, a changed arvlimit doesn't matter
+            prefetcher = Prefetcher(
+                lambda params: stream_api_query(site, config.http_method, ("query", "allrevisions"), **params),
+                ignore=("arvlimit",), discard=lambda stream: stream.close(),
+            )
             while True:
                 print("[arvcontinue]:", arv_params.get("arvcontinue", ""))
                 try:
-                    allrevs_response = site.api(
-                        http_method=config.http_method, **arv_params
-                    )
+                    t = time.monotonic()
+                    if yielded:
+                        # read again with the same arvlimit: revisions are grouped by page within
+                        # a batch, so the pages to skip only match with the same batch
+                        allrevs_stream = stream_api_query(site, config.http_method, ("query", "allrevisions"), **batch_params)
+                    else:
+                        allrevs_stream = prefetcher.get(arv_params)
+                        batch_params = dict(prefetcher.fetched or arv_params)
                     # reset params if the response is OK
                     arv_params["arvprop"] = ARV_PROP
-                    if arv_params["arvlimit"] != config.api_chunksize:
-                        arv_params["arvlimit"] = min(arv_params["arvlimit"] * 2, config.api_chunksize)
-                        print(f"INFO: response is OK, increasing arvlimit to {arv_params['arvlimit']}")
                 except mwclient.errors.APIError as e:
                     if e.code == MWUnknownContentModelException.error_code:
-                        if arv_params['arvlimit'] != 1:
-                            # let's retry with arvlimit=1 to retrieve good revisions as much as possible
+                        if arvlimit.drop():
+                            # let's retry with arvlimit=1 to retrieve good revisions as much as possible,
+                            # arvlimit.success() grows it back step by step
                             print("WARNING: API returned MWUnknownContentModelException. retrying with arvlimit=1 (revision by revision)")
-                            arv_params["arvlimit"] = 1
-                            Delay(config=config)
+                            arv_params["arvlimit"] = arvlimit.value
                             continue
                         elif '|content' in arv_params["arvprop"]:
                             log_error(config=config, to_stdout=True,
@@ -106,7 +124,6 @@ def getXMLRevisionsByAllRevisions(config: Config, session: requests.Session, sit
                                 '(wikiteam3 would mark the revision as "<text deleted="deleted"> in the xmldump)'
                             )
                             arv_params["arvprop"] = ARV_PROP.replace('|content', '')
-                            Delay(config=config)
                             continue
                         else:
                             assert False, "This should not happen"
@@ -120,7 +137,6 @@ def getXMLRevisionsByAllRevisions(config: Config, session: requests.Session, sit
                     ):
                         print("POST request to the API failed, retrying with GET")
                         config.http_method = "GET"
-                        Delay(config=config)
                         continue
                     else:
                         raise
@@ -130,8 +146,10 @@ def getXMLRevisionsByAllRevisions(config: Config, session: requests.Session, sit
                     # TODO: reuse the retry logic of the checkAPI phase? Or force mwclient
                     # to use the retry adapter we use for our own requests session?
                     print(f"ERROR: {str(err)}")
-                    print("Sleeping for 20 seconds")
-                    time.sleep(20)
+                    print("Backed off for %.1f seconds" % BACKPRESSURE.backoff(config.api))
+                    if not yielded: # keep the same batch to skip what we already have
+                        arvlimit.failure()
+                        arv_params["arvlimit"] = arvlimit.value
                     continue
                 except mwclient.errors.InvalidResponse as e:
                     if (
@@ -140,18 +158,46 @@ def getXMLRevisionsByAllRevisions(config: Config, session: requests.Session, sit
                     ):
                         print("POST request to the API failed (got HTML), retrying with GET")
                         config.http_method = "GET"
-                        Delay(config=config)
                         continue
                     else:
                         raise
 
-                for page in allrevs_response["query"]["allrevisions"]:
-                    yield make_xml_from_page(page, arv_params.get("arvcontinue", ""))
+                # MediaWiki sends "continue" before "query", so we know the next batch already
+                next_arvcontinue = allrevs_stream.document.get("continue", {}).get("arvcontinue")
+                if next_arvcontinue is not None and next_arvcontinue != arv_params.get("arvcontinue"):
+                    prefetcher.submit({**arv_params, "arvcontinue": next_arvcontinue})
+
+                # pages are parsed and converted one by one, the batch is never fully in memory
+                try:
+                    for i, page in enumerate(allrevs_stream):
+                        if i < yielded:
+                            continue
+                        yield make_xml_from_page(page, arv_params.get("arvcontinue", ""))
+                        yielded += 1
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as err:
+                    allrevs_stream.close()
+                    print(f"ERROR: {str(err)} (while reading the batch, reading it again)")
+                    print("Backed off for %.1f seconds" % BACKPRESSURE.backoff(config.api))
+                    continue
+                except BaseException: # including GeneratorExit, the consumer stopped
+                    allrevs_stream.close()
+                    prefetcher.close()
+                    raise
+                allrevs_response = allrevs_stream.document
+                if is_truncated_result(allrevs_response):
+                    # still usable, the continuation covers the missing revisions
+                    arvlimit.failure()
+                    arv_params["arvlimit"] = arvlimit.value
+                else:
+                    arv_params["arvlimit"] = arvlimit.success(time.monotonic() - t)
+                yielded = 0
 
                 # find the continue parameter
                 if "continue" in allrevs_response:
                     # handle infinite loop
                     if arv_params.get("arvcontinue", None) == allrevs_response["continue"]["arvcontinue"]:
+                        assert allrevs_stream.count == 0, \
+                            "We should have received no revisions if we are stuck in a infinite loop"
                         allrevs_response = handle_infinite_loop(
                             allrevs_response=allrevs_response, arv_params=arv_params, config=config, site=site
                         )
@@ -159,6 +205,7 @@ def getXMLRevisionsByAllRevisions(config: Config, session: requests.Session, sit
                     arv_params["arvcontinue"] = allrevs_response["continue"]["arvcontinue"]
                 else:
                     # End of continuation. We are done with this namespace.
+                    prefetcher.close()
                     break
 
         else: # curonly
@@ -258,8 +305,7 @@ def getXMLRevisionsByAllRevisions(config: Config, session: requests.Session, sit
                     except requests.exceptions.ReadTimeout as err:
                         # As above
                         print(f"ERROR: {str(err)}")
-                        print("Sleeping for 20 seconds")
-                        time.sleep(20)
+                        print("Backed off for %.1f seconds" % BACKPRESSURE.backoff(config.api))
                         # But avoid rewriting the same revisions
                         allrevs_response["query"]["allrevisions"] = []
                         continue
@@ -316,6 +362,7 @@ def getXMLRevisionsByTitles(config: Config, session: requests.Session, site: mwc
         # The XML needs to be made manually because the export=1 option
         # refuses to return an arbitrary number of revisions (see above).
         print("Getting titles to export all the revisions of each")
+        rvlimit = get_batch_size(config, config.api, "rvlimit", initial=api_limit(config, content=True))
         c = 0
         titlelist = []
         # TODO: Decide a suitable number of a batched request. Careful:
@@ -329,11 +376,13 @@ def getXMLRevisionsByTitles(config: Config, session: requests.Session, site: mwc
                 "action": "query",
                 "titles": "|".join(titlelist),
                 "prop": "revisions",
-                'rvlimit': config.api_chunksize,
+                'rvlimit': rvlimit.value,
                 "rvprop": "ids|timestamp|user|userid|size|sha1|contentmodel|comment|content|flags",
             }
+            if use_formatversion2(site):
+                pparams.update(formatversion=2, utf8=1, rvslots="main")
             try:
-                api_response = site.api(http_method=config.http_method, **pparams)
+                api_stream = stream_api_query(site, config.http_method, ("query", "pages"), **pparams)
             except requests.exceptions.HTTPError as e:
                 if (
                         e.response.status_code == 405
@@ -341,9 +390,7 @@ def getXMLRevisionsByTitles(config: Config, session: requests.Session, site: mwc
                 ):
                     print("POST request to the API failed, retrying with GET")
                     config.http_method = "GET"
-                    api_response = site.api(
-                        http_method=config.http_method, **pparams
-                    )
+                    api_stream = stream_api_query(site, config.http_method, ("query", "pages"), **pparams)
                 else:
                     raise
             except mwclient.errors.InvalidResponse:
@@ -359,19 +406,17 @@ def getXMLRevisionsByTitles(config: Config, session: requests.Session, site: mwc
                 # Get the revision data returned by the API: prequest is the initial request
                 # or the new one after continuation at the bottom of this while loop.
                 # The array is called "pages" even if there's only one.
-                try:
-                    pages = api_response["query"]["pages"]
-                except KeyError:
+                if not api_stream.started:
                     log_error(
                         config=config, to_stdout=True,
                         text="Error: page inaccessible? Could not export page: %s"
                              % ("; ".join(titlelist)),
                     )
                     break
-                # Go through the data we got to build the XML.
-                for pageid in pages:
+                # Go through the data we got to build the XML, page by page.
+                for page in api_stream:
                     try:
-                        xml = make_xml_from_page(pages[pageid], None)
+                        xml = make_xml_from_page(page, None)
                         yield xml
                     except PageMissingError:
                         log_error(
@@ -381,6 +426,7 @@ def getXMLRevisionsByTitles(config: Config, session: requests.Session, site: mwc
                         )
                         continue
 
+                api_response = api_stream.document
                 # Get next batch of revisions if there's more.
                 if "continue" in api_response.keys():
                     print("Getting more revisions for the page")
@@ -393,9 +439,7 @@ def getXMLRevisionsByTitles(config: Config, session: requests.Session, site: mwc
                     break
 
                 try:
-                    api_response = site.api(
-                        http_method=config.http_method, **pparams
-                    )
+                    api_stream = stream_api_query(site, config.http_method, ("query", "pages"), **pparams)
                 except requests.exceptions.HTTPError as e:
                     if (
                             e.response.status_code == 405
@@ -403,9 +447,7 @@ def getXMLRevisionsByTitles(config: Config, session: requests.Session, site: mwc
                     ):
                         print("POST request to the API failed, retrying with GET")
                         config.http_method = "GET"
-                        api_response = site.api(
-                            http_method=config.http_method, **pparams
-                        )
+                        api_stream = stream_api_query(site, config.http_method, ("query", "pages"), **pparams)
 
             # We're done iterating for this title or titles.
             c += len(titlelist)
@@ -417,10 +459,8 @@ def getXMLRevisionsByTitles(config: Config, session: requests.Session, site: mwc
 
 def getXMLRevisions(config: Config, session: requests.Session, lastPage: Optional[lxml.etree._ElementTree]=None, useAllrevision=True):
     # FIXME: actually figure out the various strategies for each MediaWiki version
-    apiurl = urlparse(config.api)
-    site = mwclient.Site(
-        apiurl.netloc, apiurl.path.replace("api.php", ""), scheme=apiurl.scheme, pool=session
-    )
+    site = get_site(config.api, session, path=config.path)
+    site.api_limit = api_limit(config)
 
     if useAllrevision:
         # Find last title
@@ -452,12 +492,12 @@ def getXMLRevisions(config: Config, session: requests.Session, lastPage: Optiona
             print(e)
             # TODO: check whether the KeyError was really for a missing arv API
             print("Warning. Could not use allrevisions. Wiki too old? Try to use --xmlrevisions_page")
-            sys.exit(1)
+            raise DumpError("Could not use allrevisions, try --xmlrevisions_page") from e
     else:
         # Find last title
         if lastPage is not None:
             try:
-                start = lastPage.find('title') # type: ignore
+                start = lastPage.find('title').text # type: ignore
             except Exception:
                 print("Failed to find title in last trunk XML: %s" % (lxml.etree.tostring(lastPage)))
                 raise
@@ -472,7 +512,53 @@ def getXMLRevisions(config: Config, session: requests.Session, lastPage: Optiona
         except mwclient.errors.MwClientError as e:
             print(e)
             print("This mwclient version seems not to work for us. Exiting.")
-            sys.exit(1)
+            raise DumpError(f"mwclient error: {e}") from e
+
+
+FORMATVERSION2_MIN_MW = (1, 32)
+""" `formatversion=2` is MW 1.25+, but revision slots (`rvslots`) are MW 1.32+ """
+
+
+def use_formatversion2(site: mwclient.Site) -> bool:
+    """Whether to fetch revisions with `formatversion=2&utf8=1&rvslots=main` (else the legacy format)
+
+    $WIKITEAM3_FORMATVERSION=1 forces the legacy format.
+    """
+    if os.getenv("WIKITEAM3_FORMATVERSION", "") == "1":
+        return False
+    version = getattr(site, "version", None)
+    return bool(version) and tuple(version[:2]) >= FORMATVERSION2_MIN_MW
+
+
+def stream_api_query(site: mwclient.Site, http_method: str, items_path: Tuple[str, ...], **params) -> JSONItemStream:
+    """`site.api("query", ...)`, but the response is parsed incrementally
+
+    Iterating the returned stream yields the items at `items_path` (e.g. the pages of
+    `("query", "allrevisions")`) one by one, the rest of the response is in `stream.document`.
+    API errors are raised before any item is yielded, as `site.api()` does.
+    """
+    params.update(action="query", format="json")
+    params.setdefault("continue", "")
+    url = f"{site.scheme}://{site.host}{site.path}api{site.ext}"
+    sleeper = site.sleepers.make()
+    while True:
+        if http_method == "GET":
+            r = site.connection.get(url, params=params, stream=True, **site.requests)
+        else:
+            r = site.connection.post(url, data=params, stream=True, **site.requests)
+        r.raise_for_status()
+        stream = JSONItemStream(r.iter_content(READ_SIZE), items_path, on_close=r.close)
+        try:
+            stream.start()
+        except json.JSONDecodeError:
+            r.close()
+            if stream.head().startswith("MediaWiki API is not enabled for this site."):
+                raise mwclient.errors.APIDisabledError
+            raise mwclient.errors.InvalidResponse(stream.head())
+        # raises APIError, or returns False if we should retry (e.g. DB errors)
+        if stream.started or site.handle_api_result(stream.document, sleeper=sleeper):
+            return stream
+        r.close()
 
 
 def handle_infinite_loop(allrevs_response: Dict, arv_params: Dict, config: Config, site: mwclient.Site) -> Dict:
@@ -480,13 +566,11 @@ def handle_infinite_loop(allrevs_response: Dict, arv_params: Dict, config: Confi
     return new allrevs_response without arvprop=content|comment if the response is truncated
     """
 
-    assert len(allrevs_response["query"]["allrevisions"]) == 0, \
-        "We should have received no revisions if we are stuck in a infinite loop"
     print("WARNING: API returned continue parameter that doesn't change, we might be stuck in a loop")
     print(f"current continue parameter: {arv_params.get('arvcontinue')}")
     print(f"API warnings: {allrevs_response.get('warnings', {})}")
 
-    if "truncated" in allrevs_response.get("warnings",{}).get("result",{}).get("*",""):
+    if is_truncated_result(allrevs_response):
         # workaround for [truncated API response for "allrevisions" causes infinite loop ]
         # (https://github.com/mediawiki-client-tools/mediawiki-scraper/issues/166)
         print("Let's try to skip this revision and continue...")
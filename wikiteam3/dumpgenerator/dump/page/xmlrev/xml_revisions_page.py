@@ -26,9 +26,30 @@ def make_xml_page_from_raw(xml: str, arvcontinue: Optional[str] = None) -> str:
     return ET.tostring(page, encoding="unicode", method="xml", xml_declaration=False)
 
 
+def legacy_revision(rev: Dict) -> Dict:
+    """Convert a revision of a `formatversion=2` response (with `rvslots=main`) to the `formatversion=1` layout
+
+    - content is in `rev["*"]`, contentmodel/contentformat and the text flags at the revision level
+    - flags (minor, texthidden...) are "" when set and missing when not, instead of true/false
+    """
+    if "slots" in rev:
+        rev = dict(rev)
+        main: Dict = rev.pop("slots").get("main", {})
+        for key, value in main.items():
+            rev.setdefault("*" if key == "content" else key, value)
+    elif "content" in rev and "*" not in rev:
+        rev = dict(rev)
+        rev["*"] = rev.pop("content")
+    if any(isinstance(value, bool) for value in rev.values()):
+        rev = {key: "" if value is True else value for key, value in rev.items() if value is not False}
+    return rev
+
+
 def make_xml_from_page(page: Dict, arvcontinue: Optional[str] = None) -> str:
     """Output an XML document as a string from a page as in the API JSON
 
+    Both `formatversion=1` and `formatversion=2` (with `rvslots=main`) revisions are supported.
+
     arvcontinue: None -> disable arvcontinue (default)
     arvcontinue: string (including empty "") -> write arvcontinue to XML (for api:allrevisions resuming)
     """
@@ -41,6 +62,7 @@ def make_xml_from_page(page: Dict, arvcontinue: Optional[str] = None) -> str:
         if arvcontinue is not None:
             p.attrib['arvcontinue'] = arvcontinue
         for rev in page["revisions"]:
+            rev = legacy_revision(rev)
             # Older releases like MediaWiki 1.16 do not return all fields.
             if "userid" in rev:
                 userid = rev["userid"]
@@ -1,8 +1,9 @@
 
 import requests
 
+from wikiteam3.dumpgenerator.api.continuation import ContinuedQuery
+from wikiteam3.dumpgenerator.api.limits import api_limit
 from wikiteam3.dumpgenerator.api.namespaces import getNamespacesAPI
-from wikiteam3.dumpgenerator.cli.delay import Delay
 from wikiteam3.dumpgenerator.config import Config
 from wikiteam3.utils.util import ALL_NAMESPACE_FLAG
 
@@ -14,7 +15,7 @@ def get_redirects_by_allredirects(config: Config, session: requests.Session):
         "action": "query",
         "format": "json",
         "list": "allredirects",
-        "arlimit": config.api_chunksize,
+        "arlimit": api_limit(config),
         "arprop": "ids|title|fragment|interwiki",
         "ardir": "ascending",
         "continue": "" # DEV.md#Continuation
@@ -27,23 +28,16 @@ def get_redirects_by_allredirects(config: Config, session: requests.Session):
 
         print(f"Processing namespace {ns} ({namespacenames[ns] if ns in namespacenames else 'unknown'})")
         ar_params["arnamespace"] = str(ns)
-        while True:
-            Delay(config=config)
-            r = session.get(url=config.api, params=ar_params)
-            allredirects_response = r.json()
-
+        # the next batch is fetched while the current one is written
+        query = ContinuedQuery(lambda params: session.get(url=config.api, params=params).json(), dict(ar_params))
+        for allredirects_response in query:
             redirects = allredirects_response["query"]["allredirects"]
             for redirect in redirects:
                 yield redirect
 
-            if "continue" in allredirects_response:
-                continueKey = 'arcontinue'
-                # update continue parameter
-                ar_params[continueKey] = allredirects_response["continue"][continueKey]
-                print(f"  arcontinue={ar_params[continueKey]}")
-            else:
-                # End of continuation. We are done with this namespace.
-                break
+            if query.next_continue_params:
+                print(f"  arcontinue={query.next_continue_params.get('arcontinue')}")
+        # End of continuation. We are done with this namespace.
 
 # TODO: unit test
 if __name__ == "__main__":
@@ -51,7 +45,7 @@ if __name__ == "__main__":
         api="https://en.wikipedia.org/w/api.php",
         namespaces=[ALL_NAMESPACE_FLAG], # type: ignore
         redirects=True,
-        api_chunksize=500
+        api_highlimits=False
     )
     ss = requests.Session()
     for redirect in get_redirects_by_allredirects(config, ss):
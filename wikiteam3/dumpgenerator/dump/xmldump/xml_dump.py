@@ -1,14 +1,12 @@
 from io import TextIOWrapper
 import re
-import sys
 from typing import Optional
 
 import lxml.etree
 import requests
 
-from wikiteam3.dumpgenerator.cli import Delay
 from wikiteam3.utils import url2prefix_from_config
-from wikiteam3.dumpgenerator.exceptions import PageMissingError
+from wikiteam3.dumpgenerator.exceptions import DumpError, PageMissingError
 from wikiteam3.dumpgenerator.log import log_error
 from wikiteam3.dumpgenerator.api.page_titles import read_titles
 from wikiteam3.dumpgenerator.dump.page.xmlexport.page_xml import get_XML_page
@@ -23,17 +21,9 @@ def doXMLRevisionDump(config: Config, session: requests.Session, xmlfile: TextIO
                       lastPage: Optional[lxml.etree._ElementTree]=None, useAllrevisions: bool=False):
     try:
         r_timestamp = r"<timestamp>([^<]+)</timestamp>"
-        r_arvcontinue = r'<page arvcontinue="(.*?)">'
 
-        lastArvcontinue = None
         for xml in getXMLRevisions(config=config, session=session, lastPage=lastPage, useAllrevision=useAllrevisions):
             numrevs = len(re.findall(r_timestamp, xml))
-            arvcontinueRe = re.findall(r_arvcontinue, xml)
-            if arvcontinueRe:
-                curArvcontinue = arvcontinueRe[0]
-                if lastArvcontinue != curArvcontinue:
-                    Delay(config=config)
-                    lastArvcontinue = curArvcontinue
             # Due to how generators work, it's expected this may be less
             xml = clean_XML(xml=xml)
             xmlfile.write(xml)
@@ -42,11 +32,10 @@ def doXMLRevisionDump(config: Config, session: requests.Session, xmlfile: TextIO
             assert xmltitle, f"Failed to find title in XML: {xml}"
             title = undo_HTML_entities(text=xmltitle.group(1))
             print(f'{title}, {numrevs} edits')
-            # Delay(config=config)
     except AttributeError as e:
         print(e)
         print("This API library version is not working")
-        sys.exit(1)
+        raise DumpError(f"This API library version is not working: {e}") from e
     except UnicodeEncodeError as e:
         print(e)
 
@@ -55,7 +44,6 @@ def doXMLExportDump(config: Config, session: requests.Session, xmlfile: TextIOWr
         '\nRetrieving the XML for every page\n'
     )
 
-    lock = True
     start = None
     if lastPage is not None:
         try:
@@ -63,19 +51,10 @@ def doXMLExportDump(config: Config, session: requests.Session, xmlfile: TextIOWr
         except Exception:
             print("Failed to find title in last trunk XML: %s" % (lxml.etree.tostring(lastPage)))
             raise
-    else:
-        # requested complete xml dump
-        lock = False
 
     c = 1
+    # read_titles() seeks to `start` (included) with the title index
     for title in read_titles(config, session=session, start=start):
-        if not title:
-            continue
-        if title == start:  # start downloading from start, included
-            lock = False
-        if lock:
-            continue
-        Delay(config=config)
         if c % 10 == 0:
             print(f"\n->  Downloaded {c} pages\n")
         try:
@@ -125,7 +104,7 @@ def generate_XML_dump(config: Config, resume=False, *, session: requests.Session
             if lastPage is None:
                 print("Failed to parse last page chunk: \n%s" % lastPageChunk)
                 print("Cannot resume, exiting now!")
-                sys.exit(1)
+                raise DumpError("Cannot resume: failed to parse the last page chunk of the XML dump")
 
         print("WARNING: will try to start the download...")
         xmlfile = open(
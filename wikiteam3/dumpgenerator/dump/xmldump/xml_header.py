@@ -1,11 +1,10 @@
 import json
 import re
-import sys
 from typing import Tuple
 
 import requests
 
-from wikiteam3.dumpgenerator.exceptions import ExportAbortedError, PageMissingError
+from wikiteam3.dumpgenerator.exceptions import DumpError, ExportAbortedError, PageMissingError
 from wikiteam3.dumpgenerator.log import log_error
 from wikiteam3.dumpgenerator.dump.page.xmlexport.page_xml import get_XML_page
 from wikiteam3.dumpgenerator.config import Config
@@ -127,5 +126,5 @@ def getXMLHeader(config: Config, session: requests.Session) -> Tuple[str, Config
             print("XML export on this wiki is broken, quitting.")
             log_error(config=config, to_stdout=True,
                       text="XML export on this wiki is broken, quitting.")
-            sys.exit(1)
+            raise DumpError("XML export on this wiki is broken")
     return header, config
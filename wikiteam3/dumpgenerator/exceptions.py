@@ -55,3 +55,37 @@ class FileSha1Error(Exception):
 
     def __str__(self):
         return f"File '{self.file}' sha1 is not match '{self.excpected_sha1}'."
+
+
+class DumpError(Exception):
+    """ The dump can't go on. `exit_code` is the exit status of wikiteam3dumpgenerator for it """
+    exit_code = 1
+
+    def __init__(self, message: str = "", exit_code: Optional[int] = None):
+        super().__init__(message)
+        if exit_code is not None:
+            self.exit_code = exit_code
+
+
+class WikiEngineFound(DumpError):
+    """ --get-wiki-engine: there is nothing to dump, `engine` is the answer """
+    exit_code = 0
+
+    def __init__(self, engine: str):
+        super().__init__(engine)
+        self.engine = engine
+
+
+class WikiAvoidedError(DumpError):
+    """ Wikimedia projects (2), robots.txt disallows wikiteam3 (20) """
+    exit_code = 2
+
+
+class AssertionsFailedError(DumpError):
+    """ --assert_max_* """
+    exit_code = 45
+
+
+class RecentDumpExistsError(DumpError):
+    """ A dump of the wiki was uploaded to IA recently (use --force) """
+    exit_code = 88
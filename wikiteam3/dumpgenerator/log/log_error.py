@@ -1,13 +1,15 @@
 import datetime
 
 from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils.phases import current_phase
 
 def log_error(config: Config, to_stdout=False , text="") -> None:
     """Log error in errors.log"""
     if text:
         with open(f"{config.path}/errors.log", "a", encoding="utf-8") as outfile:
-            output = "{}: {}\n".format(
+            output = "{}: {}{}\n".format(
                 datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                f"[{phase}] " if (phase := current_phase()) else "",
                 text,
             )
             outfile.write(output)
@@ -0,0 +1,149 @@
+import math
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+from wikiteam3.uploader.socketLock import SocketLockServer
+
+SLOT_BYTES = 1024 ** 3
+""" memory represented by one compression slot (1 GiB) """
+SLOTS_DIR = Path(os.getenv("WIKITEAM3_SLOTS_DIR") or Path(tempfile.gettempdir()) / "wikiteam3-compress-slots")
+""" lock files shared by the uploader processes of the host """
+DEFAULT_MEMORY_FRACTION = 0.75
+""" share of the RAM the compressions may use when --compress-slots is not given """
+
+
+def physical_memory() -> Optional[int]:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_slots() -> int:
+    """`DEFAULT_MEMORY_FRACTION` of the RAM, in slots (1 if unknown)"""
+    memory = physical_memory()
+    if not memory:
+        return 1
+    return max(1, int(memory * DEFAULT_MEMORY_FRACTION) // SLOT_BYTES)
+
+
+def zstd_memory(level: int, long_level: int, src_size: Optional[int] = None) -> int:
+    """Rough memory need of `zstd -{level} --long={long_level}` (bytes), with the round trip check
+    of `ZstdCompressor.compress_file_digests()`
+
+    The window is the `--long` one (or the default one of the level), capped to the input size.
+    Compression tables add ~1/4 of the window, ultra levels (20+) ~4 times the window,
+    the checking decompressor needs one window.
+    e.g. -17 --long=31: 4.5 GiB, --ultra -22 --long=31: 12 GiB
+    """
+    window_log = long_level if long_level else (23 if level <= 19 else level + 5)
+    window = 2 ** window_log
+    if src_size is not None:
+        window = min(window, max(2 ** 20, src_size))
+    return int(window * (1.25 if level <= 19 else 5)) + window
+
+
+def sevenzip_memory(level: int) -> int:
+    """Rough memory need of `SevenZipCompressor.compress_dir(level)` (bytes), lzma2 -md=64m needs ~11x the dictionary"""
+    return 64 * 1024 ** 2 * 11 if level else 256 * 1024 ** 2
+
+
+class CompressSlots:
+    """
+    Counting semaphore shared by the processes (and threads) of the host, so several
+    compressions run at the same time as long as their estimated memory fits.
+
+    `capacity` slots of `SLOT_BYTES`, a compression holds as many slots as its memory need
+    (at most `capacity`, so a too large one runs alone). None: no limit (--parallel).
+
+    Every slot is a lock file in `SLOTS_DIR` held with flock(), waiters block in the kernel.
+    Acquirers take a gate lock first, so partially acquired slots can't deadlock.
+    Processes sharing the slots should use the same capacity.
+    Without fcntl (Windows), compressions are serialized with `SocketLockServer`.
+    """
+
+    def __init__(self, capacity: Optional[int], slots_dir: Union[str, Path] = SLOTS_DIR):
+        assert capacity is None or capacity >= 1
+        self.capacity = capacity
+        self.slots_dir = Path(slots_dir)
+
+    def weight(self, memory: int) -> int:
+        assert self.capacity is not None
+        return min(self.capacity, max(1, math.ceil(memory / SLOT_BYTES)))
+
+    def _open(self, name: str) -> int:
+        return os.open(self.slots_dir / name, os.O_RDWR | os.O_CREAT, 0o666)
+
+    def acquire(self, weight: int) -> List[int]:
+        """Blocks until `weight` slots are held, returns their fds (see `release()`)"""
+        assert fcntl is not None and self.capacity is not None
+        self.slots_dir.mkdir(parents=True, exist_ok=True)
+        gate = self._open("gate.lock")
+        held: Dict[int, int] = {} # slot: fd
+        try:
+            fcntl.flock(gate, fcntl.LOCK_EX)
+            blocking, waiting = False, False
+            while len(held) < weight:
+                for i in range(self.capacity):
+                    if len(held) == weight:
+                        break
+                    if i in held:
+                        continue
+                    fd = self._open(f"slot-{i}.lock")
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        os.close(fd)
+                        continue
+                    except BaseException:
+                        os.close(fd)
+                        raise
+                    held[i] = fd
+                    if blocking:
+                        break # a slot was released, others may be free too
+                if len(held) < weight and not waiting:
+                    print(f"Waiting for {weight - len(held)} more compression slots (--compress-slots {self.capacity})...")
+                    waiting = True
+                # we are the only acquirer (gate): wait for a busy slot to be released, then sweep again
+                blocking = not blocking
+        except BaseException:
+            self.release(list(held.values()))
+            raise
+        finally:
+            os.close(gate) # releases the gate
+        return list(held.values())
+
+    @staticmethod
+    def release(fds: List[int]):
+        for fd in fds:
+            os.close(fd) # releases the flock
+
+    @contextmanager
+    def hold(self, memory: int, what: str = "compression"):
+        """Holds the slots of a compression needing `memory` bytes while in this context"""
+        if self.capacity is None:
+            yield
+            return
+        if fcntl is None:
+            lock = SocketLockServer()
+            with lock:
+                try:
+                    yield
+                finally:
+                    lock.release()
+            return
+        weight = self.weight(memory)
+        fds = self.acquire(weight)
+        print(f"{what}: holding {weight}/{self.capacity} compression slots (~{memory / SLOT_BYTES:.1f} GiB)")
+        try:
+            yield
+        finally:
+            self.release(fds)
@@ -3,10 +3,13 @@ import os
 from pathlib import Path
 import subprocess
 import sys
+import threading
 import time
-from typing import Tuple, Union
+from typing import List, Optional, Tuple, Union
 import warnings
 
+from wikiteam3.uploader.manifest import READ_SIZE, FileDigests, Hasher
+
 
 class ZstdCompressor:
     DEFAULT_LEVEL = 17
@@ -45,10 +48,21 @@ class ZstdCompressor:
         assert len(ret_versions) == 3
         return tuple(ret_versions) # type: ignore
 
-    def compress_file(self, path: Union[str, Path], *, level: int = DEFAULT_LEVEL, long_level: int = 31) -> Path:
-        ''' Compress path into path.zst and return the absolute path to the compressed file.
+    def compress_file(self, path: Union[str, Path], *, level: int = DEFAULT_LEVEL, long_level: int = 31,
+                      threads: int = 0) -> Path:
+        ''' Compress path into path.zst and return the absolute path to the compressed file, see `compress_file_digests()` '''
+        return self.compress_file_digests(path, level=level, long_level=long_level, threads=threads)[0]
+
+    def compress_file_digests(self, path: Union[str, Path], *, level: int = DEFAULT_LEVEL, long_level: int = 31,
+                              threads: int = 0) -> Tuple[Path, Optional[FileDigests]]:
+        ''' Compress path into path.zst, return the absolute path to the compressed file and its digests
+        (None if it already existed).
 
-        we set -T0 to use all cores
+        The source is read once: it is hashed while piped to zstd, whose output is hashed while
+        written and piped to `zstd -d`, so the round trip is verified without reading the file again
+        (`FileDigests.verified`, not with --rezstd).
+
+        threads: -T, 0 (default) to use all cores
 
         level:
             - 1 -> fast
@@ -74,16 +88,16 @@ class ZstdCompressor:
 
         if compressed_path.exists():
             print(f"File {compressed_path} already exists. Skip compressing.")
-            return compressed_path
+            return compressed_path, None
 
-        cmd =  [self.bin_zstd, "-T0","-v", "--compress", "--force"]
+        cmd =  [self.bin_zstd, f"-T{threads}","-v", "--compress"]
         if level >= 20:
             cmd.append("--ultra")
         if long_level:
             cmd.append(f"--long={long_level}")
-        cmd.extend([f"-{level}", str(path), "-o", str(compressing_temp_path)])
+        cmd.extend([f"-{level}", f"--stream-size={path.stat().st_size}", "-c", "-"])
 
-        subprocess.run(cmd)
+        digests = self._compress_stream(cmd, path, compressing_temp_path, long_level)
         assert compressing_temp_path.exists()
         if self.rezstd:
             pre_compressing_temp_path = compressing_temp_path # alias
@@ -137,6 +151,7 @@ class ZstdCompressor:
                   "(only available for a few days)")
             r = session.get(self.rezstd_endpoint + f"download/{task_id}/wikiteam3_task.zst", stream=True)
             content_length = int(r.headers["Content-Length"])
+            rezstded = Hasher()
             with open(compressing_rezstded_temp_path, "wb") as f:
                 written = 0
                 last_report_time = time.time()
@@ -145,8 +160,12 @@ class ZstdCompressor:
                         print(f"Downloaded {written/1024/1024:.2f}/{content_length/1024/1024:.2f} MB", end="\r")
                         last_report_time = time.time()
                     f.write(chunk)
+                    rezstded.update(chunk)
                     written += len(chunk)
             print()
+            # not verified, the server compressed it
+            digests = FileDigests(size=rezstded.size, md5=rezstded.md5, sha1=rezstded.sha1,
+                                  source_size=digests.source_size, source_sha1=digests.source_sha1)
             # print("Download finished, deleting from server...")
             # r = session.delete(self.rezstd_endpoint + f"delete/{task_id}")
             # print(r.text)
@@ -155,7 +174,65 @@ class ZstdCompressor:
 
         # move tmp file to final file
         os.rename(compressing_temp_path, compressed_path)
-        return compressed_path
+        return compressed_path, digests
+
+    def _compress_stream(self, cmd: List[str], path: Path, output_path: Path, long_level: int) -> FileDigests:
+        """Runs the compression `cmd` (stdin to stdout) on `path` into `output_path`, see `compress_file_digests()`"""
+        source, output, roundtrip = Hasher(), Hasher(), Hasher()
+        compress = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        check = subprocess.Popen([self.bin_zstd, "-q", "-d", f"--long={long_level or 27}", "-c", "-"],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        assert compress.stdin and compress.stdout and check.stdin and check.stdout
+        errors: List[BaseException] = []
+
+        def feed():
+            try:
+                with open(path, "rb") as f:
+                    while chunk := f.read(READ_SIZE):
+                        source.update(chunk)
+                        compress.stdin.write(chunk) # type: ignore
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                compress.stdin.close() # type: ignore
+
+        def drain_check():
+            try:
+                while chunk := check.stdout.read(READ_SIZE): # type: ignore
+                    roundtrip.update(chunk)
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=feed, daemon=True), threading.Thread(target=drain_check, daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            with open(output_path, "wb") as f:
+                while chunk := compress.stdout.read(READ_SIZE):
+                    f.write(chunk)
+                    output.update(chunk)
+                    check.stdin.write(chunk)
+        except BaseException:
+            compress.kill() # unblocks feed()
+            check.kill()
+            raise
+        finally:
+            try:
+                check.stdin.close()
+            except BrokenPipeError:
+                pass
+            for thread in threads:
+                thread.join()
+            compress.wait()
+            check.wait()
+        if errors:
+            raise errors[0]
+        if compress.returncode or check.returncode:
+            raise RuntimeError(f"zstd failed on {path}: exit codes {compress.returncode} (compress), {check.returncode} (check)")
+        if (roundtrip.size, roundtrip.sha1) != (source.size, source.sha1):
+            raise RuntimeError(f"zstd round trip of {path} doesn't match the source")
+        return FileDigests(size=output.size, md5=output.md5, sha1=output.sha1,
+                           source_size=source.size, source_sha1=source.sha1, verified=True)
 
     def test_integrity(self, path: Union[str, Path]) -> bool:
         ''' Test if path is a valid zstd compressed file. '''
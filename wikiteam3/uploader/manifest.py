@@ -0,0 +1,86 @@
+import dataclasses
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+from wikiteam3.utils.checkpoint import Checkpoint
+
+MANIFEST_FILENAME = "upload_manifest.json"
+READ_SIZE = 1024 * 1024
+
+
+@dataclasses.dataclass
+class FileDigests:
+    size: int
+    md5: str
+    sha1: str
+    source_size: Optional[int] = None
+    """ of the compressed file """
+    source_sha1: Optional[str] = None
+    verified: bool = False
+    """ the artifact decompresses to its source (zstd round trip) or passed `test_integrity()` """
+
+
+class Hasher:
+    """md5 and sha1 of a stream, updated chunk by chunk"""
+
+    def __init__(self):
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._sha1 = hashlib.sha1()
+
+    def update(self, chunk: bytes):
+        self.size += len(chunk)
+        self._md5.update(chunk)
+        self._sha1.update(chunk)
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    @property
+    def sha1(self) -> str:
+        return self._sha1.hexdigest()
+
+
+def hash_file(path: Union[str, Path]) -> Hasher:
+    hasher = Hasher()
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_SIZE):
+            hasher.update(chunk)
+    return hasher
+
+
+class Manifest:
+    """
+    Digests of the artifacts of a wikidump dir (`MANIFEST_FILENAME`), computed while they are
+    written, so resuming an upload doesn't test or hash them again.
+
+    An entry is only valid while the file keeps the size and mtime it had when recorded.
+    """
+
+    def __init__(self, wikidump_dir: Union[str, Path]):
+        self.checkpoint = Checkpoint(os.path.join(wikidump_dir, MANIFEST_FILENAME))
+
+    @staticmethod
+    def _stat(path: Path) -> Tuple[int, int]:
+        st = path.stat()
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, path: Union[str, Path]) -> Optional[FileDigests]:
+        path = Path(path)
+        entry = self.checkpoint.get(path.name)
+        if entry is None or not path.exists():
+            return None
+        if (entry["size"], entry["mtime_ns"]) != self._stat(path):
+            print(f"{path.name} changed since its digests were recorded")
+            return None
+        fields = {field.name for field in dataclasses.fields(FileDigests)}
+        return FileDigests(**{k: v for k, v in entry.items() if k in fields})
+
+    def put(self, path: Union[str, Path], digests: FileDigests):
+        path = Path(path)
+        size, mtime_ns = self._stat(path)
+        assert size == digests.size, f"{path}: {size} bytes on disk, {digests.size} hashed"
+        self.checkpoint.update(path.name, dict(dataclasses.asdict(digests), mtime_ns=mtime_ns))
@@ -0,0 +1,269 @@
+import base64
+import hashlib
+import math
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+from xml.etree import ElementTree
+
+import requests
+from internetarchive.auth import S3Auth
+from internetarchive.iarequest import S3Request
+
+from wikiteam3.utils.checkpoint import Checkpoint
+
+S3_ENDPOINT = "https://s3.us.archive.org"
+UPLOAD_STATE_FILENAME = "upload_state.json"
+PART_SIZE = int(os.getenv("WIKITEAM3_S3_PART_SIZE", str(64 * 1024 ** 2)))
+""" bytes, raised for files of more than `MAX_PARTS` parts """
+MULTIPART_THRESHOLD = int(os.getenv("WIKITEAM3_S3_MULTIPART_THRESHOLD", str(256 * 1024 ** 2)))
+""" files larger than this are sent in parts """
+UPLOAD_WORKERS = int(os.getenv("WIKITEAM3_S3_WORKERS", "4"))
+""" parts of a file (and small files) sent at the same time """
+PART_RETRIES = 6
+MAX_PARTS = 10000
+TIMEOUT = 300
+
+
+class S3Error(Exception):
+    def __init__(self, r: requests.Response):
+        self.status_code = r.status_code
+        self.text = r.text
+
+    def __str__(self):
+        return f"IA S3 error: HTTP {self.status_code}: {self.text[:1000]}"
+
+
+class S3ChecksumError(Exception):
+    def __init__(self, remote: str, etag: str, expected: str):
+        self.remote = remote
+        self.etag = etag
+        self.expected = expected
+
+    def __str__(self):
+        return f"'{self.remote}' was corrupted during its upload: ETag {self.etag}, expected {self.expected}"
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, S3Error):
+        # BadDigest: the part was corrupted on its way, it is sent again from memory
+        return e.status_code == 429 or e.status_code >= 500 or (e.status_code == 400 and "BadDigest" in e.text)
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _check(r: requests.Response) -> requests.Response:
+    # S3 may answer an error in a 200 response of a multipart completion
+    if r.status_code >= 300 or r.content.lstrip().startswith(b"<Error"):
+        raise S3Error(r)
+    return r
+
+
+def _multipart_etag(md5s: List[str]) -> str:
+    """ETag of a completed multipart upload: MD5 of the (binary) MD5s of its parts, and the part count"""
+    digest = hashlib.md5(b"".join(bytes.fromhex(md5) for md5 in md5s)).hexdigest()
+    return f"{digest}-{len(md5s)}"
+
+
+def _find(xml: bytes, tag: str) -> Optional[str]:
+    """Text of the first `tag` element of an S3 XML answer, with or without namespace"""
+    for element in ElementTree.fromstring(xml).iter():
+        if element.tag == tag or element.tag.endswith("}" + tag):
+            return element.text
+    return None
+
+
+class S3Uploader:
+    """
+    Upload engine for one IA item, using the IA S3 API (`endpoint`).
+
+    Files larger than `multipart_threshold` are sent with S3 multipart uploads, `workers` parts
+    at a time, every part is retried on its own. The upload id and the ETags of the sent parts
+    are kept in `state_path`, so an interrupted upload only sends the missing parts.
+    Every part is sent with its Content-MD5, and the ETag of the completed upload is checked
+    against the MD5s of the parts.
+    Smaller files are sent with a single PUT. `upload()` is thread-safe, call it from several
+    threads to send files in parallel. The first file creates the item (bucket), the others wait for it.
+    """
+
+    def __init__(self, identifier: str, access_key: str, secret_key: str, metadata: Dict, *,
+                 state_path: Union[str, Path], endpoint: str = S3_ENDPOINT, bucket_exists: bool = False,
+                 workers: int = UPLOAD_WORKERS, part_size: int = PART_SIZE,
+                 multipart_threshold: int = MULTIPART_THRESHOLD,
+                 session: Optional[requests.Session] = None):
+        self.identifier = identifier
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.metadata = metadata
+        self.endpoint = endpoint.rstrip("/")
+        self.workers = workers
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.session = session or requests.Session()
+        self.state = Checkpoint(str(state_path))
+        self._bucket_lock = threading.Lock()
+        self._bucket_ready = bucket_exists
+
+    def url(self, remote: str) -> str:
+        return f"{self.endpoint}/{self.identifier}/{urllib.parse.quote(remote, safe='/')}"
+
+    def _item_request(self, method: str, url: str, headers: Dict, **kwargs) -> requests.PreparedRequest:
+        """A request creating the item if needed, with its metadata (x-archive-meta-* headers)"""
+        return S3Request(
+            method=method, url=url, headers=headers, metadata=dict(self.metadata), queue_derive=False,
+            access_key=self.access_key, secret_key=self.secret_key, **kwargs,
+        ).prepare()
+
+    def _retry(self, what: str, func):
+        for attempt in range(PART_RETRIES):
+            try:
+                return func()
+            except Exception as e:
+                if not _retryable(e) or attempt == PART_RETRIES - 1:
+                    raise
+                delay = min(60, 2 ** attempt)
+                print(f"    {what}: {e}, retrying in {delay}s")
+                time.sleep(delay)
+
+    def upload(self, remote: str, local: Union[str, Path], md5: Optional[str] = None):
+        """Upload `local` as `remote`, `md5` (hex) is checked by IA for single PUTs
+        (multipart uploads check their parts, see `complete()`)"""
+        with self._bucket_lock:
+            if not self._bucket_ready:
+                # the first upload creates the item alone
+                self._upload(remote, Path(local), md5)
+                self._bucket_ready = True
+                return
+        self._upload(remote, Path(local), md5)
+
+    def _upload(self, remote: str, local: Path, md5: Optional[str]):
+        size = local.stat().st_size
+        if size > self.multipart_threshold:
+            self.multipart_upload(remote, local)
+        else:
+            self.put(remote, local, md5)
+        print(f'    "{remote}" uploaded ({size} bytes)')
+
+    def put(self, remote: str, local: Path, md5: Optional[str] = None):
+        headers = {"x-archive-size-hint": str(local.stat().st_size)}
+        if md5:
+            headers["Content-MD5"] = base64.b64encode(bytes.fromhex(md5)).decode()
+
+        def put():
+            with open(local, "rb") as f:
+                request = self._item_request("PUT", self.url(remote), dict(headers), data=f)
+                _check(self.session.send(request, timeout=TIMEOUT))
+        self._retry(remote, put)
+
+    def multipart_upload(self, remote: str, local: Path):
+        st = local.stat()
+        state = self.state.get(remote)
+        if state and (state["size"], state["mtime_ns"]) != (st.st_size, st.st_mtime_ns):
+            print(f'    "{remote}" changed since its upload started, starting over')
+            self.abort(remote, state["upload_id"])
+            state = None
+        if state is None:
+            state = self.initiate(remote, local)
+        else:
+            print(f'    "{remote}": resuming multipart upload ({len(state["parts"])}/{state["part_count"]} parts sent)')
+
+        lock = threading.Lock()
+        state.setdefault("md5s", {}) # not kept by older versions
+
+        def send_part(number: int):
+            offset = (number - 1) * state["part_size"]
+            with open(local, "rb") as f:
+                f.seek(offset)
+                data = f.read(state["part_size"])
+            md5 = hashlib.md5(data)
+
+            def put_part():
+                r = _check(self.session.put(
+                    self.url(remote), params={"partNumber": number, "uploadId": state["upload_id"]},
+                    data=data, headers={"Content-MD5": base64.b64encode(md5.digest()).decode()},
+                    auth=S3Auth(self.access_key, self.secret_key), timeout=TIMEOUT,
+                ))
+                return r.headers["ETag"]
+            etag = self._retry(f"{remote} part {number}", put_part)
+            with lock:
+                state["parts"][str(number)] = etag
+                state["md5s"][str(number)] = md5.hexdigest()
+                self.state.update(remote, state)
+                print(f'    "{remote}": {len(state["parts"])}/{state["part_count"]} parts sent', end="\r")
+
+        missing = [n for n in range(1, state["part_count"] + 1) if str(n) not in state["parts"]]
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="s3-part") as executor:
+                futures = [executor.submit(send_part, n) for n in missing]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    for future in futures:
+                        future.cancel() # the parts not sent yet, the state keeps the others
+                    raise
+        except S3Error as e:
+            if e.status_code == 404 and "NoSuchUpload" in e.text:
+                print(f'    "{remote}": the multipart upload expired, starting over')
+                self.state.update(remote, None)
+                return self.multipart_upload(remote, local)
+            raise
+        print()
+        self.complete(remote, state)
+
+    def initiate(self, remote: str, local: Path) -> Dict:
+        st = local.stat()
+        part_size = max(self.part_size, math.ceil(st.st_size / MAX_PARTS))
+        headers = {"x-archive-size-hint": str(st.st_size)}
+
+        def initiate():
+            request = self._item_request("POST", self.url(remote) + "?uploads", dict(headers))
+            return _check(self.session.send(request, timeout=TIMEOUT))
+        r = self._retry(f"{remote} (initiate multipart upload)", initiate)
+        upload_id = _find(r.content, "UploadId")
+        assert upload_id, f"No UploadId in {r.text}"
+        state = {
+            "upload_id": upload_id,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "part_size": part_size,
+            "part_count": max(1, math.ceil(st.st_size / part_size)),
+            "parts": {},
+            "md5s": {},
+        }
+        self.state.update(remote, state)
+        return state
+
+    def complete(self, remote: str, state: Dict):
+        """Complete the multipart upload, then check its ETag if IA answers one and
+        the MD5s of all the parts are known. raises: `S3ChecksumError` on mismatch"""
+        parts = "".join(
+            f"<Part><PartNumber>{n}</PartNumber><ETag>{state['parts'][str(n)]}</ETag></Part>"
+            for n in range(1, state["part_count"] + 1)
+        )
+        body = f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode()
+
+        def complete():
+            return _check(self.session.post(
+                self.url(remote), params={"uploadId": state["upload_id"]}, data=body,
+                auth=S3Auth(self.access_key, self.secret_key), timeout=TIMEOUT,
+            ))
+        r = self._retry(f"{remote} (complete multipart upload)", complete)
+        self.state.update(remote, None)
+        etag = _find(r.content, "ETag")
+        md5s = state.get("md5s", {})
+        if etag and len(md5s) == state["part_count"]:
+            expected = _multipart_etag([md5s[str(n)] for n in range(1, state["part_count"] + 1)])
+            if etag.strip('"') != expected:
+                raise S3ChecksumError(remote, etag, expected)
+
+    def abort(self, remote: str, upload_id: str):
+        try:
+            self.session.delete(self.url(remote), params={"uploadId": upload_id},
+                                auth=S3Auth(self.access_key, self.secret_key), timeout=TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f"    Failed to abort the multipart upload of {remote}: {e}")
+        self.state.update(remote, None)
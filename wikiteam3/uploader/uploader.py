@@ -9,8 +9,9 @@ from dataclasses import dataclass
 import sys
 import time
 import traceback
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 import urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from io import BytesIO
 from pathlib import Path
 
@@ -21,14 +22,20 @@ from file_read_backwards import FileReadBackwards
 from wikiteam3.dumpgenerator.api.page_titles import checkTitleOk
 from wikiteam3.dumpgenerator.config import Config, load_config
 from wikiteam3.dumpgenerator.version import getVersion
-from wikiteam3.uploader.socketLock import NoLock, SocketLockServer
 from wikiteam3.utils import url2prefix_from_config, sha1sum
 from wikiteam3.uploader.compresser import ZstdCompressor, SevenZipCompressor
+from wikiteam3.uploader.compress_slots import CompressSlots, default_slots, sevenzip_memory, zstd_memory
+from wikiteam3.uploader.manifest import FileDigests, Manifest, hash_file
+from wikiteam3.uploader.s3_upload import S3_ENDPOINT, UPLOAD_STATE_FILENAME, UPLOAD_WORKERS, S3Uploader
 from wikiteam3.utils.ia_checker import ia_s3_tasks_load_avg
 from wikiteam3.utils.util import ALL_DUMPED_MARK, UPLOADED_MARK, XMLRIVISIONS_INCREMENTAL_DUMP_MARK, is_empty_dir, mark_as_done, is_markfile_exists
 
 DEFAULT_COLLECTION = 'opensource'
 IDENTIFIER_PREFIX = "wiki-"
+COMPRESS_WORKERS = int(os.getenv("WIKITEAM3_COMPRESS_WORKERS", "4"))
+""" artifacts compressed at the same time by one upload (the XML uses all the cores, the small files one each) """
+SMALL_FILE_SIZE = 64 * 1024 ** 2
+""" files not in the manifest up to this size are hashed to be compared with IA's md5 """
 
 @dataclass
 class IAKeys:
@@ -47,10 +54,13 @@ class Args:
     zstd_level: int
     bin_7z: str
     parallel: bool
+    compress_slots: Optional[int]
 
     rezstd: bool
     rezstd_endpoint: str
 
+    s3_endpoint: str
+
     def __post_init__(self):
         self.keys_file = Path(self.keys_file).expanduser().resolve()
         if not self.keys_file.exists():
@@ -115,7 +125,44 @@ def get_xml_filename(config: Config) -> str:
     return xml_filename
 
 
-def prepare_xml_zst_file(wikidump_dir: Path, config: Config, *, parallel: bool,
+def verify_artifact(path: Path, test: Callable[[Path], bool], manifest: Manifest) -> FileDigests:
+    """ Digests of a compressed artifact, from the manifest if verified already,
+    else tested and hashed (both read the file at the same time, so mostly once from the disk) """
+    digests = manifest.get(path)
+    if digests is not None and digests.verified:
+        print(f"{path.name}: verified when written (md5 {digests.md5}), skip testing")
+        return digests
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        tested = executor.submit(test, path)
+        hasher = hash_file(path)
+        assert tested.result(), f"{path} is corrupted"
+    digests = FileDigests(size=hasher.size, md5=hasher.md5, sha1=hasher.sha1,
+                          source_size=digests and digests.source_size, source_sha1=digests and digests.source_sha1,
+                          verified=True)
+    manifest.put(path, digests)
+    return digests
+
+
+def compress_zst_file(path: Path, *, slots: CompressSlots, manifest: Manifest,
+                      zstd_compressor: ZstdCompressor, zstd_level: int, threads: int = 0) -> Path:
+    """ Compress path to path.zst, record its digests in the manifest, returns the .zst path """
+    # limit the concurrent compressions of the host, to avoid OOM
+    with slots.hold(zstd_memory(zstd_level, 31, path.stat().st_size), path.name):
+        r, digests = zstd_compressor.compress_file_digests(path, level=zstd_level, threads=threads)
+        if digests is not None:
+            manifest.put(r, digests)
+        verify_artifact(r, zstd_compressor.test_integrity, manifest)
+    return r
+
+
+def compress_small_file(path: Path, *, slots: CompressSlots, manifest: Manifest,
+                        zstd_compressor: ZstdCompressor, zstd_level: int) -> Path:
+    """ Compress titles.txt, images.txt, ... to .zst (single-threaded, next to the XML one), returns the .zst path """
+    return compress_zst_file(path, slots=slots, manifest=manifest, zstd_compressor=zstd_compressor,
+                             zstd_level=zstd_level, threads=1)
+
+
+def prepare_xml_zst_file(wikidump_dir: Path, config: Config, *, slots: CompressSlots, manifest: Manifest,
                          zstd_compressor: ZstdCompressor, zstd_level: int
                          ) -> Path:
     """ Compress xml file to .zst file."""
@@ -128,24 +175,21 @@ def prepare_xml_zst_file(wikidump_dir: Path, config: Config, *, parallel: bool,
 
     if xml_file_path.exists():
         assert xmldump_is_complete(xml_file_path)
-        with NoLock() if parallel else SocketLockServer():
-            # ensure only one process is compressing, to avoid OOM
-            r = zstd_compressor.compress_file(xml_file_path, level=zstd_level)
-            assert r == xml_zstd_file_path.resolve()
-            assert xml_zstd_file_path.exists()
-            assert zstd_compressor.test_integrity(r)
+        r = compress_zst_file(xml_file_path, slots=slots, manifest=manifest,
+                              zstd_compressor=zstd_compressor, zstd_level=zstd_level)
+        assert r == xml_zstd_file_path.resolve()
 
-            # rm source xml file
-            # decompressing is so fast that we don't need to keep the xml file
-            # os.remove(xml_file_path)
+        # rm source xml file
+        # decompressing is so fast that we don't need to keep the xml file
+        # os.remove(xml_file_path)
 
     assert xml_zstd_file_path.exists()
 
     return xml_zstd_file_path.resolve()
 
 
-def prepare_images_7z_archive(wikidump_dir: Path, config: Config, parallel: bool, *,
-                              images_source: str = "images",
+def prepare_images_7z_archive(wikidump_dir: Path, config: Config, slots: CompressSlots, *,
+                              manifest: Manifest, images_source: str = "images",
                               sevenzip_compressor: SevenZipCompressor) -> Optional[Path]:
     """ Compress wikidump_dir/images_source dir to .7z file. 
     
@@ -162,80 +206,90 @@ def prepare_images_7z_archive(wikidump_dir: Path, config: Config, parallel: bool
 
     images_7z_archive_path = wikidump_dir / f"{config2basename(config)}-{images_source}.7z"
     if not images_7z_archive_path.exists() or not images_7z_archive_path.is_file():
-        with NoLock() if parallel else SocketLockServer():
+        with slots.hold(sevenzip_memory(level=0), images_7z_archive_path.name):
             r = sevenzip_compressor.compress_dir(images_dir)
             shutil.move(r, images_7z_archive_path)
 
-    assert sevenzip_compressor.test_integrity(images_7z_archive_path)
+    verify_artifact(images_7z_archive_path, sevenzip_compressor.test_integrity, manifest)
 
     assert images_7z_archive_path.exists() and images_7z_archive_path.is_file()
     return images_7z_archive_path.resolve()
 
 
-def prepare_files_to_upload(wikidump_dir: Path, config: Config, item: Item, *, parallel: bool,
+def is_uploaded(local: Path, file_in_item: Dict, manifest: Manifest) -> bool:
+    """ Compares the md5 of the local file (from the manifest, or hashed if small) with the one of IA,
+    else only the sizes """
+    size = os.path.getsize(local)
+    if int(file_in_item["size"]) != size:
+        return False
+    digests = manifest.get(local)
+    md5 = digests.md5 if digests else (hash_file(local).md5 if size <= SMALL_FILE_SIZE else None)
+    if md5 is None or "md5" not in file_in_item:
+        return True
+    return file_in_item["md5"] == md5
+
+
+def prepare_files_to_upload(wikidump_dir: Path, config: Config, item: Item, *, slots: CompressSlots,
                             zstd_compressor: ZstdCompressor, zstd_level: int,
-                            sevenzip_compressor: SevenZipCompressor
+                            sevenzip_compressor: SevenZipCompressor,
+                            workers: int = COMPRESS_WORKERS,
+                            on_ready: Optional[Callable[[str, str], None]] = None,
+                            manifest: Optional[Manifest] = None,
                             ) -> Dict[str, str]:
-    """ return: filedict ("remote filename": "local filename") """
-    filedict = {} # "remote filename": "local filename"
+    """ Compress the artifacts concurrently, `workers` at a time (the memory is limited by `slots`)
+
+    on_ready: called with ("remote filename", "local filename") as soon as a file to upload is ready
+    return: filedict ("remote filename": "local filename")
+    """
+    basename = config2basename(config)
+    manifest = manifest or Manifest(wikidump_dir)
+    jobs: Dict[str, Callable[[], Optional[Path]]] = {} # "remote filename": prepare the local file (None: skip)
 
     # config.json
     config_json_path = wikidump_dir / "config.json"
     assert config_json_path.exists()
-    filedict[f"{config2basename(config)}-dumpMeta/config.json"] = str(config_json_path)
-
-    # errors.log optional
-    if (wikidump_dir / "errors.log").exists():
-        filedict[f"{config2basename(config)}-dumpMeta/errors.log"] = str(wikidump_dir / "errors.log")
-    # SpecialVersion.html optional
-    if (wikidump_dir / "SpecialVersion.html").exists():
-        filedict[f"{config2basename(config)}-dumpMeta/SpecialVersion.html"] = str(wikidump_dir / "SpecialVersion.html")
-    # siteinfo.json optional
-    if (wikidump_dir / "siteinfo.json").exists():
-        filedict[f"{config2basename(config)}-dumpMeta/siteinfo.json"] = str(wikidump_dir / "siteinfo.json")
-    # index.html optional
-    if (wikidump_dir / "index.html").exists():
-        filedict[f"{config2basename(config)}-dumpMeta/index.html"] = str(wikidump_dir / "index.html")
-
-    print("=== commpressing necessary files: ===")
+    jobs[f"{basename}-dumpMeta/config.json"] = lambda: config_json_path
+
+    # optional
+    for meta_filename in ["errors.log", "SpecialVersion.html", "siteinfo.json", "index.html"]:
+        meta_path = wikidump_dir / meta_filename
+        if meta_path.exists():
+            jobs[f"{basename}-dumpMeta/{meta_filename}"] = lambda meta_path=meta_path: meta_path
+
+    def small_file_job(path: Path, check: Callable[[], bool] = lambda: True) -> Callable[[], Path]:
+        def job() -> Path:
+            assert check(), f"{path} is incomplete"
+            r = compress_small_file(path, slots=slots, manifest=manifest, zstd_compressor=zstd_compressor, zstd_level=zstd_level)
+            assert r == (path.parent / (path.name + ".zst")).resolve()
+            return r
+        return job
 
     # .xml dump
     if config.xml:
         if not config.xmlrevisions:
             #  -titles.txt
-            titles_txt_path = wikidump_dir / f"{config2basename(config)}-titles.txt"
-            titles_txt_zstd_path = wikidump_dir / f"{config2basename(config)}-titles.txt.zst"
+            titles_txt_path = wikidump_dir / f"{basename}-titles.txt"
             assert titles_txt_path.exists()
-            assert checkTitleOk(config)
-            r = zstd_compressor.compress_file(titles_txt_path,level=zstd_level)
-            assert r == titles_txt_zstd_path.resolve()
-            assert zstd_compressor.test_integrity(r)
-            filedict[f"{config2basename(config)}-dumpMeta/{titles_txt_zstd_path.name}"] = str(titles_txt_zstd_path)
-        xml_zstd_path = prepare_xml_zst_file(wikidump_dir, config, parallel=parallel, zstd_compressor=zstd_compressor, zstd_level=zstd_level)
-        filedict[f"{xml_zstd_path.name}"] = str(xml_zstd_path)
+            jobs[f"{basename}-dumpMeta/{titles_txt_path.name}.zst"] = small_file_job(titles_txt_path, lambda: checkTitleOk(config))
+        jobs[f"{get_xml_filename(config)}.zst"] = lambda: prepare_xml_zst_file(
+            wikidump_dir, config, slots=slots, manifest=manifest, zstd_compressor=zstd_compressor, zstd_level=zstd_level
+        )
 
     # redirects
     if config.redirects:
         # osm.bio-20241204-redirects.jsonl
-        redirects_jsonl_path = wikidump_dir / f"{config2basename(config)}-redirects.jsonl"
-        redirects_jsonl_zstd_path = wikidump_dir / f"{config2basename(config)}-redirects.jsonl.zst"
+        redirects_jsonl_path = wikidump_dir / f"{basename}-redirects.jsonl"
         assert redirects_jsonl_path.exists()
         # TODO: check if redirects dump is complete
-        r = zstd_compressor.compress_file(redirects_jsonl_path, level=zstd_level)
-        assert r == redirects_jsonl_zstd_path.resolve()
-        assert zstd_compressor.test_integrity(r)
-        filedict[f"{config2basename(config)}-dumpMeta/{redirects_jsonl_zstd_path.name}"] = str(redirects_jsonl_zstd_path)
+        jobs[f"{basename}-dumpMeta/{redirects_jsonl_path.name}.zst"] = small_file_job(redirects_jsonl_path)
 
     # images
     if config.images:
         # images.txt
-        images_txt_path = wikidump_dir / f"{config2basename(config)}-images.txt"
-        images_txt_zstd_path = wikidump_dir / f"{config2basename(config)}-images.txt.zst"
-        assert images_list_is_complete(images_txt_path)
-        r = zstd_compressor.compress_file(images_txt_path, level=zstd_level)
-        assert r == images_txt_zstd_path.resolve()
-        assert zstd_compressor.test_integrity(r)
-        filedict[f"{config2basename(config)}-dumpMeta/{images_txt_zstd_path.name}"] = str(images_txt_zstd_path)
+        images_txt_path = wikidump_dir / f"{basename}-images.txt"
+        jobs[f"{basename}-dumpMeta/{images_txt_path.name}.zst"] = small_file_job(
+            images_txt_path, lambda: images_list_is_complete(images_txt_path)
+        )
 
         # images.7z and images_mismatch.7z
         for images_source in ["images", "images_mismatch"]:
@@ -244,30 +298,36 @@ def prepare_files_to_upload(wikidump_dir: Path, config: Config, item: Item, *, p
                 print(f"{images_source} dir not found, skip")
                 continue
             # --->
-            images_7z_archive_path = prepare_images_7z_archive(wikidump_dir, config, parallel, images_source=images_source, sevenzip_compressor=sevenzip_compressor)
-            if images_7z_archive_path:
-                filedict[f"{images_7z_archive_path.name}"] = str(images_7z_archive_path)
-            else:
-                print(f"{images_source} dir is empty, skip creating .7z archive")
-
-    print("=== Files already uploaded: ===")
-    c = 0
-    for file_in_item in item.files:
-        if file_in_item["name"] in filedict:
-            c += 1
-            if int(file_in_item["size"]) != os.path.getsize(filedict[file_in_item["name"]]):
-                print(f'    "{file_in_item["name"]}" (size mismatch), will re-upload')
+            def images_job(images_source=images_source) -> Optional[Path]:
+                r = prepare_images_7z_archive(wikidump_dir, config, slots, manifest=manifest, images_source=images_source, sevenzip_compressor=sevenzip_compressor)
+                if r is None:
+                    print(f"{images_source} dir is empty, skip creating .7z archive")
+                return r
+            jobs[f"{basename}-{images_source}.7z"] = images_job
+
+    uploaded = {file_in_item["name"]: file_in_item for file_in_item in item.files}
+    print(f"{len(item.files)} files in remote item")
+
+    print(f"=== commpressing necessary files ({workers} at a time): ===")
+    filedict = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="compress") as executor:
+        futures = {executor.submit(job): remote for remote, job in jobs.items()}
+        for future in as_completed(futures):
+            remote = futures[future]
+            local = future.result()
+            if local is None:
                 continue
-
-            filedict.pop(file_in_item["name"])
-            print(f'    "{file_in_item["name"]}" (already uploaded)')
-    print(f"Already uploaded {c} files. ({len(item.files)} files in remote item in total)")
-
-    print("=== Files to upload: ===")
-    for remote_dest, local_src in filedict.items():
-        print(f'    "{remote_dest}" from "{local_src}"')
-    print(f"{len(filedict)} files ready to upload...")
-
+            if remote in uploaded:
+                if is_uploaded(local, uploaded[remote], manifest):
+                    print(f'    "{remote}" (already uploaded)')
+                    continue
+                print(f'    "{remote}" (md5 or size mismatch), will re-upload')
+            print(f'    "{remote}" ready, from "{local}"')
+            filedict[remote] = str(local)
+            if on_ready:
+                on_ready(remote, str(local))
+
+    print(f"{len(filedict)} files to upload")
     return filedict
 
 def prepare_item_metadata(wikidump_dir: Path, config: Config, arg: Args) -> Tuple[Dict, Optional[str]]:
@@ -410,13 +470,6 @@ def upload(arg: Args):
 
     item = get_item(identifier)
 
-    print("=== Preparing files to upload ===")
-    filedict = prepare_files_to_upload(
-        wikidump_dir, config, item, parallel=arg.parallel, 
-        zstd_compressor=zstd_compressor, zstd_level=arg.zstd_level,
-        sevenzip_compressor=sevenzip_compressor
-        )
-
     print("=== Preparing metadata ===")
     metadata, logo_url = prepare_item_metadata(wikidump_dir, config, arg)
 
@@ -436,13 +489,32 @@ def upload(arg: Args):
         print(f"Failed to get IA S3 load average: {e}")
         print("Don't worry, it's optional.")
 
+    print("=== Preparing and uploading files ===")
+    manifest = Manifest(wikidump_dir)
+    s3 = S3Uploader(identifier, ia_keys.access, ia_keys.secret, metadata, endpoint=arg.s3_endpoint,
+                    state_path=wikidump_dir / UPLOAD_STATE_FILENAME, bucket_exists=item.exists)
+    # every file is uploaded as soon as it is ready, while the others are still compressed
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload") as uploader:
+        uploads: List[Future] = []
+        def on_ready(remote: str, local: str):
+            if not arg.dry_run:
+                digests = manifest.get(local)
+                uploads.append(uploader.submit(s3.upload, remote, local, digests and digests.md5))
+        filedict = prepare_files_to_upload(
+            wikidump_dir, config, item, slots=CompressSlots(None if arg.parallel else arg.compress_slots or default_slots()),
+            zstd_compressor=zstd_compressor, zstd_level=arg.zstd_level,
+            sevenzip_compressor=sevenzip_compressor, on_ready=on_ready, manifest=manifest,
+            )
+        for future in uploads:
+            future.result()
 
     if arg.dry_run:
         print("=== Dry run, exiting ===")
         return
 
-    print("=== Uploading ===")
-    upload_main_resouces(item, filedict, metadata, ia_keys)
+    if filedict:
+        print(f"Uploading {len(filedict)} files: Done.\n")
+        wait_for_item(identifier)
 
     item = get_item(identifier)
     if logo_url:
@@ -504,33 +576,12 @@ def upload_logo(item: Item, logo_url: str, ia_keys: IAKeys):
         print(r_resp.text)
         r_resp.raise_for_status()
 
-def upload_main_resouces(item: Item, filedict: Dict[str, str], metadata: Dict, ia_keys: IAKeys):
-    if not filedict:
-        print("No files to upload, skip")
-        return
-
-    r_co = item.upload(
-        files=filedict,
-        metadata=metadata,
-        access_key=ia_keys.access,
-        secret_key=ia_keys.secret,
-        verbose=True,
-        queue_derive=False, # disable derive
-    )
-    for r_resp in r_co:
-        assert isinstance(r_resp, requests.Response)
-        print(r_resp.text)
-        r_resp.raise_for_status()
-    print(f"Uploading {len(filedict)} files: Done.\n")
-
-    identifier = item.identifier
-    assert identifier
-
+def wait_for_item(identifier: str) -> Item:
     item = get_item(identifier) # refresh item
     tries = 400
     for tries_left in range(tries, 0, -1):
         if item.exists:
-            break
+            return item
 
         print(f"Waiting for item to be created ({tries_left} tries left)  ...", end='\r')
         if tries < 395:
@@ -538,10 +589,12 @@ def upload_main_resouces(item: Item, filedict: Dict[str, str], metadata: Dict, i
         time.sleep(30)
         item = get_item(identifier)
 
-    if not item.exists:
-        raise TimeoutError(f"IA overloaded, item still not created after {400 * 30} seconds")
+    if item.exists:
+        return item
+    raise TimeoutError(f"IA overloaded, item still not created after {400 * 30} seconds")
+
 
-def main():
+def main(params=None):
     parser = argparse.ArgumentParser(
         """ Upload wikidump to the Internet Archive."""
     )
@@ -568,10 +621,16 @@ def main():
                         )
     parser.add_argument("--bin-7z", default=SevenZipCompressor.bin_7z, dest="bin_7z",
                         help=f"Path to 7z binary. [default: {SevenZipCompressor.bin_7z}] ")
-    parser.add_argument("--parallel", action="store_true", help="Parallelize compression tasks")
+    parser.add_argument("--s3-endpoint", default=S3_ENDPOINT, metavar="URL", dest="s3_endpoint",
+                        help=f"IA S3 endpoint, large files are sent with multipart uploads (resumable). [default: {S3_ENDPOINT}]")
+    parser.add_argument("--parallel", action="store_true", help="Parallelize compression tasks, without any limit (see --compress-slots)")
+    parser.add_argument("--compress-slots", type=int, default=None, metavar="N", dest="compress_slots",
+                        help="Memory budget of the compressions running at the same time on this host (all processes), "
+                        "in 1 GiB slots, e.g. a zstd -17 --long=31 takes 5 slots. "
+                        "[default: 3/4 of the RAM]")
     parser.add_argument("wikidump_dir")
     
-    arg = Args(**vars(parser.parse_args()))
+    arg = Args(**vars(parser.parse_args(params)))
     print(arg)
     upload(arg)
     
@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlparse
+
+import requests
+
+CONNECT_TIMEOUT_MIN = 5.0
+CONNECT_TIMEOUT_MAX = float(os.getenv("WIKITEAM3_CONNECT_TIMEOUT_MAX", "30"))
+READ_TIMEOUT_MIN = 10.0
+READ_TIMEOUT_MAX = float(os.getenv("WIKITEAM3_READ_TIMEOUT_MAX", "600"))
+""" ceiling of the read timeout, heavy requests included """
+DEFAULT_TIMEOUT = 60.0
+""" read timeout of requests sent without one, until we know the endpoint """
+
+SAFETY_FACTOR = 4.0
+""" timeout = SAFETY_FACTOR * latency percentile """
+MIN_SAMPLES = 5
+WINDOW = 200
+""" number of recent latencies kept per endpoint """
+
+LIGHT_LIMIT = 50
+""" a batch of this size (rvlimit, arvlimit, limit...) is a normal request, larger ones are heavier """
+MAX_WEIGHT = 20.0
+EXPORT_WEIGHT = 4.0
+""" Special:Export and action=query&export are slower than normal requests """
+
+_LIMIT_PARAMS = ("limit", "rvlimit", "arvlimit", "ailimit", "aplimit", "gaplimit", "arlimit")
+
+TimeoutType = Union[None, float, Tuple[Optional[float], Optional[float]]]
+
+
+def endpoint_key(url: str) -> str:
+    """host + script (api.php, index.php...), or host + "/" for everything else (e.g. images)"""
+    parsed = urlparse(url)
+    script = parsed.path.rsplit("/", 1)[-1]
+    if not script.endswith(".php"):
+        script = ""
+    return f"{(parsed.hostname or '').lower()}/{script}"
+
+
+def request_weight(request: requests.PreparedRequest) -> float:
+    """How much heavier than a normal request `request` is expected to be (>= 1)"""
+    assert isinstance(request.url, str)
+    params = dict(parse_qsl(urlparse(request.url).query))
+    body = request.body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="ignore")
+    if isinstance(body, str) and "application/x-www-form-urlencoded" in request.headers.get("Content-Type", ""):
+        params.update(parse_qsl(body))
+
+    weight = 1.0
+    for param in _LIMIT_PARAMS:
+        try:
+            limit = int(params.get(param, 0))
+        except ValueError:
+            continue
+        weight = max(weight, limit / LIGHT_LIMIT)
+    if params.get("export") or params.get("title", "").endswith(":Export"):
+        weight *= EXPORT_WEIGHT
+    return min(weight, MAX_WEIGHT)
+
+
+class LatencyTracker:
+    """
+    Recent latencies (time to response headers) per endpoint, normalized by the request weight.
+    Thread-safe.
+    """
+
+    def __init__(self, window: int = WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[str, Deque[float]] = {}
+
+    def record(self, key: str, seconds: float, weight: float = 1.0):
+        with self._lock:
+            samples = self._samples.setdefault(key, deque(maxlen=self.window))
+            samples.append(seconds / weight)
+
+    def percentile(self, key: str, q: float) -> Optional[float]:
+        """`q` (0-100) percentile of the normalized latencies of `key`, None if not enough samples"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * q / 100))]
+
+    def timeout(self, key: str, weight: float = 1.0, default: TimeoutType = None) -> TimeoutType:
+        """(connect, read) timeout for a request of `weight` to `key`
+
+        `default` (the timeout of the caller) is used until enough latencies are known.
+        """
+        p50, p99 = self.percentile(key, 50), self.percentile(key, 99)
+        if p50 is None or p99 is None:
+            return default if default is not None else DEFAULT_TIMEOUT
+        connect = min(max(CONNECT_TIMEOUT_MIN, SAFETY_FACTOR * p50), CONNECT_TIMEOUT_MAX)
+        read = min(max(READ_TIMEOUT_MIN, SAFETY_FACTOR * p99 * weight), READ_TIMEOUT_MAX)
+        return (connect, read)
+
+
+LATENCY_TRACKER = LatencyTracker()
+""" process-wide latency statistics, shared by every session and thread """
+
+
+def _read_timeout(timeout: TimeoutType) -> Optional[float]:
+    return timeout[1] if isinstance(timeout, tuple) else timeout
+
+
+def install_adaptive_timeout(session: requests.Session, tracker: LatencyTracker = LATENCY_TRACKER):
+    """Replace the timeout of every request sent by `session` by one derived from the endpoint latency
+
+    The timeout given by the caller (e.g. `timeout=30`, or mwclient's 30s) is only used
+    until enough requests to the endpoint have been timed. Timed out requests count as
+    a latency of the read timeout, so a slowing endpoint gets longer timeouts.
+    Installing it again on a reused session does nothing.
+    """
+    if session.__dict__.get("_wikiteam3_adaptive_timeout"):
+        return
+    session.__dict__["_wikiteam3_adaptive_timeout"] = True
+    send = session.send
+
+    def adaptive_send(request: requests.PreparedRequest, **kwargs):
+        assert isinstance(request.url, str)
+        key = endpoint_key(request.url)
+        weight = request_weight(request)
+        kwargs["timeout"] = timeout = tracker.timeout(key, weight, default=kwargs.get("timeout"))
+        try:
+            r = send(request, **kwargs)
+        except requests.exceptions.ReadTimeout:
+            if (read := _read_timeout(timeout)) is not None:
+                tracker.record(key, read, weight)
+            raise
+        if r.status_code < 500:
+            tracker.record(key, r.elapsed.total_seconds(), weight)
+        return r
+
+    session.send = adaptive_send # type: ignore
@@ -0,0 +1,112 @@
+import os
+import threading
+from typing import Dict, Optional
+
+from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils.checkpoint import Checkpoint
+
+BATCH_SIZES_FILENAME = "batch_sizes.json"
+FAST_SECONDS = float(os.getenv("WIKITEAM3_BATCH_FAST_SECONDS", "10"))
+""" a batch answered within this many seconds is "fast", the batch size may grow """
+
+
+class BatchSize:
+    """
+    AIMD (additive increase, multiplicative decrease) controller of one batch size parameter.
+
+    - `success()` on a fast answer grows the value by `step` (up to `maximum`)
+    - `failure()` on timeouts, errors or truncated results divides it by `decrease` (down to `minimum`)
+    - `drop()` goes down to `minimum` at once
+
+    Learned values are saved to the dump dir (see `get_batch_size()`), so a resumed dump
+    starts with the value that worked last time.
+    """
+
+    def __init__(self, key: str, initial: int, minimum: int = 1, maximum: Optional[int] = None,
+                 decrease: float = 2, step: Optional[int] = None, store: Optional[Checkpoint] = None):
+        assert minimum >= 1 and decrease > 1
+        self.key = key
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else max(initial, minimum)
+        self.decrease = decrease
+        self.step = step if step is not None else max(1, self.maximum // 10)
+        self.store = store
+        self._lock = threading.Lock()
+
+        saved = store.get(key) if store is not None else None
+        self.value: int = self._clamp(int(saved) if saved is not None else initial)
+        if saved is not None and saved != initial:
+            print(f"Using learned batch size {self.key} = {self.value}")
+
+    def _clamp(self, value: int) -> int:
+        return max(self.minimum, min(self.maximum, value))
+
+    def _set(self, value: int) -> bool:
+        """returns True if the value changed"""
+        value = self._clamp(value)
+        if value == self.value:
+            return False
+        self.value = value
+        if self.store is not None:
+            self.store.update(self.key, value)
+        return True
+
+    def success(self, elapsed: Optional[float] = None) -> int:
+        """The last batch was OK (in `elapsed` seconds), returns the next batch size"""
+        if elapsed is None or elapsed < FAST_SECONDS:
+            with self._lock:
+                self._set(self.value + self.step)
+        return self.value
+
+    def failure(self) -> bool:
+        """The last batch failed or was truncated, returns False if already at `minimum`"""
+        with self._lock:
+            old = self.value
+            changed = self._set(int(self.value / self.decrease))
+        if changed:
+            print(f"Reducing batch size {self.key} from {old} to {self.value}")
+        return changed
+
+    def drop(self) -> bool:
+        """Go down to `minimum` at once (e.g. to isolate a bad item), `success()` grows it back
+        step by step. returns False if already at `minimum`"""
+        with self._lock:
+            old = self.value
+            changed = self._set(self.minimum)
+        if changed:
+            print(f"Reducing batch size {self.key} from {old} to {self.value}")
+        return changed
+
+
+_stores: Dict[str, Checkpoint] = {}
+_batch_sizes: Dict[str, BatchSize] = {}
+_lock = threading.Lock()
+
+
+def get_batch_size(config: Config, endpoint: str, param: str, initial: int,
+                   minimum: int = 1, maximum: Optional[int] = None, decrease: float = 2) -> BatchSize:
+    """The shared `BatchSize` of `param` on `endpoint` (e.g. config.api, "arvlimit")"""
+    key = f"{endpoint}|{param}"
+    with _lock:
+        store = None
+        if config.path and os.path.isdir(config.path):
+            path = os.path.join(config.path, BATCH_SIZES_FILENAME)
+            if path not in _stores:
+                _stores[path] = Checkpoint(path)
+            store = _stores[path]
+        cache_key = f"{config.path}|{key}"
+        batch = _batch_sizes.get(cache_key)
+        if batch is None or batch.maximum != (maximum if maximum is not None else max(initial, minimum)):
+            batch = BatchSize(key, initial, minimum=minimum, maximum=maximum, decrease=decrease, store=store)
+            _batch_sizes[cache_key] = batch
+        return batch
+
+
+def is_truncated_result(response: dict) -> bool:
+    """MediaWiki truncated the result because it exceeded $wgAPIMaxResultSize"""
+    warnings = response.get("warnings", {}).get("result", {})
+    if isinstance(warnings, dict):
+        text = warnings.get("*") or warnings.get("warnings") or ""
+    else:
+        text = str(warnings)
+    return "truncated" in text
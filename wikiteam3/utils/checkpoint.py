@@ -0,0 +1,49 @@
+import json
+import os
+import threading
+from typing import Any, Dict, Optional
+
+
+class Checkpoint:
+    """
+    A small JSON state file, used to resume long enumerations (titles, images) after a crash.
+
+    Every `update()` rewrites the whole file atomically (tmp file + `os.replace()`),
+    so a crash leaves either the old or the new state on disk, never a partial one.
+    Thread-safe.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state: Dict[str, Any] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.state = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable checkpoint {path}: {e}")
+                self.state = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.state)
+
+    def get(self, key: str, default: Optional[Any] = None) -> Any:
+        with self.lock:
+            return self.state.get(key, default)
+
+    def update(self, key: str, value: Any):
+        with self.lock:
+            self.state[key] = value
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+    def remove(self):
+        with self.lock:
+            self.state = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import requests.adapters
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool, PoolManager
+
+MAX_IDLE_SECONDS = float(os.getenv("WIKITEAM3_MAX_IDLE_SECONDS", str(60 * 3)))
+""" keep-alive connections idle for longer than this are closed instead of reused """
+
+
+class ConnectionStats:
+    """
+    Thread-safe counters of the pooled HTTP connections
+
+    - `handshakes`: new TCP (+TLS) connections
+    - `reuses`: requests sent on a kept-alive connection
+    - `idle_retired`: connections we closed because they were idle for too long
+    - `server_closed`: kept-alive connections the server closed while idle
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {"handshakes": 0, "reuses": 0, "idle_retired": 0, "server_closed": 0}
+
+    def inc(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+    def __str__(self):
+        counters = self.snapshot()
+        requests = counters["handshakes"] + counters["reuses"]
+        reuse_ratio = counters["reuses"] / requests if requests else 0.0
+        return ", ".join(f"{k}: {v}" for k, v in counters.items()) + f" (reuse ratio: {reuse_ratio:.1%})"
+
+
+CONNECTION_STATS = ConnectionStats()
+""" process-wide connection counters """
+
+
+class IdleTrackingPoolMixin:
+    """
+    Remember when each connection was returned to the pool, and retire it when it is
+    taken again after more than `max_idle` seconds. Busy connections are kept alive.
+    """
+    max_idle: float = MAX_IDLE_SECONDS
+    stats: ConnectionStats = CONNECTION_STATS
+
+    def _get_conn(self, timeout: Optional[float] = None):
+        # urllib3 already closes the connections the server dropped
+        conn = super()._get_conn(timeout=timeout) # type: ignore
+        idle_since: Optional[float] = getattr(conn, "_wikiteam3_idle_since", None)
+        connected = getattr(conn, "sock", None) is not None
+        if idle_since is not None:
+            if not connected:
+                self.stats.inc("server_closed")
+            elif time.monotonic() - idle_since > self.max_idle:
+                conn.close()
+                connected = False
+                self.stats.inc("idle_retired")
+        self.stats.inc("reuses" if connected else "handshakes")
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn._wikiteam3_idle_since = time.monotonic()
+        super()._put_conn(conn) # type: ignore
+
+
+class IdleTrackingHTTPConnectionPool(IdleTrackingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class IdleTrackingHTTPSConnectionPool(IdleTrackingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+def track_idle_connections(poolmanager: PoolManager, max_idle: float = MAX_IDLE_SECONDS,
+                           stats: ConnectionStats = CONNECTION_STATS):
+    """Make `poolmanager` create idle-tracking pools"""
+    attrs = {"max_idle": max_idle, "stats": stats}
+    poolmanager.pool_classes_by_scheme = { # type: ignore
+        "http": type("IdleTrackingHTTPConnectionPool", (IdleTrackingHTTPConnectionPool,), attrs),
+        "https": type("IdleTrackingHTTPSConnectionPool", (IdleTrackingHTTPSConnectionPool,), attrs),
+    }
+
+
+class IdleTrackingAdapter(requests.adapters.HTTPAdapter):
+    """
+    `HTTPAdapter` that only retires the keep-alive connections idle for more than `max_idle` seconds
+    """
+
+    def __init__(self, *args, max_idle: float = MAX_IDLE_SECONDS, **kwargs):
+        self.max_idle = max_idle
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        track_idle_connections(self.poolmanager, max_idle=self.max_idle)
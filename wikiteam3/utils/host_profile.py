@@ -0,0 +1,99 @@
+import datetime
+import os
+import time
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils import monkey_patch
+from wikiteam3.utils.batch_size import BATCH_SIZES_FILENAME
+from wikiteam3.utils.checkpoint import Checkpoint
+
+PROFILE_DIR = os.getenv("WIKITEAM3_PROFILE_DIR") or os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "wikiteam3", "profiles"
+)
+PROFILE_TTL_DAYS = 7.0
+""" default of --profile-ttl """
+
+
+class HostProfile:
+    """
+    What previous runs learned about the wikis of a host, saved to `{PROFILE_DIR}/{host}.json`:
+
+    - `discovery|{wiki}|{api}|{index}` (the URLs given by the user): the api.php and index.php
+      that passed the checks
+    - `tuning|{api or index}`: working HTTP method, Special:Export name, learned batch sizes,
+      detected encoding
+
+    Entries older than `ttl_days` are ignored, i.e. rediscovered. `ttl_days=0` disables the profile.
+    """
+
+    def __init__(self, url: str, ttl_days: float = PROFILE_TTL_DAYS, profile_dir: str = PROFILE_DIR):
+        self.host = (urlparse(url).hostname or "").lower()
+        self.ttl = ttl_days * 24 * 3600
+        self.store: Optional[Checkpoint] = None
+        if self.host and self.ttl > 0:
+            self.store = Checkpoint(os.path.join(profile_dir, f"{self.host}.json"))
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """The saved entry, None if missing or expired"""
+        if self.store is None:
+            return None
+        entry = self.store.get(key)
+        if not entry or time.time() - entry.get("time", 0) > self.ttl:
+            return None
+        return entry
+
+    def save(self, key: str, **values):
+        if self.store is None:
+            return
+        os.makedirs(os.path.dirname(self.store.path), exist_ok=True)
+        self.store.update(key, {**values, "time": time.time()})
+
+
+def discovery_key(wiki: Optional[str], api: Optional[str], index: Optional[str]) -> str:
+    return "discovery|{}|{}|{}".format(wiki or "", api or "", index or "")
+
+
+def describe_age(entry: Dict[str, Any]) -> str:
+    saved = datetime.datetime.fromtimestamp(entry["time"], datetime.timezone.utc)
+    return saved.strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+def _tuning_key(config: Config) -> str:
+    return f"tuning|{config.api or config.index}"
+
+
+def apply_tuning_profile(config: Config, ttl_days: float = PROFILE_TTL_DAYS):
+    """Start with what the previous run on this wiki learned (the dump dir must exist)
+
+    Batch sizes already learned in the dump dir (resumed dump) are kept.
+    """
+    profile = HostProfile(config.api or config.index, ttl_days)
+    tuning = profile.get(_tuning_key(config))
+    if tuning is None:
+        return
+    print(f"Using the host profile saved on {describe_age(tuning)} (--profile-ttl)")
+
+    config.http_method = tuning.get("http_method") or config.http_method
+    config.export = config.export or tuning.get("export", "")
+    store = Checkpoint(os.path.join(config.path, BATCH_SIZES_FILENAME))
+    for key, value in tuning.get("batch_sizes", {}).items():
+        if store.get(key) is None:
+            store.update(key, value)
+    encoding = tuning.get("encoding") or tuning.get("encodings", {}).get(profile.host)
+    if encoding and monkey_patch.get_host_encoding(profile.host) is None:
+        monkey_patch.set_host_encoding(profile.host, encoding)
+
+
+def save_tuning_profile(config: Config, ttl_days: float = PROFILE_TTL_DAYS):
+    """Save what this run learned about the wiki, for the next runs"""
+    profile = HostProfile(config.api or config.index, ttl_days)
+    batch_sizes = Checkpoint(os.path.join(config.path, BATCH_SIZES_FILENAME)).state
+    profile.save(
+        _tuning_key(config),
+        http_method=config.http_method,
+        export=config.export,
+        batch_sizes=batch_sizes,
+        encoding=monkey_patch.get_host_encoding(profile.host),
+    )
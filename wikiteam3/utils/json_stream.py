@@ -0,0 +1,159 @@
+import codecs
+import json
+from typing import Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
+
+READ_SIZE = 1 << 16
+""" bytes read from the response at once """
+
+_LIST_START = object()
+_WHITESPACE = " \t\n\r"
+
+
+class JSONItemStream:
+    """
+    Incremental parser of a JSON document, yielding the items of the container (array elements
+    or object values) at `path` one by one, e.g. `("query", "allrevisions")` of an API response.
+
+    Only one item is held in memory at a time. Everything else in the document is kept in `document`,
+    with an empty container at `path`, and `count` items were yielded from it.
+
+    >>> stream = JSONItemStream([b'{"continue": {"arvcontinue": "x"}, "query": {"allrevisions": [1, 2]}}'],
+    ...                         ("query", "allrevisions"))
+    >>> list(stream), stream.document, stream.count
+    ([1, 2], {'continue': {'arvcontinue': 'x'}, 'query': {'allrevisions': []}}, 2)
+    """
+
+    def __init__(self, chunks: Iterable[bytes], path: Tuple[str, ...], on_close: Optional[Callable[[], None]] = None):
+        assert path, "path must not be empty"
+        self.path = path
+        self.on_close = on_close
+        """ e.g. `Response.close`, see `close()` """
+        self.document: Dict[str, Any] = {}
+        self.count = 0
+        self.started = False
+        """ Whether the container at `path` was reached (see `start()`) """
+
+        self._chunks: Iterator[bytes] = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._gen = self._parse_document()
+        self._done = False
+
+    def start(self) -> "JSONItemStream":
+        """Parse the document up to the first item (or to the end if there is no container at `path`)"""
+        if not self.started and not self._done:
+            try:
+                assert next(self._gen) is _LIST_START
+                self.started = True
+            except StopIteration:
+                self._done = True
+        return self
+
+    def __iter__(self) -> Generator[Any, None, None]:
+        self.start()
+        if self._done:
+            return
+        for item in self._gen:
+            self.count += 1
+            yield item
+        self._done = True
+
+    def close(self):
+        """Stop reading the document (releases the connection of a streamed response)"""
+        self._done = True
+        if self.on_close is not None:
+            self.on_close()
+
+    def head(self, size: int = 1024) -> str:
+        """The beginning of the document (to report invalid responses)"""
+        return self._buf[:size]
+
+    # buffer
+
+    def _fill(self, size: int = READ_SIZE) -> bool:
+        """Read at least `size` more characters, returns False at the end of the document"""
+        if self._eof:
+            return False
+        if self._pos > READ_SIZE and self._pos * 2 > len(self._buf):
+            self._buf, self._pos = self._buf[self._pos:], 0
+        wanted = len(self._buf) + size
+        while len(self._buf) < wanted:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._buf += self._text_decoder.decode(b"", final=True)
+                self._eof = True
+                break
+            self._buf += self._text_decoder.decode(chunk)
+        return True
+
+    def _peek(self) -> str:
+        """Next non-whitespace character, "" at the end of the document"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars: str) -> str:
+        char = self._peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(f"Expecting one of {chars!r}", self._buf, self._pos)
+        self._pos += 1
+        return char
+
+    def _value(self) -> Any:
+        """Decode the next value, reading more of the document as needed"""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            else:
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            # grow geometrically, so a large value is not re-decoded too many times
+            self._fill(max(READ_SIZE, len(self._buf) - self._pos))
+
+    # grammar
+
+    def _parse_document(self):
+        if self._peek() != "{":
+            raise json.JSONDecodeError("Expecting a JSON object", self._buf, self._pos)
+        yield from self._parse_container((), self.document)
+        if self._peek():
+            raise json.JSONDecodeError("Extra data", self._buf, self._pos)
+
+    def _parse_container(self, prefix: Tuple[str, ...], container: Union[Dict, List]):
+        is_items = prefix == self.path
+        if is_items:
+            yield _LIST_START
+        is_object = self._expect("{[") == "{"
+        if self._peek() == ("}" if is_object else "]"):
+            self._pos += 1
+            return
+        while True:
+            key = None
+            if is_object:
+                key = self._value()
+                self._expect(":")
+            if is_items:
+                yield self._value()
+            elif is_object and self.path[:len(prefix) + 1] == prefix + (key,) and self._peek() in ("{", "["):
+                child: Union[Dict, List] = {} if self._peek() == "{" else []
+                container[key] = child # type: ignore
+                yield from self._parse_container(prefix + (key,), child)
+            elif is_object:
+                container[key] = self._value() # type: ignore
+            else:
+                container.append(self._value()) # type: ignore
+            if self._expect(",}" if is_object else ",]") != ",":
+                return
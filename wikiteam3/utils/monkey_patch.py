@@ -1,7 +1,10 @@
+import codecs
 import os
 import ssl
-import time
-from typing import Optional
+import threading
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 import warnings
 
 import requests
@@ -9,8 +12,98 @@ import requests.adapters
 from urllib3.util import create_urllib3_context
 from urllib3 import PoolManager
 
-from wikiteam3.dumpgenerator.cli.delay import Delay
 from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.utils.connection_pool import IdleTrackingAdapter, track_idle_connections
+from wikiteam3.utils.phases import current_phase
+from wikiteam3.utils.rate_limiter import BACKPRESSURE
+
+ENCODING_DETECT_BYTES = 64 * 1024
+""" charset detection only looks at the first bytes of the body """
+ENCODING_CONFIDENCE = 0.9
+""" a detection at least this confident is cached for the host """
+
+_host_encodings: Dict[str, str] = {}
+""" host -> encoding detected on a previous response (when the server doesn't send a usable charset) """
+_fffd_counter = threading.local()
+
+
+def _count_fffd(e: UnicodeError):
+    """ `errors="wikiteam3_count_fffd"`: same as "replace", and counts the replacements """
+    _fffd_counter.count += 1
+    if _fffd_counter.first_error is None and isinstance(e, UnicodeDecodeError):
+        # the codec reuses `e` for the next errors, keep a copy
+        _fffd_counter.first_error = UnicodeDecodeError(e.encoding, e.object, e.start, e.end, e.reason)
+    return ("\ufffd", e.end) # type: ignore
+
+codecs.register_error("wikiteam3_count_fffd", _count_fffd)
+
+
+def decode_counting_fffd(content: bytes, encoding: str) -> Tuple[str, int, Optional[UnicodeError]]:
+    """ Decode `content` in a single pass, replacing undecodable bytes with U+FFFD
+
+    returns: (text, number of replacements, first UnicodeDecodeError)
+    """
+    _fffd_counter.count, _fffd_counter.first_error = 0, None
+    text = codecs.decode(content, encoding, errors="wikiteam3_count_fffd")
+    return text, _fffd_counter.count, _fffd_counter.first_error
+
+
+def _host(response: requests.Response) -> str:
+    return (urlparse(response.url).hostname or "").lower()
+
+
+def _is_7bit(encoding: str) -> bool:
+    try:
+        return codecs.lookup(encoding).name in ("ascii", "utf-7")
+    except LookupError:
+        return False
+
+
+def get_host_encoding(host: str) -> Optional[str]:
+    """ The encoding detected on a previous response of `host`, if any """
+    return _host_encodings.get(host)
+
+
+def set_host_encoding(host: str, encoding: Optional[str]):
+    """ Remember (or forget, `encoding=None`) the encoding of `host`, 7-bit ones are inconclusive and ignored """
+    if encoding is None:
+        _host_encodings.pop(host, None)
+    elif not _is_7bit(encoding):
+        _host_encodings[host] = encoding
+
+
+def detect_encoding(response: requests.Response) -> str:
+    """ Encoding of a response without a usable charset, cached per host
+
+    The detection looks at the first `ENCODING_DETECT_BYTES`. An ASCII prefix says nothing about
+    the rest of the body: the whole body is then checked as UTF-8, or detected again.
+    """
+    host = _host(response)
+    cached = get_host_encoding(host)
+    if cached is not None:
+        return cached
+
+    chardet = requests.compat.chardet # type: ignore
+    if chardet is None:
+        return response.apparent_encoding or "utf-8"
+    content = response.content
+    result = chardet.detect(content[:ENCODING_DETECT_BYTES])
+    encoding = result.get("encoding") or "utf-8"
+    if _is_7bit(encoding) and len(content) > ENCODING_DETECT_BYTES:
+        if content.isascii():
+            return "utf-8" # inconclusive, not cached
+        try:
+            content.decode("utf-8")
+            result = {"encoding": "utf-8", "confidence": 1.0}
+        except UnicodeDecodeError:
+            result = chardet.detect(content)
+        encoding = result.get("encoding") or "utf-8"
+    if _is_7bit(encoding):
+        return "utf-8" # a superset, not cached
+    if (result.get("confidence") or 0) >= ENCODING_CONFIDENCE:
+        set_host_encoding(host, encoding)
+    return encoding
+
 
 def mod_requests_text(requests: requests): # type: ignore
     """ 
@@ -20,47 +113,48 @@ def mod_requests_text(requests: requests): # type: ignore
     def new_text(_self: requests.Response):
         # Handle incorrect encoding
         encoding = _self.encoding
+        from_cache = False
         if encoding is None or encoding == 'ISO-8859-1':
-            encoding = _self.apparent_encoding
-            if encoding is None:
-                encoding = 'utf-8'
-        if _self.content.startswith(b'\xef\xbb\xbf'):
-            content = _self.content.lstrip(b'\xef\xbb\xbf')
-            encoding = "utf-8"
-        else:
-            content = _self.content
-
-        try:
-            return content.decode(encoding, errors="strict")
-        except UnicodeDecodeError as e:
-            FFFD_CHAR = u'�'
-            FFFD_TOLERANCE = float(os.environ.get('WIKITEAM3_REQUESTS_TEXT_FFFD_TOLERANCE', '0.01'))
-            assert 0 <= FFFD_TOLERANCE <= 1
-            print('UnicodeDecodeError:', e)
-            ignore_text = content.decode(encoding, errors='ignore')
-            FFFDs_in_ignore_text = ignore_text.count(FFFD_CHAR)
-            replace_text = content.decode(encoding, errors='replace')
-            FFFDs_in_replace_text = replace_text.count(FFFD_CHAR)
-            
-            bad_FFFDs = FFFDs_in_replace_text - FFFDs_in_ignore_text
-            bad_FFFDs_ratio = bad_FFFDs / len(replace_text)
-
-            if bad_FFFDs_ratio > FFFD_TOLERANCE:
-                print(f"ERROR: Bad \\ufffd too many. {bad_FFFDs} bad FFFDs in {len(replace_text)} chars ({bad_FFFDs_ratio}) "
-                      "Check the encoding or set $WIKITEAM3_REQUESTS_TEXT_FFFD_TOLERANCE to a higher value.")
-                raise e
-
-            warnings.warn(
-                message=f"found bad \\ufffd, but tolerable. {bad_FFFDs} bad FFFDs in {len(replace_text)} chars ({bad_FFFDs_ratio})",
-                category=UserWarning
-            )
-            return replace_text
+            from_cache = get_host_encoding(_host(_self)) is not None
+            encoding = detect_encoding(_self)
+        content = _self.content
+        if content.startswith(b'\xef\xbb\xbf'):
+            encoding = "utf-8-sig" # strips the BOM without copying the content
+            from_cache = False
+
+        text, bad_FFFDs, e = decode_counting_fffd(content, encoding)
+        if bad_FFFDs and from_cache:
+            # the encoding of the previous responses doesn't fit this one, detect it on this one
+            set_host_encoding(_host(_self), None)
+            encoding = detect_encoding(_self)
+            text, bad_FFFDs, e = decode_counting_fffd(content, encoding)
+        if not bad_FFFDs:
+            return text
+
+        FFFD_TOLERANCE = float(os.environ.get('WIKITEAM3_REQUESTS_TEXT_FFFD_TOLERANCE', '0.01'))
+        assert 0 <= FFFD_TOLERANCE <= 1
+        print('UnicodeDecodeError:', e)
+        bad_FFFDs_ratio = bad_FFFDs / len(text)
+
+        if bad_FFFDs_ratio > FFFD_TOLERANCE:
+            print(f"ERROR: Bad \\ufffd too many. {bad_FFFDs} bad FFFDs in {len(text)} chars ({bad_FFFDs_ratio}) "
+                  "Check the encoding or set $WIKITEAM3_REQUESTS_TEXT_FFFD_TOLERANCE to a higher value.")
+            # the cached encoding of the host may be wrong, detect it again next time
+            set_host_encoding(_host(_self), None)
+            assert e is not None
+            raise e
+
+        warnings.warn(
+            message=f"found bad \\ufffd, but tolerable. {bad_FFFDs} bad FFFDs in {len(text)} chars ({bad_FFFDs_ratio})",
+            category=UserWarning
+        )
+        return text
 
 
     requests.Response.text = property(new_text) # type: ignore
 
 
-class WakeTLSAdapter(requests.adapters.HTTPAdapter):
+class WakeTLSAdapter(IdleTrackingAdapter):
     """
     Workaround for bad SSL/TLS
     """
@@ -82,110 +176,114 @@ class WakeTLSAdapter(requests.adapters.HTTPAdapter):
             block=block,
             ssl_context=ctx
         )
+        track_idle_connections(self.poolmanager, max_idle=self.max_idle)
 
 class SessionMonkeyPatch:
     """
     Monkey patch `requests.Session.send`
+
+    Several patches of the same session may be active at once (concurrent dump phases), and
+    released in any order: the first `hijack()` installs a dispatcher on the session, which sends
+    each request through the latest patch of the current phase (see `current_phase()`), or the
+    latest patch if its phase has none. The last `release()` restores the original `send`.
     """
     hijacked = False
+    _registry_lock = threading.Lock()
+
     def __init__(self,*, session: requests.Session, config: Optional[Config]=None,
-                 add_delay: bool=False, delay_msg: Optional[str]=None,
                  hard_retries: int=0,
-                 free_timeout_connections: bool=True, vaild_lft_sec: int=60 * 3,
                  accept_encoding: str="",
         ):
         """
         hard_retries: hard retries, default 0 (no retry)
-        free_timeout_connections: regularly(`vaild_lft_sec`) clear connections pool
+
+        Idle keep-alive connections are retired by the adapter (see `IdleTrackingAdapter`).
         """
 
         self.session = session
         self.config = config
 
-        self.add_delay = add_delay
-        self.delay_msg = delay_msg
-
         self.hard_retries = hard_retries
 
-        self.free_timeout_connections: bool = free_timeout_connections
-        self.vaild_lft_sec = vaild_lft_sec
-        self.last_clear_time = time.time()
-
         self.accept_encoding = accept_encoding
-
-    def clear_timeouted_pools(self):
-        for adapter in self.session.adapters.values():
-            adapter: requests.adapters.HTTPAdapter
-            if adapter.poolmanager.pools._container.__len__() > 0 and \
-                time.time() - self.last_clear_time > self.vaild_lft_sec:
-                # TODO: logging this
-                # print('Keep-alived timeout: %d' % adapter.poolmanager.pools._container.__len__(), "connection(s) dropped.")
-                adapter.poolmanager.clear() # clear all
-                self.last_clear_time = time.time()
+        self.phase: Optional[str] = None
 
     def hijack(self):
         ''' Don't forget to call `release()` '''
+        self.phase = current_phase()
+        with self._registry_lock:
+            patches: List[SessionMonkeyPatch] = self.session.__dict__.setdefault("_wikiteam3_patches", [])
+            if not patches:
+                original_send = self.session.send
+                self.session.__dict__["_wikiteam3_original_send"] = original_send
+                self.session.send = partial(_dispatch_send, self.session, original_send) # type: ignore
+            patches.append(self)
+            self.old_send_method = self.session.__dict__["_wikiteam3_original_send"]
+        self.hijacked = True
 
-        # Monkey patch `requests.Session.send`
-        self.old_send_method = self.session.send
+    def send(self, request: requests.PreparedRequest, **kwargs):
+        hard_retries_left = self.hard_retries + 1
+        if hard_retries_left <= 0:
+            raise ValueError('hard_retries must be positive')
 
-        def new_send(request: requests.PreparedRequest, **kwargs):
-            hard_retries_left = self.hard_retries + 1
-            if hard_retries_left <= 0:
-                raise ValueError('hard_retries must be positive')
+        accept_encoding = ''
 
-            accept_encoding = ''
+        while hard_retries_left > 0:
+            try:
+                if _accept_encoding := accept_encoding or self.accept_encoding or request.headers.get("Accept-Encoding", ""):
+                    request.headers["Accept-Encoding"] = _accept_encoding
 
-            while hard_retries_left > 0:
-                try:
-                    if self.add_delay:
-                        Delay(msg=self.delay_msg, config=self.config)
+                return self.old_send_method(request, **kwargs)
+            except (KeyboardInterrupt, requests.exceptions.ContentDecodingError): # don't retry
+                raise
+            except Exception as e:
+                hard_retries_left -= 1
+                if hard_retries_left <= 0:
+                    raise
 
-                    if self.free_timeout_connections:
-                        self.clear_timeouted_pools()
+                print('Hard retry... (%d), due to: %s' % (hard_retries_left, e))
 
-                    if _accept_encoding := accept_encoding or self.accept_encoding or request.headers.get("Accept-Encoding", ""):
-                        request.headers["Accept-Encoding"] = _accept_encoding
+                # workaround for https://wiki.erischan.org/index.php/Main_Page and other ChunkedEncodingError sites
+                if isinstance(e, requests.exceptions.ChunkedEncodingError):
+                    accept_encoding = 'identity'
+                    print('retry with Accept-Encoding:', accept_encoding)
 
-                    return self.old_send_method(request, **kwargs)
-                except (KeyboardInterrupt, requests.exceptions.ContentDecodingError): # don't retry
-                    raise
-                except Exception as e:
-                    hard_retries_left -= 1
-                    if hard_retries_left <= 0:
-                        raise
-
-                    print('Hard retry... (%d), due to: %s' % (hard_retries_left, e))
-
-                    # workaround for https://wiki.erischan.org/index.php/Main_Page and other ChunkedEncodingError sites
-                    if isinstance(e, requests.exceptions.ChunkedEncodingError):
-                        accept_encoding = 'identity'
-                        print('retry with Accept-Encoding:', accept_encoding)
-
-                    # if --bypass-cdn-image-compression is enabled, retry with different url
-                    assert isinstance(request.url, str)
-                    if '_wikiteam3_nocdn=' in request.url:
-                        request.url = request.url.replace('_wikiteam3_nocdn=init_req', f'_wikiteam3_nocdn=retry_{hard_retries_left}')
-                        request.url = request.url.replace(
-                            f'_wikiteam3_nocdn=retry_{hard_retries_left + 1}',
-                            f'_wikiteam3_nocdn=retry_{hard_retries_left}'
-                            )
-                        print('--bypass-cdn-image-compression: change url to', request.url, 'on hard retry...')
-
-                    time.sleep(3)
-
-        self.session.send = new_send # type: ignore
-        self.hijacked = True
+                # if --bypass-cdn-image-compression is enabled, retry with different url
+                assert isinstance(request.url, str)
+                if '_wikiteam3_nocdn=' in request.url:
+                    request.url = request.url.replace('_wikiteam3_nocdn=init_req', f'_wikiteam3_nocdn=retry_{hard_retries_left}')
+                    request.url = request.url.replace(
+                        f'_wikiteam3_nocdn=retry_{hard_retries_left + 1}',
+                        f'_wikiteam3_nocdn=retry_{hard_retries_left}'
+                        )
+                    print('--bypass-cdn-image-compression: change url to', request.url, 'on hard retry...')
+
+                BACKPRESSURE.backoff(request.url)
 
     def release(self):
         ''' Undo monkey patch '''
         if not self.hijacked:
             warnings.warn('Warning: SessionMonkeyPatch.release() called before hijack()', RuntimeWarning)
             return
-        self.session.send = self.old_send_method
-        del self
+        with self._registry_lock:
+            patches: List[SessionMonkeyPatch] = self.session.__dict__.get("_wikiteam3_patches", [])
+            if self in patches:
+                patches.remove(self)
+            if not patches and "_wikiteam3_original_send" in self.session.__dict__:
+                self.session.send = self.session.__dict__.pop("_wikiteam3_original_send") # type: ignore
+        self.hijacked = False
 
     def __del__(self):
         if self.hijacked:
             print('Undo monkey patch...')
             self.release()
+
+
+def _dispatch_send(session: requests.Session, original_send, request: requests.PreparedRequest, **kwargs):
+    """ `session.send` while `SessionMonkeyPatch`es are active """
+    patches: List[SessionMonkeyPatch] = list(session.__dict__.get("_wikiteam3_patches", []))
+    if not patches: # released meanwhile
+        return original_send(request, **kwargs)
+    phase = current_phase()
+    patch = next((p for p in reversed(patches) if p.phase == phase), patches[-1])
+    return patch.send(request, **kwargs)
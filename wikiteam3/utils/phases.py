@@ -0,0 +1,130 @@
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Callable, List, Optional, TextIO, Tuple
+
+Phase = Tuple[str, Callable[[], None]]
+""" (label, function), e.g. ("images", lambda: ...) """
+ProgressCallback = Callable[[str, str], None]
+""" on_progress(label, event), event: "started", "done" or "failed" """
+
+_local = threading.local()
+
+
+def current_phase() -> Optional[str]:
+    """Label of the phase running in this thread, None outside of `run_phases(concurrent=True)`"""
+    return getattr(_local, "phase", None)
+
+
+@contextmanager
+def labeled(label: str):
+    """Label the output of this thread, nested in the current label if any (e.g. "wiki.example/xml")"""
+    parent = current_phase()
+    _local.phase = f"{parent}/{label}" if parent else label
+    try:
+        yield
+    finally:
+        _local.phase = parent
+
+
+class PhaseOutput:
+    """
+    Wraps stdout/stderr to prefix the lines printed by a phase thread with `[label] `,
+    so the output of concurrent phases can be told apart.
+    """
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self._at_line_start = threading.local()
+
+    def write(self, text: str) -> int:
+        label = current_phase()
+        if label is None or not text:
+            return self.stream.write(text)
+        out = []
+        at_line_start = getattr(self._at_line_start, "value", True)
+        for part in text.splitlines(keepends=True):
+            if at_line_start:
+                out.append(f"[{label}] ")
+            out.append(part)
+            at_line_start = part.endswith(("\n", "\r"))
+        self._at_line_start.value = at_line_start
+        return self.stream.write("".join(out))
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def labeled_output():
+    """Prefix the lines printed by labeled threads (see `PhaseOutput`) while in this context"""
+    if isinstance(sys.stdout, PhaseOutput):
+        yield
+        return
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = PhaseOutput(stdout), PhaseOutput(stderr) # type: ignore
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def _notify(on_progress: Optional[ProgressCallback], label: str, event: str):
+    if on_progress is None:
+        return
+    try:
+        on_progress(label, event)
+    except Exception as e:
+        print(f"on_progress({label!r}, {event!r}) failed: {e!r}")
+
+
+def _run_tracked(label: str, func: Callable[[], None], on_progress: Optional[ProgressCallback]):
+    _notify(on_progress, label, "started")
+    try:
+        func()
+    except BaseException:
+        _notify(on_progress, label, "failed")
+        raise
+    _notify(on_progress, label, "done")
+
+
+def _run_labeled(parent: Optional[str], label: str, func: Callable[[], None], errors: List[Tuple[str, BaseException]],
+                 on_progress: Optional[ProgressCallback]):
+    _local.phase = parent
+    with labeled(label):
+        try:
+            print(f"=== {label}: started ===")
+            _run_tracked(label, func, on_progress)
+            print(f"=== {label}: done ===")
+        except BaseException as e:
+            print(f"=== {label}: failed: {e!r} ===")
+            errors.append((label, e))
+
+
+def run_phases(phases: List[Phase], concurrent: bool = False, on_progress: Optional[ProgressCallback] = None):
+    """Run the dump phases, one after another or (`concurrent`) each in its own thread
+
+    Concurrent phases share the session, so its rate limiter (one politeness budget per host).
+    A failing phase doesn't stop the others, the first exception is raised once all are finished.
+    Phase threads are daemons, so Ctrl-C still exits (every phase keeps its own resume state).
+    `on_progress` is called when a phase starts and ends (from its thread), its errors are only printed.
+    """
+    if not concurrent or len(phases) < 2:
+        for label, func in phases:
+            _run_tracked(label, func, on_progress)
+        return
+
+    errors: List[Tuple[str, BaseException]] = []
+    parent = current_phase()
+    threads = [
+        threading.Thread(target=_run_labeled, args=(parent, label, func, errors, on_progress), name=f"phase-{label}", daemon=True)
+        for label, func in phases
+    ]
+    with labeled_output():
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(timeout=1) # interruptible by Ctrl-C
+    if errors:
+        raise errors[0][1]
@@ -0,0 +1,279 @@
+import datetime
+import email.utils
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+
+from wikiteam3.dumpgenerator.config import Config
+
+
+class DynamicDelay:
+    """
+    `config.delay`, picking up changes of `{config.path}/config.json` (so the delay can be
+    tuned while the dump is running).
+
+    The file is only stat()ed every `poll_interval` seconds, and only parsed when its mtime changed.
+    """
+
+    def __init__(self, config: Config, config_filename: str = "config.json", poll_interval: float = 5.0):
+        self.config = config
+        self.config_filename = config_filename
+        self.poll_interval = poll_interval
+        self.delay = float(config.delay or 0)
+
+        self._lock = threading.Lock()
+        self._next_poll = 0.0
+        self._mtime_ns: Optional[int] = None
+
+    def use(self, config: Config):
+        """Follow `config` (the next dump on a reused session) from now on"""
+        with self._lock:
+            self.config = config
+            self.delay = float(config.delay or 0)
+            self._next_poll = 0.0
+            self._mtime_ns = None
+
+    def get(self) -> float:
+        now = time.monotonic()
+        if now < self._next_poll or not self.config.path:
+            return self.delay
+        with self._lock:
+            if now < self._next_poll:
+                return self.delay
+            self._next_poll = now + self.poll_interval
+            path = os.path.join(self.config.path, self.config_filename)
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+                if mtime_ns != self._mtime_ns:
+                    self._mtime_ns = mtime_ns
+                    with open(path, encoding="utf-8") as f:
+                        delay = float(json.load(f).get("delay", self.delay) or 0)
+                    if delay != self.delay:
+                        print(f"Delay changed in {self.config_filename}: {self.delay}s -> {delay}s")
+                        self.delay = delay
+            except FileNotFoundError:
+                pass # config.json is not saved yet
+            except (OSError, ValueError, TypeError) as e:
+                print(f"Unable to load {self.config_filename} for dynamic delay (keeping {self.delay}s):", e)
+        return self.delay
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket, one bucket per key (host).
+
+    Each request reserves the next free slot of its bucket: slots are `interval` seconds apart,
+    so the time a request takes is credited against the delay of the next one. `burst` requests
+    can be sent back to back after an idle period (1 = strictly one request per `interval`).
+    """
+
+    def __init__(self, burst: int = 1):
+        assert burst >= 1
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._next_slot: Dict[str, float] = {}
+        """ key -> theoretical time of the next request (monotonic) """
+
+    def reserve(self, key: str, interval: float) -> float:
+        """Reserve a slot for `key`, returns how many seconds to wait before using it"""
+        interval = max(0.0, interval)
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(key, now))
+            self._next_slot[key] = slot + interval
+        return max(0.0, slot - now - (self.burst - 1) * interval)
+
+    def acquire(self, key: str, interval: float) -> float:
+        """Block until a request to `key` is allowed, returns the seconds waited"""
+        wait = self.reserve(key, interval)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def hold(self, key: str, seconds: float):
+        """No request to `key` before `seconds` from now"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._next_slot[key] = max(self._next_slot.get(key, until), until)
+
+
+RATE_LIMITER = RateLimiter()
+""" process-wide rate limiter, shared by every session and thread """
+
+
+MAX_BACKOFF_FACTOR = 64
+MAX_RETRY_AFTER = 600
+""" max seconds we honour in a Retry-After header """
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After header (seconds or HTTP-date) -> seconds, None if missing or invalid"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        seconds = (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+    return min(max(0.0, seconds), MAX_RETRY_AFTER)
+
+
+def is_maxlag_response(response: requests.Response) -> bool:
+    """MediaWiki refused the request because the replication lag exceeds `maxlag`"""
+    return response.headers.get("MediaWiki-API-Error") == "maxlag" or "X-Database-Lag" in response.headers
+
+
+class Backpressure:
+    """
+    Per-key (host) slowdown, driven by what the server tells us.
+
+    Overload signals (429, 503, MediaWiki maxlag, timeouts) double the key's backoff factor
+    (up to `MAX_BACKOFF_FACTOR`) and hold the key for `Retry-After` seconds if the server sent one,
+    else for `base_interval * factor` seconds. Healthy responses shrink the factor by `recovery`,
+    so we speed back up to `--delay` once the server is fine again.
+    """
+
+    def __init__(self, limiter: RateLimiter = RATE_LIMITER, base_interval: float = 1.0, recovery: float = 0.75):
+        self.limiter = limiter
+        self.base_interval = base_interval
+        self.recovery = recovery
+        self._lock = threading.Lock()
+        self._factor: Dict[str, float] = {}
+
+    def factor(self, key: str) -> float:
+        return self._factor.get(key, 1.0)
+
+    def interval(self, key: str, delay: float) -> float:
+        """interval between requests to `key`, given the configured `delay`"""
+        factor = self.factor(key)
+        if factor <= 1.0:
+            return delay
+        return max(delay, self.base_interval) * factor
+
+    def on_success(self, key: str):
+        if key not in self._factor:
+            return
+        with self._lock:
+            factor = self._factor.get(key, 1.0) * self.recovery
+            if factor <= 1.0:
+                self._factor.pop(key, None)
+            else:
+                self._factor[key] = factor
+
+    def on_overload(self, key: str, retry_after: Optional[float] = None) -> float:
+        """Slow down `key`, returns how long `key` is held"""
+        with self._lock:
+            factor = min(self._factor.get(key, 1.0) * 2, MAX_BACKOFF_FACTOR)
+            self._factor[key] = factor
+        wait = retry_after if retry_after is not None else self.base_interval * factor
+        self.limiter.hold(key, wait)
+        return wait
+
+    def on_response(self, response: requests.Response) -> Optional[float]:
+        """Update the state of the response's host, returns the hold time if the server is overloaded"""
+        assert isinstance(response.url, str)
+        key = limiter_key(response.url)
+        if response.status_code in (429, 503) or is_maxlag_response(response):
+            return self.on_overload(key, parse_retry_after(response.headers.get("Retry-After")))
+        if response.status_code < 400:
+            self.on_success(key)
+        return None
+
+    def backoff(self, url: str) -> float:
+        """Slow down the host of `url` (e.g. after a timeout) and wait, returns the seconds waited"""
+        key = limiter_key(url)
+        wait = self.on_overload(key)
+        self.limiter.acquire(key, 0)
+        return wait
+
+
+BACKPRESSURE = Backpressure()
+""" process-wide backpressure state, shared by every session and thread """
+
+
+MAXLAG = int(os.getenv("WIKITEAM3_MAXLAG", "5"))
+""" `maxlag` sent to api.php (seconds of replication lag), 0 to disable """
+MAXLAG_RETRIES = 10
+
+
+FARM_DOMAINS = [
+    "fandom.com", "wikia.com", "wikia.org", "miraheze.org", "wiki.gg", "shoutwiki.com", "referata.com",
+] + [d.strip().lower() for d in os.getenv("WIKITEAM3_FARM_DOMAINS", "").split(",") if d.strip()]
+""" wiki farms: their wikis (subdomains) share one politeness budget """
+
+
+def farm_key(host: str) -> str:
+    """The wiki farm domain of `host` (e.g. "fandom.com" for "foo.fandom.com"), else the host itself"""
+    host = host.lower()
+    for domain in FARM_DOMAINS:
+        if host == domain or host.endswith("." + domain):
+            return domain
+    return host
+
+
+def limiter_key(url: str) -> str:
+    return farm_key(urlparse(url).hostname or "")
+
+
+def is_rate_limited(session: requests.Session) -> bool:
+    """Whether `install_rate_limiter()` was called on `session`"""
+    return session.__dict__.get("_wikiteam3_delay") is not None
+
+
+def limit_request(url: str, delay: float, limiter: RateLimiter = RATE_LIMITER,
+                  backpressure: Backpressure = BACKPRESSURE):
+    """Wait for the slot of a request to `url` sent by a session without `install_rate_limiter()`
+    (e.g. the startup checks)"""
+    key = limiter_key(url)
+    limiter.acquire(key, backpressure.interval(key, delay))
+
+
+def install_rate_limiter(session: requests.Session, config: Config,
+                         limiter: RateLimiter = RATE_LIMITER,
+                         backpressure: Backpressure = BACKPRESSURE) -> DynamicDelay:
+    """Rate limit every request sent by `session` to `config.delay` (per host), with backpressure
+
+    - api.php requests are sent with `maxlag`, and retried when MediaWiki says the database is lagged
+    - `Retry-After`, 429 and 503 slow down the host (see `Backpressure`)
+
+    Wraps `session.send` permanently, the requests sent through `mwclient.Site(pool=session)`
+    and redirects are limited too. Installing it again on a reused session only switches to `config`.
+    """
+    if (delay := session.__dict__.get("_wikiteam3_delay")) is not None:
+        delay.use(config)
+        return delay
+    delay = DynamicDelay(config)
+    session.__dict__["_wikiteam3_delay"] = delay
+    send = session.send
+
+    def limited_send(request: requests.PreparedRequest, **kwargs):
+        assert isinstance(request.url, str)
+        key = limiter_key(request.url)
+        url = urlparse(request.url)
+        if MAXLAG > 0 and url.path.endswith("api.php") and "maxlag=" not in (url.query or ""):
+            request.prepare_url(request.url, {"maxlag": MAXLAG})
+
+        for attempt in range(MAXLAG_RETRIES + 1):
+            limiter.acquire(key, backpressure.interval(key, delay.get()))
+            r = send(request, **kwargs)
+            wait = backpressure.on_response(r)
+            if wait is not None and attempt < MAXLAG_RETRIES and is_maxlag_response(r):
+                print(f"Server is lagged ({r.headers.get('X-Database-Lag', '?')}s), retrying in {wait:.1f}s...")
+                r.close()
+                continue
+            return r
+        assert False, "Unreachable"
+
+    session.send = limited_send # type: ignore
+    return delay
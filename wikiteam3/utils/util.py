@@ -1,11 +1,15 @@
 import datetime
 import hashlib
+import heapq
+import itertools
+import os
 from pathlib import Path
 import re
-import sys
+import tempfile
 from typing import Optional, Union
 
 from wikiteam3.dumpgenerator.config import Config
+from wikiteam3.dumpgenerator.exceptions import DumpError
 
 ALL_DUMPED_MARK = "all_dumped.mark"
 UPLOADED_MARK = 'uploaded_to_IA.mark'
@@ -52,7 +56,7 @@ def clean_HTML(raw: str = "") -> str:
     else:
         print(raw[:250])
         print("This wiki doesn't use marks to split content")
-        sys.exit(1)
+        raise DumpError("This wiki doesn't use marks to split content")
     return raw
 
 
@@ -144,3 +148,39 @@ def int_or_zero(size: Union[int, str]) -> int:
 def is_empty_dir(path: Union[str, Path]) -> bool:
     assert Path(path).is_dir()
     return not any(Path(path).iterdir())
+
+
+def sort_unique_lines(path: Union[str, Path], run_lines: int = 1 << 18):
+    """ Sort the lines of a text file and remove duplicated lines, in place.
+
+    External merge sort, at most `run_lines` lines are kept in memory.
+    The file is replaced atomically.
+    """
+    path = str(path)
+    tmpdir = tempfile.mkdtemp(prefix=".sort-", dir=os.path.dirname(path) or ".")
+    runs = []
+    try:
+        with open(path, "rb") as f:
+            while lines := list(itertools.islice(f, run_lines)):
+                lines = sorted(line if line.endswith(b"\n") else line + b"\n" for line in lines)
+                run_path = os.path.join(tmpdir, "run-%d" % len(runs))
+                with open(run_path, "wb") as run:
+                    run.writelines(lines)
+                runs.append(run_path)
+
+        run_files = [open(run_path, "rb") for run_path in runs]
+        try:
+            with open(path + ".tmp", "wb") as out:
+                last = None
+                for line in heapq.merge(*run_files):
+                    if line != last:
+                        out.write(line)
+                        last = line
+        finally:
+            for run in run_files:
+                run.close()
+        os.replace(path + ".tmp", path)
+    finally:
+        for run_path in runs:
+            os.remove(run_path)
+        os.rmdir(tmpdir)
@@ -1,10 +1,10 @@
 import re
-import sys
 from urllib.parse import urlparse
 
 import requests
 
 from wikiteam3.dumpgenerator.config import Config, OtherConfig
+from wikiteam3.dumpgenerator.exceptions import WikiAvoidedError
 
 def avoid_WikiMedia_projects(config: Config, other: OtherConfig):
     """Skip Wikimedia projects and redirect to the dumps website"""
@@ -23,7 +23,7 @@ def avoid_WikiMedia_projects(config: Config, other: OtherConfig):
         print("Download the dumps from http://dumps.wikimedia.org")
         if not other.force:
             print("Thanks!")
-            sys.exit(2)
+            raise WikiAvoidedError("Wikimedia project, download the dumps from http://dumps.wikimedia.org", exit_code=2)
 
 def avoid_robots_disallow(config: Config, other: OtherConfig):
     """Check if the robots.txt allows the download"""
@@ -43,4 +43,4 @@ def avoid_robots_disallow(config: Config, other: OtherConfig):
         print('Error: cannot get robots.txt', e)
 
     if exit_:
-        sys.exit(20)
+        raise WikiAvoidedError("robots.txt disallows wikiteam3", exit_code=20)